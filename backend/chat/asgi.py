@@ -23,7 +23,9 @@ django.setup()
 from django.core.asgi import get_asgi_application
 from channels.routing import ProtocolTypeRouter, URLRouter
 from channels.auth import AuthMiddlewareStack
-from channels.security.websocket import AllowedHostsOriginValidator
+from channels.security.websocket import AllowedHostsOriginValidator, OriginValidator
+from django.conf import settings
+from core.middleware import JWTAuthMiddleware
 from core.routing import websocket_urlpatterns
 
 
@@ -42,5 +44,10 @@ application = get_asgi_application()
 
 application = ProtocolTypeRouter({
     "http": application,
-    "websocket": URLRouter(websocket_urlpatterns),
+    # The access_token cookie is sent along by any page that opens a socket,
+    # so only the frontend's origins may connect
+    "websocket": OriginValidator(
+        JWTAuthMiddleware(URLRouter(websocket_urlpatterns)),
+        settings.CORS_ALLOWED_ORIGINS,
+    ),
 })
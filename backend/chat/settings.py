@@ -92,7 +92,8 @@ TEMPLATES = [
 
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': (
-        'rest_framework_simplejwt.authentication.JWTAuthentication',
+        # simplejwt's JWTAuthentication, with the authenticated users cached
+        'core.authentication.CachedJWTAuthentication',
     ),
 }
 
@@ -129,6 +130,18 @@ CHANNEL_LAYERS = {
     },
 }
 
+# To run several Daphne workers on one host, start `python manage.py runbroker`
+# and point every worker at the broker's socket.
+if os.getenv('CHANNEL_BROKER_SOCKET'):
+    CHANNEL_LAYERS = {
+        'default': {
+            'BACKEND': 'core.layers.BrokerChannelLayer',
+            'CONFIG': {
+                'path': os.getenv('CHANNEL_BROKER_SOCKET'),
+            },
+        },
+    }
+
 # CHANNEL_LAYERS = {
 #     'default': {
 #         'BACKEND': 'channels_redis.core.RedisChannelLayer',
@@ -139,6 +152,77 @@ CHANNEL_LAYERS = {
     # },
 # }
 
+# Chat message persistence
+# With write-behind enabled, ChatConsumer broadcasts a message straight away and
+# queues its INSERT; queued messages are written with bulk_create once
+# BATCH_SIZE are waiting or FLUSH_INTERVAL seconds have passed. Queued messages
+# are broadcast with ids reserved ID_BLOCK_SIZE at a time; reserved blocks would
+# let ids of different workers interleave out of order, so workers sharing a
+# channel broker reserve one id per message.
+CHAT_WRITE_BEHIND = {
+    'ENABLED': os.getenv('CHAT_WRITE_BEHIND', 'false').lower() == 'true',
+    'BATCH_SIZE': 100,
+    'FLUSH_INTERVAL': 0.05,
+    'ID_BLOCK_SIZE': 1 if os.getenv('CHANNEL_BROKER_SOCKET') else 100,
+}
+
+# Read receipts
+# "mark read" events are debounced and written in bulk every FLUSH_INTERVAL
+# seconds, or sooner once BATCH_SIZE marks are queued.
+CHAT_READ_RECEIPTS = {
+    'BATCH_SIZE': 500,
+    'FLUSH_INTERVAL': 1.0,
+}
+
+# History replay
+# ChatConsumer replays missed messages to clients connecting with ?since=<id>
+# or ?last=<n>, CHUNK_SIZE messages per frame and at most MAX_MESSAGES in all.
+CHAT_REPLAY = {
+    'CHUNK_SIZE': 100,
+    'MAX_MESSAGES': 1000,
+}
+
+# Hot message history
+# Each process keeps the newest MESSAGES serialized messages of recently opened
+# rooms, up to MAX_BYTES in total, and serves the first page of message history
+# from them. Only consistent when a single process writes messages, so it is
+# off when workers share a channel broker.
+CHAT_HISTORY_CACHE = {
+    'ENABLED': not os.getenv('CHANNEL_BROKER_SOCKET'),
+    'MESSAGES': 200,
+    'MAX_BYTES': 64 * 1024 * 1024,
+}
+
+# Presence
+# A global connection that has not sent a heartbeat for HEARTBEAT_TIMEOUT
+# seconds is expired. Expiry and the lazy writes of User.is_online run every
+# SWEEP_INTERVAL seconds; presence changes are broadcast as one diff every
+# BROADCAST_INTERVAL seconds. When workers share a channel broker, presence is
+# SHARED: the broker keeps it for all of them.
+CHAT_PRESENCE = {
+    'HEARTBEAT_TIMEOUT': 90,
+    'SWEEP_INTERVAL': 5,
+    'BROADCAST_INTERVAL': 1,
+    'SHARED': bool(os.getenv('CHANNEL_BROKER_SOCKET')),
+}
+
+# Outbound WebSocket queues
+# Every connection queues at most MAX_QUEUE frames. When a queue is full, the
+# consumer's policy applies: 'drop_oldest', 'coalesce_presence' (merge queued
+# presence diffs) or 'disconnect' (close with a resume hint).
+CHAT_OUTBOUND = {
+    'MAX_QUEUE': 256,
+    'CHAT_POLICY': 'disconnect',
+    'GLOBAL_POLICY': 'coalesce_presence',
+}
+
+# Metrics
+# /api/metrics/ serves Prometheus metrics to admins and to scrapers connecting
+# from ALLOWED_IPS.
+CHAT_METRICS = {
+    'ALLOWED_IPS': os.getenv('METRICS_ALLOWED_IPS', '127.0.0.1').split(','),
+}
+
 SIMPLE_JWT = {
   'ACCESS_TOKEN_LIFETIME': timedelta(days=2),
   'REFRESH_TOKEN_LIFETIME': timedelta(days=3),
@@ -188,9 +272,23 @@ SIMPLE_JWT = {
 # }
 
 DATABASES = {
-    'default': dj_database_url.config(default=os.getenv('DATABASE_URL'))
+    # Connections are closed at the end of each request; only the consumers'
+    # database threads below keep theirs open (CHAT_DB_CONN_MAX_AGE)
+    'default': dj_database_url.config(
+        default=os.getenv('DATABASE_URL'),
+        conn_max_age=0,
+        conn_health_checks=True,
+    )
 }
 
+# Threads running the consumers' database work, see core/db.py. Each holds one
+# persistent connection, so keep it under the database's connection limit
+# divided by the number of worker processes. Not used with SQLite, whose
+# database work stays on a single thread.
+CHAT_DB_THREADS = int(os.getenv('CHAT_DB_THREADS', 8))
+# Seconds the connection of each of those threads is reused for
+CHAT_DB_CONN_MAX_AGE = int(os.getenv('CHAT_DB_CONN_MAX_AGE', 600))
+
 # Password validation
 # https://docs.djangoproject.com/en/5.0/ref/settings/#auth-password-validators
 
@@ -228,6 +326,39 @@ USE_TZ = True
 
 STATIC_URL = 'static/'
 
+# File storage
+# Chat media goes to the 'chat_media' storage; the local filesystem stands in
+# for an object store backend in development and tests.
+STORAGES = {
+    'default': {
+        'BACKEND': 'django.core.files.storage.FileSystemStorage',
+    },
+    'staticfiles': {
+        'BACKEND': 'django.contrib.staticfiles.storage.StaticFilesStorage',
+    },
+    'chat_media': {
+        'BACKEND': 'django.core.files.storage.FileSystemStorage',
+        'OPTIONS': {
+            'location': os.getenv('CHAT_MEDIA_ROOT', BASE_DIR / 'media'),
+            'base_url': '/media/',
+        },
+    },
+}
+
+# Chat media uploads
+# Files of up to MAX_SIZE bytes are uploaded in chunks of at most
+# MAX_CHUNK_SIZE bytes, assembled in UPLOAD_DIR and then moved to the
+# 'chat_media' storage. WORKERS threads hash and store
+# completed uploads and make thumbnails THUMBNAIL_SIZE pixels wide and high at
+# most.
+CHAT_MEDIA = {
+    'MAX_SIZE': 100 * 1024 * 1024,
+    'MAX_CHUNK_SIZE': 8 * 1024 * 1024,
+    'UPLOAD_DIR': os.getenv('CHAT_UPLOAD_DIR', BASE_DIR / 'uploads'),
+    'WORKERS': 2,
+    'THUMBNAIL_SIZE': 320,
+}
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/5.0/ref/settings/#default-auto-field
 
@@ -14,10 +14,21 @@ Including another URLconf
     1. Import the include() function: from django.urls import include, path
     2. Add a URL to urlpatterns:  path('blog/', include('blog.urls'))
 """
+from django.conf import settings
+from django.conf.urls.static import static
 from django.contrib import admin
 from django.urls import path, include
 
+from core.views import serve_media
+
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('api/', include('core.urls')),
 ]
+
+# Chat media from the local 'chat_media' storage; only served by Django in development
+urlpatterns += static(
+    settings.STORAGES['chat_media']['OPTIONS']['base_url'],
+    view=serve_media,
+    document_root=settings.STORAGES['chat_media']['OPTIONS']['location'],
+)
@@ -5,3 +5,5 @@ admin.site.register(ChatRoom)
 admin.site.register(Message)
 admin.site.register(User)
 admin.site.register(Conversation)
+admin.site.register(ReadState)
+admin.site.register(MediaAsset)
@@ -0,0 +1,32 @@
+import copy
+
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import InvalidToken
+from rest_framework_simplejwt.settings import api_settings
+
+from .cache import principals
+
+
+class CachedJWTAuthentication(JWTAuthentication):
+    """
+    JWTAuthentication that keeps authenticated users in a bounded TTL cache,
+    so polling clients do not load their User row on every request.
+
+    Entries are dropped when the user is saved (which covers password changes)
+    or logs out, in every worker when they share a broker (see
+    core.cache.invalidate), and expire after the cache's TTL regardless.
+    """
+
+    def get_user(self, validated_token):
+        try:
+            user_id = validated_token[api_settings.USER_ID_CLAIM]
+        except KeyError:
+            raise InvalidToken('Token contained no recognizable user identification')
+
+        user = principals.get(user_id)
+        if user is None:
+            # Raises for unknown and inactive users, which are never cached
+            user = super().get_user(validated_token)
+            principals.set(user_id, user)
+        # Requests get their own copy, so attributes set on request.user do not leak
+        return copy.copy(user)
@@ -0,0 +1,99 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+from channels.layers import get_channel_layer
+from django.db import transaction
+
+logger = logging.getLogger(__name__)
+
+# Name -> LRUCache for caches that are invalidated across worker processes
+shared_caches = {}
+
+
+class LRUCache:
+    """
+    Small thread-safe, bounded, least-recently-used mapping.
+
+    Used for process-level lookups that are read on every message and change
+    rarely, so that hot paths do not go back to the database. With `ttl`,
+    entries also expire `ttl` seconds after they were set, which bounds how
+    stale they get in processes that did not see the invalidating write.
+
+    Caches with a `name` can be invalidated in every worker process through
+    `invalidate`.
+    """
+
+    def __init__(self, maxsize=1024, ttl=None, name=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.name = name
+        if name is not None:
+            shared_caches[name] = self
+        self._data = OrderedDict()  # key -> (expires or None, value)
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                self._data.move_to_end(key)
+                expires, value = self._data[key]
+            except KeyError:
+                return default
+            if expires is not None and expires < time.monotonic():
+                del self._data[key]
+                return default
+            return value
+
+    def set(self, key, value):
+        expires = time.monotonic() + self.ttl if self.ttl is not None else None
+        with self._lock:
+            self._data[key] = (expires, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+def invalidate(cache, key):
+    """
+    Delete `key` from `cache` in this process and, once the current
+    transaction commits, in every worker sharing a BrokerChannelLayer.
+    """
+
+    cache.delete(key)
+    publish = getattr(get_channel_layer(), 'publish_invalidation', None)
+    if publish is None or cache.name is None:
+        return
+
+    def broadcast():
+        try:
+            publish(cache.name, key)
+        except OSError as e:
+            logger.error(f"Could not invalidate {cache.name} {key!r} in other workers: {e}")
+
+    transaction.on_commit(broadcast)
+
+
+# Room name -> ChatRoom primary key
+room_ids = LRUCache(maxsize=10000, name='room_ids')
+
+# ChatRoom primary key -> frozenset of participant user ids
+room_members = LRUCache(maxsize=10000, name='room_members')
+
+# (Cloudinary public id, transformation options) -> resolved URL
+avatar_urls = LRUCache(maxsize=50000)
+
+# User id -> User authenticated by CachedJWTAuthentication
+principals = LRUCache(maxsize=10000, ttl=60, name='principals')
@@ -1,96 +1,265 @@
-import json
+import asyncio
 import logging
 from channels.generic.websocket import AsyncWebsocketConsumer
-from .models import ChatRoom, Message, User
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from .cache import room_ids, room_members
+from .encoding import decode_frame, encode_frames, negotiate_encoding
+from .history import room_history
+from .media import visible_assets
+from .metrics import receive_phase_seconds, room_connections, timed_handler, timed_sync_to_async
+from .models import ChatRoom, Conversation, MediaAsset, Message, ReadState, User
+from .outbound import OutboundQueueMixin
+from .pagination import messages_after
+from .persistence import (
+    add_unread,
+    ensure_read_states,
+    get_message_buffer,
+    get_message_ids,
+    get_read_buffer,
+    touch_conversation,
+)
+from .presence import presence
 from .serializers import MessageSerializer
-from asgiref.sync import sync_to_async
 from urllib.parse import parse_qs
 
 logger = logging.getLogger(__name__)
 
-class ChatConsumer(AsyncWebsocketConsumer):
+
+def inbox_group_name(user_id):
+    """
+    Name of the group holding every global connection of a user.
+    """
+
+    return f'inbox_{user_id}'
+
+
+class ChatConsumer(OutboundQueueMixin, AsyncWebsocketConsumer):
+    outbound_policy = settings.CHAT_OUTBOUND['CHAT_POLICY']
+
+    @timed_handler
     async def connect(self):
         try:
             query_params = parse_qs(self.scope['query_string'].decode())
-            user_id = query_params.get('user_id', [None])[0]
 
             self.room_name = self.scope['url_route']['kwargs']['room_name']
             self.room_group_name = f'chat_{self.room_name}'
+            # Messages sent by the history replay, see chat_message
+            self.replayed_ids = set()
 
-            if user_id:
-                user = await self.get_user(user_id)
-                if user:
-                    self.scope['user'] = user
-                else:
-                    logger.error(f"User with ID {user_id} does not exist.")
-                    await self.close()
-                    return
-            else:
-                logger.error("User ID is missing in the query parameters.")
+            # Set from the access token by JWTAuthMiddleware, without a query
+            if not self.scope['user'].is_authenticated:
+                logger.error("WebSocket connection without a valid access token.")
                 await self.close()
                 return
 
+            # Resolved once per connection so that sending a message is a single INSERT
+            self.room_id = await self.get_room_id(self.room_name)
+
             # Add user to the room group
             await self.channel_layer.group_add(
                 self.room_group_name,
                 self.channel_name
             )
 
-            await self.accept()
+            self.binary, subprotocol = negotiate_encoding(self.scope, query_params)
+            await self.accept(subprotocol=subprotocol)
+            room_connections.inc(room=self.room_name)
+            self.counted = True
+
+            # Joined the group before reading history, so nothing falls in between
+            since = query_params.get('since', [None])[0]
+            last = query_params.get('last', [None])[0]
+            if since or last:
+                await self.replay_history(since=since, last=last)
         except Exception as e:
             logger.error(f"Error in connect method: {e}")
             await self.close()
 
+    async def replay_history(self, since=None, last=None):
+        """
+        Send the messages after message `since`, or the `last` N messages, as
+        {"type": "history", "messages": [...], "done": bool, "truncated": bool}
+        frames of up to CHUNK_SIZE messages, oldest first. Live messages that
+        were already replayed are skipped afterwards. `truncated` means there
+        was more to replay than MAX_MESSAGES (or `since` is unknown) and the
+        client should page the rest over REST.
+        """
+
+        config = settings.CHAT_REPLAY
+        chunk_size = config['CHUNK_SIZE']
+        if settings.CHAT_WRITE_BEHIND['ENABLED']:
+            # Queued messages have to be in the database to be replayed
+            await get_message_buffer().flush()
+
+        if last:
+            messages = await self.load_last_messages(min(int(last), config['MAX_MESSAGES']))
+            chunks = [messages[i:i + chunk_size] for i in range(0, len(messages), chunk_size)] or [[]]
+            for index, chunk in enumerate(chunks):
+                await self.send_history(chunk, done=index == len(chunks) - 1)
+            return
+
+        anchor = await self.get_message_anchor(int(since))
+        if anchor is None:
+            await self.send_history([], done=True, truncated=True)
+            return
+        # The client has everything up to `since`, even if nothing new is delivered
+        self.delivered_message_id = anchor['id']
+        sent = 0
+        while True:
+            limit = min(chunk_size, config['MAX_MESSAGES'] - sent)
+            # One message more than is sent tells whether anything is left
+            chunk = await self.load_messages_after(anchor, limit + 1)
+            more, chunk = len(chunk) > limit, chunk[:limit]
+            sent += len(chunk)
+            if not more or sent >= config['MAX_MESSAGES']:
+                await self.send_history(chunk, done=True, truncated=more)
+                return
+            await self.send_history(chunk, done=False)
+            anchor = {'id': chunk[-1]['id'], 'created_at': chunk[-1]['_created_at']}
+
+    async def send_history(self, messages, done, truncated=False):
+        # Ids, not a watermark: with write-behind, ids are reserved before the
+        # messages are written, so a live message may have a lower id than one replayed
+        self.replayed_ids.update(message['id'] for message in messages)
+        await self.send_frame(self.encode({
+            'type': 'history',
+            'messages': [{k: v for k, v in message.items() if k != '_created_at'} for message in messages],
+            'done': done,
+            'truncated': truncated
+        }), message_id=messages[-1]['id'] if messages else None)
+
+    @timed_handler
     async def disconnect(self, close_code):
+        if getattr(self, 'counted', False):
+            room_connections.dec(room=self.room_name)
         try:
             # Leave room group
             await self.channel_layer.group_discard(
                 self.room_group_name,
                 self.channel_name
             )
+            if settings.CHAT_WRITE_BEHIND['ENABLED']:
+                await get_message_buffer().flush()
         except Exception as e:
             logger.error(f"Error in disconnect method: {e}")
 
-    async def receive(self, text_data):
+    @timed_handler
+    async def receive(self, text_data=None, bytes_data=None):
         try:
-            text_data_json = json.loads(text_data)
+            with receive_phase_seconds.time(phase='parse'):
+                text_data_json = decode_frame(text_data, bytes_data)
+            if text_data_json.get('type') == 'read':
+                await self.mark_read(int(text_data_json['messageId']))
+                return
+
             text = text_data_json['text']
-            userId = text_data_json['userId']
             message_type = text_data_json['messageType']
+            media = None
+            if text_data_json.get('mediaId'):
+                # Uploaded beforehand through the media upload endpoints
+                media = await self.get_media(int(text_data_json['mediaId']))
+                if media is None or media.kind != message_type:
+                    logger.error(f"Media asset {text_data_json['mediaId']} does not fit a {message_type} message.")
+                    return
+            with receive_phase_seconds.time(phase='members'):
+                # Cached per room; also makes sure every member has a ReadState to count unread messages in
+                member_ids = await self.get_room_members()
 
-            # Save message to the database
-            message = await self.save_message(self.room_name, userId, text, message_type)
+            with receive_phase_seconds.time(phase='save'):
+                # The full User is needed to serialize the message; loaded once per connection
+                sender = await self.get_sender()
+                if sender is None:
+                    await self.close()
+                    return
+                queued = settings.CHAT_WRITE_BEHIND['ENABLED']
+                if queued:
+                    # Broadcast straight away with a reserved id and leave the INSERT to the write-behind buffer
+                    message_id = await get_message_ids().next_id()
+                    message = self.build_message(sender, text, message_type, media, message_id)
+                    get_message_buffer().put(message)
+                else:
+                    # Save message to the database
+                    message = await self.save_message(sender, text, message_type, media)
 
             if message:  # Ensure message is not None
-                serialized_message = await self.serialize_message(message)
-                await self.channel_layer.group_send(
-                    self.room_group_name,
-                    {
+                with receive_phase_seconds.time(phase='serialize'):
+                    serialized_message = await self.serialize_message(message)
+                    if not queued:
+                        # Queued messages join the hot history once the write-behind buffer writes them
+                        room_history.append(self.room_id, serialized_message)
+                    chat_event = {
                         'type': 'chat_message',
-                        'message': serialized_message
+                        **encode_frames(serialized_message),
+                        'message_id': message.pk
                     }
-                )
-                await self.channel_layer.group_send(
-                    'chat_global',
-                    {
+                    # Notify the room's participants only, through their inboxes
+                    event = {
                         'type': 'global_message',
-                        'message': serialized_message,
-                        'room_name': self.room_name
+                        **encode_frames({
+                            'type': 'global_message',
+                            'room_name': self.room_name,
+                            'message': serialized_message
+                        })
                     }
-                )
+                with receive_phase_seconds.time(phase='group_send'):
+                    await self.channel_layer.group_send(self.room_group_name, chat_event)
+                    for member_id in member_ids:
+                        await self.channel_layer.group_send(inbox_group_name(member_id), event)
         except Exception as e:
             logger.error(f"Error in receive method: {e}")
 
+    async def mark_read(self, message_id):
+        # Marks are debounced per connection and written in bulk by the read buffer
+        if message_id <= getattr(self, 'last_read_message_id', 0):
+            return
+        # One bad id would fail the whole bulk write of the buffered marks
+        if message_id != getattr(self, 'last_message_id', None) and not await self.is_room_message(message_id):
+            logger.error(f"Read mark for message {message_id}, which is not in room {self.room_name}.")
+            return
+        self.last_read_message_id = message_id
+        user_id = self.scope['user'].id
+        get_read_buffer().put((user_id, self.room_id, message_id))
+        await self.channel_layer.group_send(
+            self.room_group_name,
+            {
+                'type': 'chat_message',
+                **encode_frames({
+                    'type': 'read',
+                    'user': user_id,
+                    'messageId': message_id
+                })
+            }
+        )
+
+    @timed_handler
     async def chat_message(self, event):
         try:
-            message = event['message']
-
-            # Send message to WebSocket
-            await self.send(text_data=json.dumps(message))
+            message_id = event.get('message_id')
+            if message_id in self.replayed_ids:
+                # Already sent as part of the history replay, and never broadcast twice
+                self.replayed_ids.discard(message_id)
+                return
+            # Queue the pre-encoded message for the WebSocket
+            await self.send_event(event)
+            if message_id:
+                # Known to be in this room, which saves mark_read a query
+                self.last_message_id = message_id
         except Exception as e:
             logger.error(f"Error in chat_message method: {e}")
 
-    @sync_to_async
+    def resume_hint(self):
+        # Tells a client dropped for being too slow where to resume from:
+        # the last message it was sent, not the last one queued and dropped
+        return {'type': 'resume', 'since': getattr(self, 'delivered_message_id', None)}
+
+    async def get_sender(self):
+        if not hasattr(self, 'sender'):
+            self.sender = await self.get_user(self.scope['user'].id)
+        return self.sender
+
+    @timed_sync_to_async('get_user')
     def get_user(self, user_id):
         try:
             return User.objects.get(id=user_id)
@@ -98,103 +267,187 @@ class ChatConsumer(AsyncWebsocketConsumer):
             logger.error(f"User with ID {user_id} does not exist.")
             return None
 
-    @sync_to_async
-    def save_message(self, room_name, sender_id, message_text, message_type):
-        try:
+    @timed_sync_to_async('get_room_id')
+    def get_room_id(self, room_name):
+        room_id = room_ids.get(room_name)
+        if room_id is None:
             room, _ = ChatRoom.objects.get_or_create(name=room_name)
-            user = User.objects.get(id=sender_id)
-            message = Message.objects.create(chat_room=room, user=user, text=message_text, message_type=message_type)
+            room_id = room.pk
+            if not Conversation.objects.filter(chat_room=room).exists() and not self.create_direct_conversation(room):
+                # Not cached, so that a participant connecting later still creates it
+                return room_id
+            room_ids.set(room_name, room_id)
+        return room_id
+
+    def create_direct_conversation(self, room):
+        """
+        Create the Conversation of a direct room, which is named after the ids
+        of its two participants (e.g. "3_12"), when one of them connects. Group
+        conversations are never created implicitly. Returns whether one was
+        created.
+        """
+
+        user_ids = {int(part) for part in room.name.split('_') if part.isdigit()}
+        if len(user_ids) != 2 or int(self.scope['user'].id) not in user_ids:
+            return False
+        participants = list(User.objects.filter(pk__in=user_ids))
+        if len(participants) != 2:
+            return False
+        conversation = Conversation.objects.create(chat_room=room, is_group=False)
+        conversation.participants.set(participants)
+        return True
+
+    @timed_sync_to_async('get_room_members')
+    def get_room_members(self):
+        members = room_members.get(self.room_id)
+        if members is None:
+            members = frozenset(
+                Conversation.participants.through.objects
+                .filter(conversation__chat_room_id=self.room_id)
+                .values_list('user_id', flat=True)
+            )
+            if not members:
+                # Direct rooms without a Conversation are named after their two user ids
+                user_ids = [int(part) for part in self.room_name.split('_') if part.isdigit()]
+                members = frozenset(User.objects.filter(pk__in=user_ids).values_list('pk', flat=True))
+            ensure_read_states(self.room_id, members)
+            room_members.set(self.room_id, members)
+        return members
+
+    @timed_sync_to_async('is_room_message')
+    def is_room_message(self, message_id):
+        if not 0 < message_id < 2 ** 63:
+            return False
+        return Message.objects.filter(chat_room_id=self.room_id, id=message_id).exists()
+
+    @timed_sync_to_async('get_media')
+    def get_media(self, media_id):
+        # Only the sender's own uploads and media already sent in their rooms,
+        # once processing has confirmed they are what they claim to be
+        return visible_assets(self.scope['user'].id).filter(pk=media_id, status=MediaAsset.READY).first()
+
+    def build_message(self, sender, message_text, message_type, media=None, message_id=None):
+        return Message(
+            id=message_id,
+            chat_room_id=self.room_id,
+            user=sender,
+            text=message_text,
+            message_type=message_type,
+            media=media,
+            created_at=timezone.now()
+        )
+
+    @timed_sync_to_async('save_message')
+    def save_message(self, sender, message_text, message_type, media=None):
+        try:
+            message = self.build_message(sender, message_text, message_type, media)
+            with transaction.atomic():
+                message.save(force_insert=True)
+                add_unread(self.room_id, {message.user_id: 1})
+                touch_conversation(self.room_id, message)
             return message
         except Exception as e:
             logger.error(f"Error in save_message method: {e}")
             return None
 
-    @sync_to_async
+    @timed_sync_to_async('get_message_anchor')
+    def get_message_anchor(self, message_id):
+        return Message.objects.filter(chat_room_id=self.room_id, id=message_id).values('id', 'created_at').first()
+
+    @timed_sync_to_async('load_messages_after')
+    def load_messages_after(self, anchor, limit):
+        messages = messages_after(Message.objects.filter(chat_room_id=self.room_id), anchor)
+        return self.serialize_history(messages.select_related('user', 'media').order_by('created_at', 'id')[:limit])
+
+    @timed_sync_to_async('load_last_messages')
+    def load_last_messages(self, limit):
+        messages = Message.objects.filter(chat_room_id=self.room_id).select_related('user', 'media')
+        return self.serialize_history(list(messages.order_by('-created_at', '-id')[:limit])[::-1])
+
+    def serialize_history(self, messages):
+        messages = list(messages)
+        watermarks = dict(
+            ReadState.objects.filter(chat_room_id=self.room_id).values_list('user_id', 'last_read_message_id')
+        )
+        data = MessageSerializer(messages, many=True, context={'watermarks': watermarks}).data
+        for item, message in zip(data, messages):
+            # Keyset position of the next chunk; stripped before sending
+            item['_created_at'] = message.created_at
+        return data
+
+    @timed_sync_to_async('serialize_message')
     def serialize_message(self, message):
-        serializer = MessageSerializer(message)
+        serializer = MessageSerializer(message, context={'is_new': True})
         return serializer.data
 
-class GlobalConsumer(AsyncWebsocketConsumer):
+class GlobalConsumer(OutboundQueueMixin, AsyncWebsocketConsumer):
+    outbound_policy = settings.CHAT_OUTBOUND['GLOBAL_POLICY']
+
+    @timed_handler
     async def connect(self):
         query_params = parse_qs(self.scope['query_string'].decode())
-        user_id = query_params.get('user_id', [None])[0]
 
-        if user_id:
-            user = await self.get_user(user_id)
-            if user:
-                self.scope['user'] = user
-            else:
-                await self.close()
-                return
-        else:
+        # A TokenUser from JWTAuthMiddleware; its id and username are all presence needs
+        user = self.scope['user']
+        if not user.is_authenticated:
             await self.close()
             return
 
         self.room_group_name = 'chat_global'
+        self.inbox_group_name = inbox_group_name(user.id)
 
-        await self.channel_layer.group_add(
-            self.room_group_name,
-            self.channel_name
-        )
+        try:
+            await self.channel_layer.group_add(
+                self.room_group_name,
+                self.channel_name
+            )
+            await self.channel_layer.group_add(
+                self.inbox_group_name,
+                self.channel_name
+            )
+        except asyncio.TimeoutError:
+            # The broker did not confirm the membership; the client reconnects
+            await self.close()
+            return
 
-        await self.accept()
-        await self.update_user_status(user, True)
-        await self.broadcast_user_status(user.username, 'online')
+        self.binary, subprotocol = negotiate_encoding(self.scope, query_params)
+        await self.accept(subprotocol=subprotocol)
+        # Answered with a presence_snapshot event
+        await presence.join(self.channel_name, user.id, user.username)
 
+    @timed_handler
     async def disconnect(self, close_code):
+        if not hasattr(self, 'room_group_name'):
+            return
         await self.channel_layer.group_discard(
             self.room_group_name,
             self.channel_name
         )
+        await self.channel_layer.group_discard(
+            self.inbox_group_name,
+            self.channel_name
+        )
 
-        # Mark user as offline and broadcast to global room
-        user = self.scope.get("user")
-        if user:
-            await self.update_user_status(user, False)
-            await self.broadcast_user_status(user.username, 'offline')
+        # Goes out with the next presence diff once the user's last connection is gone
+        await presence.leave(self.channel_name)
 
-    async def receive(self, text_data):
-        pass
+    async def receive(self, text_data=None, bytes_data=None):
+        # Any frame, normally {"type": "heartbeat"}, keeps the connection alive
+        await presence.beat(self.channel_name)
 
-    async def broadcast_user_status(self, username, status):
-        await self.channel_layer.group_send(
-            'chat_global',
-            {
-                'type': 'user_status',
-                'user': username,
-                'status': status
-            }
-        )
+    async def presence_expired(self, event):
+        # The presence sweeper gave up on this connection
+        await self.close()
 
-    async def user_status(self, event):
-        user = event['user']
-        status = event['status']
+    @timed_handler
+    async def presence_snapshot(self, event):
+        await self.send_event(event)
 
-        await self.send(text_data=json.dumps({
-            'type': 'user_status',
-            'user': user,
-            'status': status
-        }))
+    @timed_handler
+    async def presence_diff(self, event):
+        await self.send_event(event, kind='presence')
 
+    @timed_handler
     async def global_message(self, event):
-        message = event['message']
-        room_name = event['room_name']
-
-        # Send message to WebSocket
-        await self.send(text_data=json.dumps({
-            'type': 'global_message',
-            'room_name': room_name,
-            'message': message
-        }))
-
-    @sync_to_async
-    def update_user_status(self, user, is_online):
-        user.is_online = is_online
-        user.save()
-
-    @sync_to_async
-    def get_user(self, user_id):
-        try:
-            return User.objects.get(id=user_id)
-        except User.DoesNotExist:
-            return None
+        # Queue the pre-encoded message for the WebSocket
+        await self.send_event(event)
@@ -0,0 +1,49 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from channels.db import DatabaseSyncToAsync
+from django.conf import settings
+from django.db import connections
+
+
+def persist_connections():
+    """
+    Make the calling thread keep its database connections open for
+    CHAT_DB_CONN_MAX_AGE seconds. Connections are per thread, but their
+    settings_dict is shared, so it is copied rather than changed.
+    """
+
+    for connection in connections.all(initialized_only=False):
+        connection.settings_dict = {**connection.settings_dict, 'CONN_MAX_AGE': settings.CHAT_DB_CONN_MAX_AGE}
+
+
+# Database work of the consumers runs here rather than on asgiref's single
+# thread-sensitive thread, so queries from different connections run in
+# parallel. Every thread keeps its own persistent connection, so the pool size
+# is also the number of pooled database connections. Everything else closes
+# its connections after use (CONN_MAX_AGE = 0).
+executor = ThreadPoolExecutor(
+    max_workers=settings.CHAT_DB_THREADS, thread_name_prefix='chat-db', initializer=persist_connections
+)
+
+
+def db_threads():
+    """
+    Number of threads the database work of the consumers is spread over.
+    """
+
+    return 1 if connections['default'].vendor == 'sqlite' else settings.CHAT_DB_THREADS
+
+
+def db_sync_to_async(func):
+    """
+    Like channels' `database_sync_to_async`, running `func` on the database
+    thread pool. Closes stale connections before and after the call.
+
+    SQLite takes one writer at a time, and the test database is an in-memory
+    database shared between connections, so on SQLite `func` stays on the
+    thread-sensitive thread like it would with `database_sync_to_async`.
+    """
+
+    if connections['default'].vendor == 'sqlite':
+        return DatabaseSyncToAsync(func, thread_sensitive=True)
+    return DatabaseSyncToAsync(func, thread_sensitive=False, executor=executor)
@@ -0,0 +1,117 @@
+import json
+
+import msgpack
+
+from .cache import LRUCache
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# WebSocket subprotocols a client can offer to pick the wire encoding. JSON text
+# frames are the default; the MessagePack encoding sends binary frames with the
+# short keys below.
+SUBPROTOCOL_JSON = 'chat.json.v1'
+SUBPROTOCOL_MSGPACK = 'chat.msgpack.v1'
+
+SHORT_KEYS = {
+    'type': 't',
+    'message': 'm',
+    'messages': 'ms',
+    'room_name': 'r',
+    'id': 'i',
+    'user': 'u',
+    'username': 'n',
+    'profile_picture': 'p',
+    'is_online': 'o',
+    'text': 'x',
+    'message_type': 'k',
+    'messageType': 'mt',
+    'messageId': 'mi',
+    'media': 'md',
+    'mediaId': 'mdi',
+    'seen_by': 's',
+    'created_at': 'c',
+    'online': 'on',
+    'offline': 'of',
+    'done': 'd',
+    'truncated': 'tr',
+    'since': 'si',
+}
+LONG_KEYS = {short: key for key, short in SHORT_KEYS.items()}
+
+# JSON frame -> the same frame in MessagePack, see packed_frame
+_packed_frames = LRUCache(maxsize=1024)
+
+
+def _rename_keys(value, keys):
+    if isinstance(value, dict):
+        return {keys.get(key, key): _rename_keys(item, keys) for key, item in value.items()}
+    if isinstance(value, list):
+        return [_rename_keys(item, keys) for item in value]
+    return value
+
+
+def encode_frame(payload):
+    """
+    Encode a payload into the text of a WebSocket frame.
+
+    Group events carry the encoded frame rather than the payload, so a message is
+    encoded once however many connections it is delivered to. orjson is used
+    when it is installed.
+    """
+
+    if orjson is not None:
+        return orjson.dumps(payload, default=str).decode()
+    return json.dumps(payload, default=str, separators=(',', ':'))
+
+
+def encode_packed(payload):
+    """
+    Encode a payload into a binary MessagePack frame with short keys.
+    """
+
+    return msgpack.packb(_rename_keys(payload, SHORT_KEYS), default=str, use_bin_type=True)
+
+
+def encode_frames(payload):
+    """
+    Encode a payload for a group event. Only the JSON frame is sent; binary
+    recipients get it through `packed_frame`, so nothing is packed for rooms
+    without them.
+    """
+
+    return {'frame': encode_frame(payload)}
+
+
+def packed_frame(frame):
+    """
+    MessagePack version of a JSON frame from `encode_frame`, converted once
+    per process however many binary connections it is delivered to.
+    """
+
+    packed = _packed_frames.get(frame)
+    if packed is None:
+        packed = encode_packed(json.loads(frame))
+        _packed_frames.set(frame, packed)
+    return packed
+
+
+def decode_frame(text_data=None, bytes_data=None):
+    if bytes_data is not None:
+        return _rename_keys(msgpack.unpackb(bytes_data, raw=False), LONG_KEYS)
+    return json.loads(text_data)
+
+
+def negotiate_encoding(scope, query_params):
+    """
+    Pick the wire encoding of a connection from its offered subprotocols or its
+    `encoding` query parameter. Returns (binary, subprotocol to accept).
+    """
+
+    offered = scope.get('subprotocols') or []
+    if SUBPROTOCOL_MSGPACK in offered:
+        return True, SUBPROTOCOL_MSGPACK
+    subprotocol = SUBPROTOCOL_JSON if SUBPROTOCOL_JSON in offered else None
+    return query_params.get('encoding', [None])[0] == 'msgpack', subprotocol
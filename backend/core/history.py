@@ -0,0 +1,164 @@
+import threading
+from collections import OrderedDict, deque
+
+from django.conf import settings
+
+from .encoding import encode_frame
+
+
+class RoomEntry:
+    def __init__(self, size):
+        self.messages = deque(maxlen=size)  # serialized messages, oldest first
+        self.sizes = deque(maxlen=size)  # encoded size of each message
+        self.complete = False  # True if the entry holds the room's whole history
+        self.watermarks = {}  # user id -> last read message id
+        self.bytes = 0
+
+
+class RoomHistory:
+    """
+    Per-room ring buffers of the newest serialized messages, shared by the
+    requests and consumers of this process.
+
+    An entry is filled from the first history page the database returns and
+    kept current by the message write path, so later first-page requests are
+    served from memory. Rooms are evicted least recently used first once the
+    buffers hold more than `max_bytes`. Any write the buffer cannot apply in
+    order drops the room's entry, so a stale page is never served.
+    """
+
+    def __init__(self, size, max_bytes, enabled=True):
+        self.size = size
+        self.max_bytes = max_bytes
+        self.enabled = enabled
+        self._rooms = OrderedDict()  # room id -> RoomEntry
+        self._filling = {}  # room id -> token of the fill in progress
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, room_id, limit):
+        """
+        Return (messages newest first, has_older), or None if the entry cannot
+        serve a page of `limit` messages.
+        """
+
+        if not self.enabled:
+            return None
+        with self._lock:
+            entry = self._rooms.get(room_id)
+            if entry is None or (len(entry.messages) < limit and not entry.complete):
+                return None
+            self._rooms.move_to_end(room_id)
+            messages = list(entry.messages)[-limit:]
+            has_older = len(entry.messages) > limit or not entry.complete
+            watermarks = dict(entry.watermarks)
+        results = []
+        for message in reversed(messages):
+            message = dict(message)
+            sender = message['user']['id'] if message.get('user') else None
+            message['seen_by'] = [
+                user_id for user_id, last_read in watermarks.items()
+                if last_read >= message['id'] and user_id != sender
+            ]
+            results.append(message)
+        return results, has_older
+
+    def begin_fill(self, room_id):
+        """
+        Call before reading the page to `fill` the entry with; writes to the
+        room in between make the fill a no-op.
+        """
+
+        token = object()
+        with self._lock:
+            self._filling[room_id] = token
+        return token
+
+    def fill(self, room_id, token, messages, complete, watermarks):
+        """
+        Install an entry from a page of serialized messages, newest first.
+        `complete` means the page holds the room's whole history.
+        """
+
+        with self._lock:
+            if self._filling.get(room_id) is not token:
+                return
+            del self._filling[room_id]
+            self._drop(room_id)
+            entry = RoomEntry(self.size)
+            entry.complete = complete and len(messages) <= self.size
+            entry.watermarks = dict(watermarks)
+            self._rooms[room_id] = entry
+            for message in reversed(messages[:self.size]):
+                self._push(entry, message)
+            self._evict()
+
+    def append(self, room_id, message):
+        """
+        Add a newly written message, serialized, to the room's entry.
+        """
+
+        if not self.enabled:
+            return
+        with self._lock:
+            self._filling.pop(room_id, None)
+            entry = self._rooms.get(room_id)
+            if entry is None:
+                return
+            if message['id'] is None or (entry.messages and message['id'] <= entry.messages[-1]['id']):
+                # Written out of order; let the next request refill from the database
+                self._drop(room_id)
+                return
+            if len(entry.messages) == entry.messages.maxlen:
+                entry.complete = False
+            self._push(entry, message)
+            self._evict()
+
+    def mark_read(self, room_id, user_id, message_id):
+        if not self.enabled:
+            return
+        with self._lock:
+            entry = self._rooms.get(room_id)
+            if entry is None:
+                # A fill in progress may have read the old watermark
+                self._filling.pop(room_id, None)
+            elif message_id > entry.watermarks.get(user_id, 0):
+                entry.watermarks[user_id] = message_id
+
+    def discard(self, room_id):
+        with self._lock:
+            self._filling.pop(room_id, None)
+            self._drop(room_id)
+
+    def clear(self):
+        with self._lock:
+            self._filling.clear()
+            self._rooms.clear()
+            self._bytes = 0
+
+    def _push(self, entry, message):
+        if len(entry.messages) == entry.messages.maxlen:
+            entry.bytes -= entry.sizes[0]
+            self._bytes -= entry.sizes[0]
+        size = len(encode_frame(message))
+        entry.messages.append(message)
+        entry.sizes.append(size)
+        entry.bytes += size
+        self._bytes += size
+
+    def _drop(self, room_id):
+        entry = self._rooms.pop(room_id, None)
+        if entry is not None:
+            self._bytes -= entry.bytes
+
+    def _evict(self):
+        while self._bytes > self.max_bytes and self._rooms:
+            _, entry = self._rooms.popitem(last=False)
+            self._bytes -= entry.bytes
+
+
+room_history = RoomHistory(
+    size=settings.CHAT_HISTORY_CACHE['MESSAGES'],
+    max_bytes=settings.CHAT_HISTORY_CACHE['MAX_BYTES'],
+    enabled=settings.CHAT_HISTORY_CACHE['ENABLED'],
+)
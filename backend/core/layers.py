@@ -0,0 +1,374 @@
+import asyncio
+import copy
+import logging
+import random
+import socket
+import string
+import struct
+import time
+import uuid
+
+import msgpack
+from channels.exceptions import ChannelFull
+from channels.layers import BaseChannelLayer
+
+from .cache import shared_caches
+
+logger = logging.getLogger(__name__)
+
+_header = struct.Struct('!I')
+
+
+async def read_frame(reader):
+    """
+    Read one length-prefixed msgpack frame. Returns None at end of stream.
+    """
+
+    try:
+        header = await reader.readexactly(_header.size)
+        payload = await reader.readexactly(_header.unpack(header)[0])
+    except asyncio.IncompleteReadError:
+        return None
+    return msgpack.unpackb(payload, raw=False)
+
+
+def pack_frame(*frame):
+    payload = msgpack.packb(frame, use_bin_type=True)
+    return _header.pack(len(payload)) + payload
+
+
+def channel_owner(channel):
+    """
+    Return the id of the broker client that receives on a process-specific
+    channel, e.g. "specific.<client id>!<random>".
+    """
+
+    return channel.split('!', 1)[0].rsplit('.', 1)[-1]
+
+
+class ChannelBroker:
+    """
+    Local message broker shared by the worker processes of one host.
+
+    Workers connect to it over a Unix socket through `BrokerChannelLayer`. The
+    broker keeps group membership for every worker; a group_send is delivered
+    to each worker with members in the group as a single frame listing the
+    worker's member channels, and the worker fans it out locally.
+
+    With a `presence` registry (see core.presence), the broker also tracks the
+    presence of every worker's global connections. The registry sends through
+    the broker's own `send` and `group_send`.
+
+    Process-level caches are kept coherent by relaying 'invalidate' frames,
+    which anyone may publish (see `BrokerChannelLayer.publish_invalidation`),
+    to every worker.
+
+    Every write to a worker waits for the worker's socket to drain, so a
+    worker that stops reading slows its senders down rather than growing the
+    broker's buffers.
+    """
+
+    def __init__(self, path, presence=None):
+        self.path = path
+        self.presence = presence
+        self.clients = {}  # client id -> stream writer
+        self.groups = {}  # group -> set of channels
+
+    async def start(self):
+        return await asyncio.start_unix_server(self.handle, path=self.path)
+
+    async def serve_forever(self):
+        server = await self.start()
+        async with server:
+            await server.serve_forever()
+
+    async def handle(self, reader, writer):
+        client_id = None
+        try:
+            while True:
+                frame = await read_frame(reader)
+                if frame is None:
+                    break
+                op = frame[0]
+                if op == 'hello':
+                    client_id = frame[1]
+                    self.clients[client_id] = writer
+                elif op == 'group_add':
+                    self.groups.setdefault(frame[1], set()).add(frame[2])
+                    if len(frame) > 3:
+                        # Acknowledge, so messages sent after group_add returns reach the channel
+                        await self.write(writer, 'ack', frame[3])
+                elif op == 'group_discard':
+                    members = self.groups.get(frame[1])
+                    if members is not None:
+                        members.discard(frame[2])
+                        if not members:
+                            del self.groups[frame[1]]
+                elif op == 'send':
+                    await self.deliver([frame[1]], frame[2])
+                elif op == 'group_send':
+                    await self.deliver(self.groups.get(frame[1], ()), frame[2])
+                elif op == 'flush':
+                    self.groups.clear()
+                elif op == 'presence' and self.presence is not None:
+                    await self.handle_presence(*frame[1:])
+                elif op == 'invalidate':
+                    for client in list(self.clients.values()):
+                        await self.write(client, *frame)
+        except Exception as e:
+            logger.error(f"Error in channel broker connection {client_id}: {e}")
+        finally:
+            if client_id is not None and self.clients.get(client_id) is writer:
+                del self.clients[client_id]
+                self.forget(client_id)
+            writer.close()
+
+    async def handle_presence(self, action, channel, *args):
+        if action == 'join':
+            await self.presence.join(channel, *args)
+        elif action == 'leave':
+            await self.presence.leave(channel)
+        elif action == 'beat':
+            await self.presence.beat(channel)
+
+    async def send(self, channel, message):
+        await self.deliver([channel], message)
+
+    async def group_send(self, group, message):
+        await self.deliver(self.groups.get(group, ()), message)
+
+    async def deliver(self, channels, message):
+        by_client = {}
+        for channel in channels:
+            by_client.setdefault(channel_owner(channel), []).append(channel)
+        for client_id, client_channels in by_client.items():
+            writer = self.clients.get(client_id)
+            if writer is not None:
+                await self.write(writer, 'deliver', client_channels, message)
+
+    async def write(self, writer, *frame):
+        writer.write(pack_frame(*frame))
+        try:
+            await writer.drain()
+        except ConnectionError:
+            # The worker is gone; its own connection handler forgets it
+            pass
+
+    def forget(self, client_id):
+        for group, members in list(self.groups.items()):
+            members.difference_update([channel for channel in members if channel_owner(channel) == client_id])
+            if not members:
+                del self.groups[group]
+        if self.presence is not None:
+            # Users whose last connection was on that worker go offline
+            for channel in self.presence.channel_names():
+                if channel_owner(channel) == client_id:
+                    self.presence.disconnect(channel)
+
+
+class BrokerChannelLayer(BaseChannelLayer):
+    """
+    Channel layer that lets several worker processes on one host share groups
+    through a `ChannelBroker` listening on `path`.
+
+    Only process-specific channels (the kind consumers get from `new_channel`)
+    are supported. Messages for channels of this process never leave it; group
+    messages go through the broker, which batches them per worker.
+
+    A channel has a queue from `new_channel` until its receiver is cancelled,
+    which is how a consumer stops receiving once it disconnects. Messages for
+    channels without one are dropped, like expired messages.
+
+    group_add waits up to `group_add_timeout` seconds for the broker to
+    acknowledge the membership and raises asyncio.TimeoutError after that.
+    """
+
+    extensions = ['groups', 'flush']
+
+    def __init__(self, path, expiry=60, capacity=100, channel_capacity=None, group_add_timeout=5, **kwargs):
+        super().__init__(expiry=expiry, capacity=capacity, channel_capacity=channel_capacity, **kwargs)
+        self.path = path
+        self.group_add_timeout = group_add_timeout
+        self.channels = {}  # local channel -> asyncio.Queue of (expires, message)
+        self.groups = {}  # group -> local member channels, replayed after a reconnect
+        self.present = {}  # local channel -> (user id, username) registered with the broker's presence
+        self._client_ids = {}  # event loop -> broker client id
+        self._connections = {}  # event loop -> (reader, writer, reader task)
+        self._locks = {}  # event loop -> asyncio.Lock guarding (re)connection
+        self._acks = {}  # sequence number -> future resolved by the broker's ack
+        self._sequence = 0
+
+    async def _connection(self):
+        loop = asyncio.get_running_loop()
+        connection = self._connections.get(loop)
+        if connection is not None and not connection[2].done():
+            return connection
+        async with self._locks.setdefault(loop, asyncio.Lock()):
+            connection = self._connections.get(loop)
+            if connection is not None and not connection[2].done():
+                return connection
+            client_id = self._client_ids.setdefault(loop, uuid.uuid4().hex)
+            reader, writer = await asyncio.open_unix_connection(self.path)
+            writer.write(pack_frame('hello', client_id))
+            for group, channels in self.groups.items():
+                for channel in channels:
+                    if channel_owner(channel) == client_id:
+                        writer.write(pack_frame('group_add', group, channel))
+            for channel, (user_id, username) in self.present.items():
+                if channel_owner(channel) == client_id:
+                    writer.write(pack_frame('presence', 'join', channel, user_id, username))
+            await writer.drain()
+            task = loop.create_task(self._read(reader))
+            connection = self._connections[loop] = (reader, writer, task)
+            return connection
+
+    async def _write(self, *frame):
+        _, writer, _ = await self._connection()
+        writer.write(pack_frame(*frame))
+        await writer.drain()
+
+    async def _read(self, reader):
+        while True:
+            frame = await read_frame(reader)
+            if frame is None:
+                logger.error("Lost connection to the channel broker.")
+                return
+            if frame[0] == 'ack':
+                future = self._acks.pop(frame[1], None)
+                if future is not None and not future.done():
+                    future.set_result(None)
+                continue
+            if frame[0] == 'invalidate':
+                cache = shared_caches.get(frame[1])
+                if cache is not None:
+                    cache.delete(frame[2])
+                continue
+            _, channels, message = frame
+            for channel in channels:
+                try:
+                    self._put(channel, message)
+                except ChannelFull:
+                    logger.error(f"Dropped message for full channel {channel}.")
+
+    def _put(self, channel, message):
+        queue = self.channels.get(channel)
+        if queue is None:
+            # Nothing receives on the channel (any more)
+            return
+        if queue.qsize() >= self.get_capacity(channel):
+            raise ChannelFull(channel)
+        queue.put_nowait((time.time() + self.expiry, message))
+
+    def _is_local(self, channel):
+        return channel_owner(channel) == self._client_ids.get(asyncio.get_running_loop())
+
+    # Channel layer API
+
+    async def send(self, channel, message):
+        assert isinstance(message, dict), "message is not a dict"
+        assert self.valid_channel_name(channel), "Channel name not valid"
+        assert "__asgi_channel__" not in message
+        if '!' not in channel:
+            raise ValueError(f"{self.__class__.__name__} only supports process-specific channels, got {channel}.")
+        if self._is_local(channel):
+            self._put(channel, copy.deepcopy(message))
+        else:
+            await self._write('send', channel, message)
+
+    async def receive(self, channel):
+        assert self.valid_channel_name(channel)
+        queue = self.channels.setdefault(channel, asyncio.Queue())
+        try:
+            while True:
+                expires, message = await queue.get()
+                if expires >= time.time():
+                    return message
+        except asyncio.CancelledError:
+            # The consumer stopped receiving, see channels.utils.await_many_dispatch
+            if self.channels.get(channel) is queue:
+                del self.channels[channel]
+            raise
+
+    async def new_channel(self, prefix="specific."):
+        await self._connection()
+        client_id = self._client_ids[asyncio.get_running_loop()]
+        suffix = "".join(random.choice(string.ascii_letters) for _ in range(12))
+        channel = f"{prefix}{client_id}!{suffix}"
+        # Messages are kept from now on, even before the consumer's first receive
+        self.channels[channel] = asyncio.Queue()
+        return channel
+
+    async def flush(self):
+        self.channels = {}
+        self.groups = {}
+        await self._write('flush')
+
+    async def presence(self, action, channel, *args):
+        """
+        Forward a join, leave or beat of a global connection to the broker's
+        presence registry (see core.presence.BrokerPresence).
+        """
+
+        if action == 'join':
+            self.present[channel] = tuple(args)
+        elif action == 'leave':
+            self.present.pop(channel, None)
+        await self._write('presence', action, channel, *args)
+
+    def publish_invalidation(self, cache_name, key):
+        """
+        Have every worker delete `key` from its shared cache `cache_name` (see
+        core.cache.invalidate). Synchronous, for signal handlers and views, so
+        it uses a short-lived connection of its own.
+        """
+
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(1)
+            sock.connect(self.path)
+            sock.sendall(pack_frame('invalidate', cache_name, key))
+
+    async def close(self):
+        connection = self._connections.pop(asyncio.get_running_loop(), None)
+        if connection is not None:
+            _, writer, task = connection
+            task.cancel()
+            writer.close()
+
+    # Groups extension
+
+    async def group_add(self, group, channel):
+        assert self.valid_group_name(group), "Group name not valid"
+        assert self.valid_channel_name(channel), "Channel name not valid"
+        self.groups.setdefault(group, set()).add(channel)
+        self._sequence += 1
+        sequence = self._sequence
+        ack = self._acks[sequence] = asyncio.get_running_loop().create_future()
+        try:
+            await self._write('group_add', group, channel, sequence)
+            await asyncio.wait_for(ack, timeout=self.group_add_timeout)
+        except asyncio.TimeoutError:
+            # Not replayed on reconnect; the caller fails the connection instead
+            members = self.groups.get(group)
+            if members is not None:
+                members.discard(channel)
+                if not members:
+                    del self.groups[group]
+            logger.error(f"Channel broker did not acknowledge group_add of {channel} to {group}.")
+            raise
+        finally:
+            self._acks.pop(sequence, None)
+
+    async def group_discard(self, group, channel):
+        assert self.valid_channel_name(channel), "Invalid channel name"
+        assert self.valid_group_name(group), "Invalid group name"
+        members = self.groups.get(group)
+        if members is not None:
+            members.discard(channel)
+            if not members:
+                del self.groups[group]
+        await self._write('group_discard', group, channel)
+
+    async def group_send(self, group, message):
+        assert isinstance(message, dict), "Message is not a dict"
+        assert self.valid_group_name(group), "Invalid group name"
+        await self._write('group_send', group, message)
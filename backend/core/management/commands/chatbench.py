@@ -0,0 +1,343 @@
+import asyncio
+import json
+import statistics
+import threading
+import time
+import tracemalloc
+import uuid
+
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from django.db.backends.signals import connection_created
+
+from rest_framework_simplejwt.tokens import AccessToken
+
+from core.encoding import SUBPROTOCOL_JSON, SUBPROTOCOL_MSGPACK, decode_frame, encode_frame, encode_packed
+from core.middleware import TOKEN_SUBPROTOCOL_PREFIX, JWTAuthMiddleware
+from core.models import ChatRoom, Conversation, User
+from core.persistence import get_message_buffer
+from core.routing import websocket_urlpatterns
+
+try:
+    import websockets
+except ImportError:
+    websockets = None
+
+USER_PREFIX = 'chatbench'
+
+# Metrics compared against a baseline, and whether a higher value is better
+METRICS = {
+    'messages_per_second': True,
+    'fanout_p50_ms': False,
+    'fanout_p99_ms': False,
+    'inbox_p50_ms': False,
+    'inbox_p99_ms': False,
+    'queries_per_message': False,
+    'memory_per_connection_kb': False,
+}
+
+
+class QueryCounter:
+    """
+    Counts the queries run on every database connection, including the ones
+    opened by sync_to_async threads while the benchmark runs.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        with self.lock:
+            self.count += 1
+        return execute(sql, params, many, context)
+
+    def install(self, sender=None, connection=None, **kwargs):
+        if self not in connection.execute_wrappers:
+            connection.execute_wrappers.append(self)
+
+    def __enter__(self):
+        for conn in connections.all(initialized_only=True):
+            self.install(connection=conn)
+        connection_created.connect(self.install)
+        return self
+
+    def __exit__(self, *exc_info):
+        connection_created.disconnect(self.install)
+        for conn in connections.all(initialized_only=True):
+            if self in conn.execute_wrappers:
+                conn.execute_wrappers.remove(self)
+
+
+class CommunicatorClient:
+    """
+    Client talking to the consumers in this process through channels' test communicator.
+    """
+
+    application = JWTAuthMiddleware(URLRouter(websocket_urlpatterns))
+
+    def __init__(self, path, token, binary):
+        subprotocols = [SUBPROTOCOL_MSGPACK if binary else SUBPROTOCOL_JSON, TOKEN_SUBPROTOCOL_PREFIX + token]
+        self.binary = binary
+        self.communicator = WebsocketCommunicator(self.application, path, subprotocols=subprotocols)
+
+    async def connect(self):
+        connected, _ = await self.communicator.connect()
+        if not connected:
+            raise CommandError(f'Connection to {self.communicator.scope["path"]} was refused.')
+
+    async def send(self, payload):
+        if self.binary:
+            await self.communicator.send_to(bytes_data=encode_packed(payload))
+        else:
+            await self.communicator.send_to(text_data=encode_frame(payload))
+
+    async def receive(self, timeout):
+        message = await self.communicator.receive_output(timeout)
+        if message['type'] == 'websocket.close':
+            raise CommandError('Connection closed by the server.')
+        return decode_frame(message.get('text'), message.get('bytes'))
+
+    async def close(self):
+        await self.communicator.disconnect()
+
+
+class SocketClient:
+    """
+    Client talking to a running server over a real WebSocket.
+    """
+
+    def __init__(self, url, token, binary, origin):
+        self.url = url
+        self.token = token
+        self.binary = binary
+        self.origin = origin
+
+    async def connect(self):
+        subprotocols = [SUBPROTOCOL_MSGPACK if self.binary else SUBPROTOCOL_JSON, TOKEN_SUBPROTOCOL_PREFIX + self.token]
+        self.socket = await websockets.connect(self.url, subprotocols=subprotocols, origin=self.origin, max_queue=None)
+
+    async def send(self, payload):
+        await self.socket.send(encode_packed(payload) if self.binary else encode_frame(payload))
+
+    async def receive(self, timeout):
+        data = await asyncio.wait_for(self.socket.recv(), timeout)
+        if isinstance(data, bytes):
+            return decode_frame(bytes_data=data)
+        return decode_frame(data)
+
+    async def close(self):
+        await self.socket.close()
+
+
+def percentile(values, percent):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * percent / 100))]
+
+
+class Command(BaseCommand):
+    help = (
+        'Benchmark the chat consumers with simulated clients spread over several rooms, '
+        'each also connected to the global socket. Reports messages/sec, fan-out latency '
+        'to the rooms and to the global inboxes, DB queries per message and memory per '
+        'connection, and can save or compare against a JSON baseline.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--clients', type=int, default=50, help='Number of simulated clients.')
+        parser.add_argument('--rooms', type=int, default=5, help='Number of rooms the clients are spread over.')
+        parser.add_argument('--messages', type=int, default=20, help='Messages sent by every client.')
+        parser.add_argument('--encoding', choices=['json', 'msgpack'], default='json')
+        parser.add_argument(
+            '--no-global', action='store_true',
+            help='Only connect the clients to their rooms, not to the global socket as well.',
+        )
+        parser.add_argument('--timeout', type=float, default=10, help='Seconds to wait for a single frame.')
+        parser.add_argument(
+            '--url',
+            help='Base URL of a running server, e.g. ws://127.0.0.1:8000. Defaults to running the '
+                 'consumers in this process. Needs the websockets package.',
+        )
+        parser.add_argument(
+            '--origin',
+            help='Origin header sent to a running server, which only accepts CORS_ALLOWED_ORIGINS. '
+                 'Defaults to the first of them.',
+        )
+        parser.add_argument('--save-baseline', metavar='PATH', help='Write the results to PATH.')
+        parser.add_argument('--compare', metavar='PATH', help='Compare the results with a saved baseline.')
+        parser.add_argument(
+            '--tolerance', type=float, default=0.1,
+            help='Relative change against the baseline reported as a regression (default 0.1).',
+        )
+
+    def handle(self, *args, **options):
+        if options['clients'] < 1 or options['rooms'] < 1:
+            raise CommandError('--clients and --rooms must be at least 1.')
+        if options['url'] and websockets is None:
+            raise CommandError('Benchmarking a running server needs the websockets package.')
+
+        self.user_ids, self.room_ids = [], []
+        try:
+            users, rooms = self.set_up(options['clients'], options['rooms'])
+            results = asyncio.run(self.run(users, rooms, options))
+        finally:
+            self.tear_down()
+
+        for name, value in results.items():
+            self.stdout.write(f'{name:>28}: {value}')
+        if options['save_baseline']:
+            with open(options['save_baseline'], 'w') as f:
+                json.dump(results, f, indent=2)
+            self.stdout.write(f'Baseline saved to {options["save_baseline"]}')
+        if options['compare']:
+            self.compare(results, options['compare'], options['tolerance'])
+
+    def set_up(self, client_count, room_count):
+        # Names unique to this run, so existing users and rooms are never touched
+        run = uuid.uuid4().hex[:8]
+        User.objects.bulk_create(
+            User(username=f'{USER_PREFIX}{run}_{index}', email=f'{USER_PREFIX}{run}_{index}@example.com')
+            for index in range(client_count)
+        )
+        users = list(User.objects.filter(username__startswith=f'{USER_PREFIX}{run}_').order_by('id'))
+        self.user_ids = [user.id for user in users]
+        self.tokens = {}
+        for user in users:
+            # Access tokens only, so no outstanding refresh tokens are left behind
+            token = AccessToken.for_user(user)
+            token['username'] = user.username
+            self.tokens[user.id] = str(token)
+        rooms = []
+        for index in range(room_count):
+            # No digits between underscores, so the name is not read as a direct room
+            room = ChatRoom.objects.create(name=f'{USER_PREFIX}_r{index}_{run}')
+            self.room_ids.append(room.id)
+            conversation = Conversation.objects.create(chat_room=room, is_group=True)
+            conversation.participants.set(users[index::room_count])
+            rooms.append((room.name, users[index::room_count]))
+        return users, rooms
+
+    def tear_down(self):
+        # Only what set_up created in this run
+        ChatRoom.objects.filter(id__in=self.room_ids).delete()
+        User.objects.filter(id__in=self.user_ids).delete()
+
+    def client(self, path, user, options):
+        binary = options['encoding'] == 'msgpack'
+        token = self.tokens[user.id]
+        if options['url']:
+            origin = options['origin'] or settings.CORS_ALLOWED_ORIGINS[0]
+            return SocketClient(options['url'].rstrip('/') + path, token, binary, origin)
+        return CommunicatorClient(path, token, binary)
+
+    async def run(self, users, rooms, options):
+        in_process = not options['url']
+        timeout = options['timeout']
+
+        tracemalloc.start()
+        before = tracemalloc.take_snapshot()
+        members = []  # (client, room name, user)
+        inboxes = []  # (global client, room name), notified of every message in the user's room
+        for room_name, room_users in rooms:
+            for user in room_users:
+                client = self.client(f'/ws/chat/{room_name}/', user, options)
+                await client.connect()
+                members.append((client, room_name, user))
+                if not options['no_global']:
+                    client = self.client('/ws/chat/global/', user, options)
+                    await client.connect()
+                    inboxes.append((client, room_name))
+        after = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+        memory = sum(stat.size_diff for stat in after.compare_to(before, 'filename'))
+        connection_count = len(members) + len(inboxes)
+
+        sent_at = {}
+        latencies = []
+        inbox_latencies = []
+        expected = {
+            room_name: options['messages'] * len(room_users) for room_name, room_users in rooms
+        }
+
+        async def listen(client, room_name):
+            received = 0
+            while received < expected[room_name]:
+                frame = await client.receive(timeout)
+                if frame.get('type') == 'read' or 'text' not in frame:
+                    continue
+                latencies.append(time.perf_counter() - sent_at[frame['text']])
+                received += 1
+
+        async def listen_inbox(client, room_name):
+            received = 0
+            while received < expected[room_name]:
+                frame = await client.receive(timeout)
+                # Presence snapshots and diffs go to the same socket
+                if frame.get('type') != 'global_message':
+                    continue
+                inbox_latencies.append(time.perf_counter() - sent_at[frame['message']['text']])
+                received += 1
+
+        async def talk(client, user):
+            for index in range(options['messages']):
+                text = f'{user.id}:{index}'
+                sent_at[text] = time.perf_counter()
+                await client.send({'text': text, 'messageType': 'text'})
+
+        with QueryCounter() as queries:
+            started = time.perf_counter()
+            listeners = [asyncio.ensure_future(listen(client, room)) for client, room, _ in members]
+            listeners += [asyncio.ensure_future(listen_inbox(client, room)) for client, room in inboxes]
+            await asyncio.gather(*(talk(client, user) for client, _, user in members))
+            await asyncio.gather(*listeners)
+            elapsed = time.perf_counter() - started
+            if in_process and settings.CHAT_WRITE_BEHIND['ENABLED']:
+                # Count the queued INSERTs too
+                await get_message_buffer().flush()
+            query_count = queries.count
+
+        for client in [client for client, _, _ in members] + [client for client, _ in inboxes]:
+            await client.close()
+
+        sent = options['messages'] * len(members)
+        return {
+            'clients': len(members),
+            'global_connections': len(inboxes),
+            'rooms': len(rooms),
+            'messages_sent': sent,
+            'frames_delivered': len(latencies),
+            'messages_per_second': round(sent / elapsed, 1),
+            'fanout_p50_ms': round(statistics.median(latencies) * 1000, 2) if latencies else None,
+            'fanout_p99_ms': round(percentile(latencies, 99) * 1000, 2) if latencies else None,
+            'inbox_frames_delivered': len(inbox_latencies),
+            'inbox_p50_ms': round(statistics.median(inbox_latencies) * 1000, 2) if inbox_latencies else None,
+            'inbox_p99_ms': round(percentile(inbox_latencies, 99) * 1000, 2) if inbox_latencies else None,
+            # Queries and memory can only be observed in this process
+            'queries_per_message': round(query_count / sent, 2) if in_process else None,
+            'memory_per_connection_kb': round(memory / connection_count / 1024, 1) if in_process else None,
+        }
+
+    def compare(self, results, path, tolerance):
+        try:
+            with open(path) as f:
+                baseline = json.load(f)
+        except (OSError, ValueError) as e:
+            raise CommandError(f'Could not read baseline {path}: {e}')
+
+        regressions = []
+        for name, higher_is_better in METRICS.items():
+            old, new = baseline.get(name), results.get(name)
+            if not old or new is None:
+                continue
+            change = (new - old) / old
+            regressed = change < -tolerance if higher_is_better else change > tolerance
+            self.stdout.write(f'{name:>28}: {old} -> {new} ({change:+.1%}){"  REGRESSION" if regressed else ""}')
+            if regressed:
+                regressions.append(name)
+        if regressions:
+            raise CommandError(f'Regressed against {path}: {", ".join(regressions)}')
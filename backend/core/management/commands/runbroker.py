@@ -0,0 +1,38 @@
+import asyncio
+import os
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from core.layers import ChannelBroker
+from core.presence import presence_registry
+
+
+class Command(BaseCommand):
+    help = (
+        'Run the local channel broker that lets several Daphne workers on this host '
+        'share channel layer groups through core.layers.BrokerChannelLayer.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--path',
+            default=settings.CHANNEL_LAYERS['default'].get('CONFIG', {}).get('path'),
+            help='Unix socket to listen on. Defaults to the path of the default channel layer.',
+        )
+
+    def handle(self, *args, **options):
+        path = options['path']
+        if not path:
+            self.stderr.write('No socket path given and the default channel layer has none configured.')
+            return
+        if os.path.exists(path):
+            os.unlink(path)
+        self.stdout.write(f'Channel broker listening on {path}')
+        try:
+            broker = ChannelBroker(path)
+            # The presence of every worker's global connections is kept here
+            broker.presence = presence_registry(layer=broker)
+            asyncio.run(broker.serve_forever())
+        except KeyboardInterrupt:
+            pass
@@ -0,0 +1,274 @@
+import hashlib
+import io
+import logging
+import os
+import shutil
+import subprocess
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.files import File
+from django.core.files.base import ContentFile
+from django.db import IntegrityError, close_old_connections, transaction
+from django.db.models import Q
+from PIL import Image, ImageOps
+
+from .history import room_history
+from .models import MediaAsset, MediaUpload, Message
+
+logger = logging.getLogger(__name__)
+
+# Completed uploads are stored, and thumbnails and preview frames made, here, off the request path
+executor = ThreadPoolExecutor(max_workers=settings.CHAT_MEDIA['WORKERS'], thread_name_prefix='chat-media')
+
+_copy_size = 64 * 1024
+
+
+# Accepted content types -> (MediaAsset kind, file extension, Pillow format of images)
+CONTENT_TYPES = {
+    'image/jpeg': (MediaAsset.IMAGE, '.jpg', 'JPEG'),
+    'image/png': (MediaAsset.IMAGE, '.png', 'PNG'),
+    'image/gif': (MediaAsset.IMAGE, '.gif', 'GIF'),
+    'image/webp': (MediaAsset.IMAGE, '.webp', 'WEBP'),
+    'video/mp4': (MediaAsset.VIDEO, '.mp4', None),
+    'video/webm': (MediaAsset.VIDEO, '.webm', None),
+    'video/quicktime': (MediaAsset.VIDEO, '.mov', None),
+}
+
+
+class InvalidMedia(Exception):
+    """
+    Raised for uploaded content that does not match its declared type.
+    """
+
+
+def media_kind(content_type):
+    """
+    The MediaAsset kind of a content type, or None if it is not accepted.
+    """
+
+    accepted = CONTENT_TYPES.get(content_type)
+    return accepted[0] if accepted else None
+
+
+def check_image(path, image_format):
+    """
+    Make sure the file at `path` is an image in `image_format`, so that
+    nothing but images is ever stored and served as one.
+    """
+
+    try:
+        with Image.open(path) as image:
+            actual = image.format
+            image.verify()
+    except Exception:
+        raise InvalidMedia("The file is not a valid image.")
+    if actual != image_format:
+        raise InvalidMedia(f"The file is a {actual} image, not {image_format}.")
+
+
+def visible_assets(user_id):
+    """
+    The media assets a user may see and send: ones they uploaded or completed
+    an upload of, and ones sent in rooms they take part in.
+    """
+
+    return MediaAsset.objects.filter(
+        Q(uploaded_by_id=user_id)
+        | Q(uploads__user_id=user_id)
+        | Q(messages__chat_room__rooms__participants__id=user_id)
+    ).distinct()
+
+
+def part_path(upload):
+    return os.path.join(settings.CHAT_MEDIA['UPLOAD_DIR'], f'{upload.pk}.part')
+
+
+def append_chunk(upload, stream, length):
+    """
+    Append `length` bytes read from `stream` to the upload's part file.
+    Returns the number of bytes written, which is less than `length` if the
+    stream ended early.
+    """
+
+    os.makedirs(settings.CHAT_MEDIA['UPLOAD_DIR'], exist_ok=True)
+    written = 0
+    with open(part_path(upload), 'ab') as part:
+        # Drop the tail of an earlier chunk that failed half-way
+        part.truncate(upload.received)
+        while written < length:
+            data = stream.read(min(_copy_size, length - written))
+            if not data:
+                break
+            part.write(data)
+            written += len(data)
+    return written
+
+
+def discard_upload(upload):
+    try:
+        os.remove(part_path(upload))
+    except FileNotFoundError:
+        pass
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for data in iter(lambda: f.read(_copy_size), b''):
+            digest.update(data)
+    return digest.hexdigest()
+
+
+def schedule_completion(upload_id):
+    # Submitted once committed, so the worker is sure to see the finished upload
+    transaction.on_commit(lambda: executor.submit(finish_upload, upload_id))
+
+
+def finish_upload(upload_id):
+    """
+    Complete an upload in the background, see complete_upload. Clients poll
+    the upload until its asset is set.
+    """
+
+    close_old_connections()
+    try:
+        upload = MediaUpload.objects.get(pk=upload_id)
+        if upload.asset_id is None and not upload.error:
+            try:
+                complete_upload(upload)
+            except InvalidMedia as e:
+                upload.error = str(e)
+                upload.save(update_fields=['error'])
+                discard_upload(upload)
+    except Exception as e:
+        logger.error(f"Error completing media upload {upload_id}: {e}")
+    finally:
+        close_old_connections()
+
+
+def complete_upload(upload):
+    """
+    Turn a fully received upload into a MediaAsset. Content that was uploaded
+    before is not stored again; the existing asset is used instead. Running it
+    again for a completed upload is harmless. Returns (asset, created).
+
+    Raises InvalidMedia if an image upload is not an image of its content type.
+    The stored file's extension always comes from the content type.
+    """
+
+    path = part_path(upload)
+    try:
+        sha256 = file_sha256(path)
+    except FileNotFoundError:
+        # Completed by an earlier run for the same upload
+        upload.refresh_from_db(fields=['asset'])
+        if upload.asset is None:
+            raise
+        return upload.asset, False
+    asset = MediaAsset.objects.filter(sha256=sha256).first()
+    created = False
+    if asset is None:
+        kind, extension, image_format = CONTENT_TYPES[upload.content_type]
+        if image_format is not None:
+            check_image(path, image_format)
+        # The field's storage, which is what asset.file reads from
+        storage = MediaAsset._meta.get_field('file').storage
+        with open(path, 'rb') as f:
+            name = storage.save(f'media/{sha256[:2]}/{sha256}{extension}', File(f))
+        try:
+            with transaction.atomic():
+                asset = MediaAsset.objects.create(
+                    sha256=sha256,
+                    kind=kind,
+                    content_type=upload.content_type,
+                    size=upload.size,
+                    file=name,
+                    uploaded_by_id=upload.user_id,
+                )
+            created = True
+        except IntegrityError:
+            # The same content was completed concurrently
+            storage.delete(name)
+            asset = MediaAsset.objects.get(sha256=sha256)
+    # Linked before the part file goes, for concurrent runs that no longer find it
+    upload.asset = asset
+    upload.save(update_fields=['asset'])
+    discard_upload(upload)
+    if created:
+        schedule_processing(asset.pk)
+    return asset, created
+
+
+def schedule_processing(asset_id):
+    # Submitted once committed, so the worker is sure to see the asset
+    transaction.on_commit(lambda: executor.submit(process_asset, asset_id))
+
+
+def process_asset(asset_id):
+    """
+    Make the thumbnail of an image, or the preview frame of a video, and
+    mark the asset ready (or failed).
+    """
+
+    close_old_connections()
+    try:
+        asset = MediaAsset.objects.get(pk=asset_id)
+        try:
+            if asset.kind == MediaAsset.IMAGE:
+                make_image_thumbnail(asset)
+            else:
+                make_video_preview(asset)
+            asset.status = MediaAsset.READY
+        except Exception as e:
+            logger.error(f"Error processing media asset {asset_id}: {e}")
+            asset.status = MediaAsset.FAILED
+        asset.save(update_fields=['thumbnail', 'width', 'height', 'status'])
+        # Cached history pages show the asset as it was when they were filled
+        rooms = Message.objects.filter(media=asset).values_list('chat_room_id', flat=True).distinct()
+        for room_id in rooms:
+            room_history.discard(room_id)
+    except Exception as e:
+        logger.error(f"Error in process_asset for media asset {asset_id}: {e}")
+    finally:
+        close_old_connections()
+
+
+def save_thumbnail(asset, image):
+    size = settings.CHAT_MEDIA['THUMBNAIL_SIZE']
+    image.thumbnail((size, size))
+    buffer = io.BytesIO()
+    image.convert('RGB').save(buffer, format='JPEG', quality=80)
+    asset.thumbnail.save(f'{asset.sha256}.jpg', ContentFile(buffer.getvalue()), save=False)
+
+
+def make_image_thumbnail(asset):
+    with asset.file.open('rb') as f:
+        image = ImageOps.exif_transpose(Image.open(f))
+        asset.width, asset.height = image.size
+        save_thumbnail(asset, image)
+
+
+def make_video_preview(asset):
+    ffmpeg = shutil.which('ffmpeg')
+    if ffmpeg is None:
+        # Videos are still playable; they just have no preview frame
+        logger.warning("ffmpeg is not installed; skipping the video preview frame.")
+        return
+    with tempfile.TemporaryDirectory() as directory:
+        try:
+            source = asset.file.path
+        except NotImplementedError:
+            # Remote storage; ffmpeg needs a local copy
+            source = os.path.join(directory, 'source')
+            with asset.file.open('rb') as f, open(source, 'wb') as copy:
+                shutil.copyfileobj(f, copy, _copy_size)
+        frame = os.path.join(directory, 'frame.png')
+        subprocess.run(
+            [ffmpeg, '-v', 'error', '-i', source, '-vf', 'thumbnail', '-frames:v', '1', frame],
+            check=True, capture_output=True, timeout=60,
+        )
+        with Image.open(frame) as image:
+            asset.width, asset.height = image.size
+            save_thumbnail(asset, image)
@@ -0,0 +1,215 @@
+import bisect
+import functools
+import threading
+import time
+from contextlib import contextmanager
+
+from channels.layers import get_channel_layer
+from django.conf import settings
+
+from .db import db_sync_to_async, db_threads
+from .outbound import outbound_stats
+
+# Latency buckets in seconds, from a fast in-memory handler to a slow query
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+
+_metrics = []
+
+
+def _labels(labels, **extra):
+    labels = {**labels, **extra}
+    if not labels:
+        return ''
+    pairs = []
+    for key, value in labels.items():
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"')
+        pairs.append(f'{key}="{value}"')
+    return '{' + ','.join(pairs) + '}'
+
+
+class Histogram:
+    """
+    Prometheus-style histogram. `observe` is a bisect and three additions
+    under a lock, cheap enough to stay on in production.
+    """
+
+    kind = 'histogram'
+
+    def __init__(self, name, help, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        self.series = {}  # sorted label items -> [bucket counts, sum, count]
+        self.lock = threading.Lock()
+        _metrics.append(self)
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.series.get(key)
+            if series is None:
+                series = self.series[key] = [[0] * len(self.buckets), 0.0, 0]
+            if index < len(self.buckets):
+                series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def samples(self):
+        with self.lock:
+            series = [(dict(key), list(counts), total, count) for key, (counts, total, count) in self.series.items()]
+        for labels, counts, total, count in series:
+            cumulative = 0
+            for bound, bucket in zip(self.buckets, counts):
+                cumulative += bucket
+                yield f'{self.name}_bucket{_labels(labels, le=bound)} {cumulative}'
+            yield f'{self.name}_bucket{_labels(labels, le="+Inf")} {count}'
+            yield f'{self.name}_sum{_labels(labels)} {total}'
+            yield f'{self.name}_count{_labels(labels)} {count}'
+
+
+class Gauge:
+    """
+    Gauge set by the code it measures, or read from `collect` at scrape time.
+    `collect` returns a number, or a list of (labels, value) pairs.
+    """
+
+    kind = 'gauge'
+
+    def __init__(self, name, help, collect=None):
+        self.name = name
+        self.help = help
+        self.collect = collect
+        self.values = {}  # sorted label items -> value
+        self.lock = threading.Lock()
+        _metrics.append(self)
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            value = self.values.get(key, 0) + amount
+            if value or not labels:
+                self.values[key] = value
+            else:
+                # Labelled series that drop to zero are removed, so closed rooms do not pile up
+                self.values.pop(key, None)
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def samples(self):
+        if self.collect is not None:
+            values = self.collect()
+            if not isinstance(values, list):
+                values = [({}, values)]
+        else:
+            with self.lock:
+                values = [(dict(key), value) for key, value in self.values.items()]
+        for labels, value in values:
+            yield f'{self.name}{_labels(labels)} {value}'
+
+
+class Counter(Gauge):
+    """
+    Monotonic counter, normally read from `collect`.
+    """
+
+    kind = 'counter'
+
+
+def render():
+    """
+    All metrics in the Prometheus text exposition format.
+    """
+
+    lines = []
+    for metric in _metrics:
+        lines.append(f'# HELP {metric.name} {metric.help}')
+        lines.append(f'# TYPE {metric.name} {metric.kind}')
+        lines.extend(metric.samples())
+    return '\n'.join(lines) + '\n'
+
+
+handler_seconds = Histogram('chat_handler_seconds', 'Time spent in WebSocket consumer handlers.')
+receive_phase_seconds = Histogram('chat_receive_phase_seconds', 'Time spent in each phase of ChatConsumer.receive.')
+db_seconds = Histogram('chat_db_seconds', 'Time spent running database helpers.')
+db_wait_seconds = Histogram('chat_db_wait_seconds', 'Time database helpers waited for a worker thread.')
+db_in_flight = Gauge('chat_db_in_flight', 'Database helpers currently running in worker threads.')
+db_in_flight.inc(0)
+room_connections = Gauge('chat_room_connections', 'Open ChatConsumer connections per room.')
+
+
+def timed_handler(handler):
+    """
+    Record the duration of an async consumer handler in chat_handler_seconds.
+    """
+
+    @functools.wraps(handler)
+    async def wrapper(self, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await handler(self, *args, **kwargs)
+        finally:
+            handler_seconds.observe(
+                time.perf_counter() - started, consumer=type(self).__name__, handler=handler.__name__
+            )
+
+    return wrapper
+
+
+def timed_sync_to_async(name):
+    """
+    Like `db_sync_to_async`, recording how long the call waited for a thread
+    and how long it ran, and counting it in chat_db_in_flight while it runs.
+    """
+
+    def decorator(func):
+        def run(queued_at, *args, **kwargs):
+            started = time.perf_counter()
+            db_wait_seconds.observe(started - queued_at, helper=name)
+            db_in_flight.inc()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                db_in_flight.dec()
+                db_seconds.observe(time.perf_counter() - started, helper=name)
+
+        run_in_thread = db_sync_to_async(run)
+
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            return await run_in_thread(time.perf_counter(), *args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def _layer_queue_depth():
+    layer = get_channel_layer()
+    queues = list(getattr(layer, 'channels', {}).values())
+    return sum(queue.qsize() for queue in queues)
+
+
+def _outbound(*keys):
+    def collect():
+        stats = outbound_stats()
+        return [({'event': key}, stats[key]) for key in keys] if len(keys) > 1 else stats[keys[0]]
+
+    return collect
+
+
+Gauge('chat_db_threads', 'Size of the database thread pool.', db_threads)
+Gauge('chat_layer_queue_depth', 'Messages waiting in the channel layer queues of this process.', _layer_queue_depth)
+Gauge('chat_outbound_connections', 'WebSocket connections with an outbound queue.', _outbound('connections'))
+Gauge('chat_outbound_queued_frames', 'Frames waiting in outbound queues.', _outbound('queued_frames'))
+Gauge('chat_outbound_max_queue_depth', 'Longest outbound queue.', _outbound('max_queue_depth'))
+Counter('chat_outbound_slow_consumer_total', 'Slow-consumer policy actions.', _outbound('dropped', 'coalesced', 'disconnected'))
@@ -0,0 +1,50 @@
+from channels.middleware import BaseMiddleware
+from django.conf import settings
+from django.contrib.auth.models import AnonymousUser
+from django.http import parse_cookie
+from rest_framework_simplejwt.exceptions import TokenError
+from rest_framework_simplejwt.models import TokenUser
+from rest_framework_simplejwt.tokens import AccessToken
+
+# Browsers cannot set headers on a WebSocket handshake, so clients that cannot
+# rely on the access_token cookie offer the token as a subprotocol instead,
+# e.g. ["chat.json.v1", "access_token.<jwt>"]. It is never accepted back.
+TOKEN_SUBPROTOCOL_PREFIX = 'access_token.'
+
+
+def get_raw_token(scope):
+    for subprotocol in scope.get('subprotocols') or []:
+        if subprotocol.startswith(TOKEN_SUBPROTOCOL_PREFIX):
+            return subprotocol[len(TOKEN_SUBPROTOCOL_PREFIX):]
+    for name, value in scope.get('headers', []):
+        if name == b'cookie':
+            return parse_cookie(value.decode('latin1')).get(settings.SIMPLE_JWT['AUTH_COOKIE'])
+    return None
+
+
+def get_token_user(scope):
+    """
+    The user of the connection's access token, built from its claims without
+    a database query, or AnonymousUser if there is no valid token.
+    """
+
+    raw_token = get_raw_token(scope)
+    if not raw_token:
+        return AnonymousUser()
+    try:
+        return TokenUser(AccessToken(raw_token))
+    except TokenError:
+        return AnonymousUser()
+
+
+class JWTAuthMiddleware(BaseMiddleware):
+    """
+    Sets scope['user'] of WebSocket connections from a simplejwt access token.
+
+    scope['user'] is a TokenUser carrying the id and username claims; consumers
+    load the full User only when they need it.
+    """
+
+    async def __call__(self, scope, receive, send):
+        scope = dict(scope, user=get_token_user(scope))
+        return await super().__call__(scope, receive, send)
@@ -0,0 +1,55 @@
+# Generated by Django 5.0.6 on 2026-10-18 10:03
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Max
+
+
+def seen_by_to_read_states(apps, schema_editor):
+    Message = apps.get_model('core', 'Message')
+    ReadState = apps.get_model('core', 'ReadState')
+    watermarks = (
+        Message.seen_by.through.objects
+        .values('user_id', 'message__chat_room_id')
+        .annotate(last_read=Max('message_id'))
+    )
+    ReadState.objects.bulk_create(
+        (
+            ReadState(
+                user_id=row['user_id'],
+                chat_room_id=row['message__chat_room_id'],
+                last_read_message_id=row['last_read'],
+            )
+            for row in watermarks.iterator()
+        ),
+        batch_size=1000,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0007_message_core_msg_room_created_idx'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ReadState',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('last_read_message_id', models.BigIntegerField(default=0)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('chat_room', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='read_states', to='core.chatroom')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='read_states', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('user', 'chat_room'), name='core_readstate_user_room_uniq')],
+            },
+        ),
+        migrations.RunPython(seen_by_to_read_states, migrations.RunPython.noop),
+        migrations.RemoveField(
+            model_name='message',
+            name='seen_by',
+        ),
+    ]
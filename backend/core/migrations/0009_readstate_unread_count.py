@@ -0,0 +1,18 @@
+# Generated by Django 5.0.6 on 2026-10-18 10:41
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0008_readstate_remove_message_seen_by'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='readstate',
+            name='unread_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
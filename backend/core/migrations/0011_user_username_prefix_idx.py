@@ -0,0 +1,48 @@
+# Generated by Django 5.0.6 on 2026-10-18 11:52
+
+import django.contrib.postgres.indexes
+import django.db.models.functions.text
+from django.db import migrations, models
+
+
+def create_username_prefix_index(apps, schema_editor):
+    # username__istartswith compiles to UPPER("username"::text) LIKE UPPER('prefix%'),
+    # which PostgreSQL can only serve from an index using a pattern operator class.
+    if schema_editor.connection.vendor == 'postgresql':
+        schema_editor.execute(
+            'CREATE INDEX core_user_username_prefix_idx ON core_user (UPPER(username::text) text_pattern_ops)'
+        )
+    else:
+        schema_editor.execute('CREATE INDEX core_user_username_prefix_idx ON core_user (UPPER(username))')
+
+
+def drop_username_prefix_index(apps, schema_editor):
+    schema_editor.execute('DROP INDEX core_user_username_prefix_idx')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0010_conversation_last_message'),
+    ]
+
+    operations = [
+        # The operator class only exists on PostgreSQL, so the index is created
+        # by hand and declared on the model for the migration state
+        migrations.SeparateDatabaseAndState(
+            database_operations=[
+                migrations.RunPython(create_username_prefix_index, drop_username_prefix_index),
+            ],
+            state_operations=[
+                migrations.AddIndex(
+                    model_name='user',
+                    index=models.Index(
+                        django.contrib.postgres.indexes.OpClass(
+                            django.db.models.functions.text.Upper('username'), name='text_pattern_ops'
+                        ),
+                        name='core_user_username_prefix_idx',
+                    ),
+                ),
+            ],
+        ),
+    ]
@@ -0,0 +1,68 @@
+# Generated by Django 5.0.6 on 2026-10-18 13:05
+
+from django.db import migrations
+
+SQLITE_FTS = [
+    "CREATE VIRTUAL TABLE core_message_fts USING fts5(text, content='core_message', content_rowid='id')",
+    "INSERT INTO core_message_fts(rowid, text) SELECT id, text FROM core_message",
+    """
+    CREATE TRIGGER core_message_fts_ai AFTER INSERT ON core_message BEGIN
+        INSERT INTO core_message_fts(rowid, text) VALUES (new.id, new.text);
+    END
+    """,
+    """
+    CREATE TRIGGER core_message_fts_ad AFTER DELETE ON core_message BEGIN
+        INSERT INTO core_message_fts(core_message_fts, rowid, text) VALUES ('delete', old.id, old.text);
+    END
+    """,
+    """
+    CREATE TRIGGER core_message_fts_au AFTER UPDATE OF text ON core_message BEGIN
+        INSERT INTO core_message_fts(core_message_fts, rowid, text) VALUES ('delete', old.id, old.text);
+        INSERT INTO core_message_fts(rowid, text) VALUES (new.id, new.text);
+    END
+    """,
+]
+
+SQLITE_FTS_DROP = [
+    "DROP TRIGGER core_message_fts_au",
+    "DROP TRIGGER core_message_fts_ad",
+    "DROP TRIGGER core_message_fts_ai",
+    "DROP TABLE core_message_fts",
+]
+
+
+def text_search_index():
+    from django.contrib.postgres.indexes import GinIndex
+    from django.contrib.postgres.search import SearchVector
+
+    # Must match the expression core.search filters on for the index to be used
+    return GinIndex(SearchVector('text', config='simple'), name='core_msg_text_search_idx')
+
+
+def create_text_search_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == 'postgresql':
+        schema_editor.add_index(apps.get_model('core', 'Message'), text_search_index())
+    elif vendor == 'sqlite':
+        for statement in SQLITE_FTS:
+            schema_editor.execute(statement)
+
+
+def drop_text_search_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == 'postgresql':
+        schema_editor.remove_index(apps.get_model('core', 'Message'), text_search_index())
+    elif vendor == 'sqlite':
+        for statement in SQLITE_FTS_DROP:
+            schema_editor.execute(statement)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0011_user_username_prefix_idx'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_text_search_index, drop_text_search_index),
+    ]
@@ -1,6 +1,11 @@
+import uuid
+
 from django.db import models
 from cloudinary.models import CloudinaryField
 from django.contrib.auth.models import AbstractUser
+from django.contrib.postgres.indexes import OpClass
+from django.core.files.storage import storages
+from django.db.models.functions import Upper
 
 class User(AbstractUser):
     username = models.CharField(max_length=150, unique=True)
@@ -8,6 +13,12 @@ class User(AbstractUser):
     profile_picture = CloudinaryField('image', null=True, blank=True)
     is_online = models.BooleanField(default=False)
 
+    class Meta(AbstractUser.Meta):
+        indexes = [
+            # Serves username__istartswith, i.e. UPPER("username") LIKE 'PREFIX%'
+            models.Index(OpClass(Upper('username'), name='text_pattern_ops'), name='core_user_username_prefix_idx'),
+        ]
+
     def __str__(self):
         return self.username
 
@@ -18,6 +29,69 @@ class ChatRoom(models.Model):
     def __str__(self):
         return self.name
 
+def media_storage():
+    return storages['chat_media']
+
+class MediaAsset(models.Model):
+    """
+    An uploaded image or video, stored once per distinct content.
+
+    Assets are deduplicated by the SHA-256 of their content. Thumbnails (and
+    preview frames of videos) are made in the background by core.media, which
+    moves `status` from processing to ready or failed.
+    """
+
+    IMAGE = 'image'
+    VIDEO = 'video'
+    KIND_CHOICES = [
+        (IMAGE, 'Image'),
+        (VIDEO, 'Video'),
+    ]
+
+    PROCESSING = 'processing'
+    READY = 'ready'
+    FAILED = 'failed'
+    STATUS_CHOICES = [
+        (PROCESSING, 'Processing'),
+        (READY, 'Ready'),
+        (FAILED, 'Failed'),
+    ]
+
+    sha256 = models.CharField(max_length=64, unique=True)
+    kind = models.CharField(max_length=10, choices=KIND_CHOICES)
+    content_type = models.CharField(max_length=100)
+    size = models.BigIntegerField()
+    file = models.FileField(storage=media_storage, upload_to='media/', max_length=255)
+    thumbnail = models.FileField(storage=media_storage, upload_to='thumbnails/', max_length=255, blank=True)
+    width = models.PositiveIntegerField(null=True, blank=True)
+    height = models.PositiveIntegerField(null=True, blank=True)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=PROCESSING)
+    uploaded_by = models.ForeignKey(User, related_name='media_assets', on_delete=models.SET_NULL, null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f'{self.kind} {self.sha256[:12]}'
+
+class MediaUpload(models.Model):
+    """
+    A chunked upload in progress. Chunks are appended to a part file in
+    CHAT_MEDIA['UPLOAD_DIR'] until `received` reaches `size`. Completing it
+    sets either `asset` or, for rejected content, `error`.
+    """
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    user = models.ForeignKey(User, related_name='media_uploads', on_delete=models.CASCADE)
+    filename = models.CharField(max_length=255)
+    content_type = models.CharField(max_length=100)
+    size = models.BigIntegerField()
+    received = models.BigIntegerField(default=0)
+    asset = models.ForeignKey(MediaAsset, related_name='uploads', on_delete=models.SET_NULL, null=True, blank=True)
+    error = models.CharField(max_length=200, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f'{self.filename} ({self.received}/{self.size})'
+
 class Message(models.Model):
     TEXT = 'text'
     IMAGE = 'image'
@@ -32,21 +106,58 @@ class Message(models.Model):
     user = models.ForeignKey(User, related_name='messages', on_delete=models.CASCADE)
     text = models.TextField()
     message_type = models.CharField(max_length=10, choices=MESSAGE_TYPE_CHOICES, default=TEXT)
-    seen_by = models.ManyToManyField(User, related_name='seen_messages', blank=True)
+    media = models.ForeignKey(MediaAsset, related_name='messages', on_delete=models.SET_NULL, null=True, blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['chat_room', 'created_at', 'id'], name='core_msg_room_created_idx'),
+        ]
+
     def __str__(self):
         return f'{self.user} message in {self.chat_room}'
 
+class ReadState(models.Model):
+    """
+    How far a user has read in a chat room.
+
+    Every message with an id up to `last_read_message_id` counts as seen by the
+    user, so read receipts cost one row per reader per room. `unread_count` is
+    maintained by the message write path and reset by read events.
+    """
+
+    user = models.ForeignKey(User, related_name='read_states', on_delete=models.CASCADE)
+    chat_room = models.ForeignKey(ChatRoom, related_name='read_states', on_delete=models.CASCADE)
+    last_read_message_id = models.BigIntegerField(default=0)
+    unread_count = models.PositiveIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'chat_room'], name='core_readstate_user_room_uniq'),
+        ]
+
+    def __str__(self):
+        return f'{self.user} read {self.chat_room} up to {self.last_read_message_id}'
+
 class Conversation(models.Model):
     admin = models.ForeignKey(User, related_name='convos', on_delete=models.CASCADE, null=True, blank=True)
     chat_room = models.ForeignKey(ChatRoom, related_name='rooms', on_delete=models.CASCADE)
     # room_image = 
     participants = models.ManyToManyField(User)
     is_group = models.BooleanField(default=False)
+    # Denormalized summary of the newest message, kept current by the message write path
+    last_message_text = models.CharField(max_length=255, blank=True, default='')
+    last_message_sender = models.ForeignKey(User, related_name='+', on_delete=models.SET_NULL, null=True, blank=True)
+    last_message_at = models.DateTimeField(null=True, blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['-updated_at', '-id'], name='core_conv_updated_idx'),
+        ]
+
     def __str__(self):
         return f'{self.chat_room.name} (Group)' if self.is_group else f'Conversation in {self.chat_room.name}'
 
@@ -0,0 +1,198 @@
+import asyncio
+import logging
+import weakref
+from collections import deque
+
+from django.conf import settings
+
+from .encoding import decode_frame, encode_frame, encode_packed, packed_frame
+
+logger = logging.getLogger(__name__)
+
+DROP_OLDEST = 'drop_oldest'
+COALESCE_PRESENCE = 'coalesce_presence'
+DISCONNECT = 'disconnect'
+
+# Close code sent to clients that could not keep up; they should reconnect and resume
+SLOW_CONSUMER_CLOSE_CODE = 4008
+
+_consumers = weakref.WeakSet()
+_counters = {'dropped': 0, 'coalesced': 0, 'disconnected': 0}
+
+
+def outbound_stats():
+    """
+    Queue depth and slow-consumer counters of this process's connections.
+    """
+
+    depths = [len(consumer.outbound) for consumer in list(_consumers)]
+    return {
+        'connections': len(depths),
+        'queued_frames': sum(depths),
+        'max_queue_depth': max(depths, default=0),
+        **_counters,
+    }
+
+
+def merge_presence(frames):
+    """
+    Collapse several presence diff frames into one, later diffs winning.
+    """
+
+    online, offline = {}, {}
+    for frame in frames:
+        diff = decode_frame(bytes_data=frame) if isinstance(frame, bytes) else decode_frame(frame)
+        for username in diff['online']:
+            offline.pop(username, None)
+            online[username] = True
+        for username in diff['offline']:
+            online.pop(username, None)
+            offline[username] = True
+    payload = {'type': 'presence', 'online': list(online), 'offline': list(offline)}
+    return encode_packed(payload) if isinstance(frames[0], bytes) else encode_frame(payload)
+
+
+class TransportProducer:
+    """
+    Twisted push producer registered on a Daphne connection. Twisted pauses
+    it while the transport's write buffer is full and resumes it once the
+    buffer has been written out, so `writable` is clear while the client is
+    not reading.
+    """
+
+    def __init__(self):
+        self.writable = asyncio.Event()
+        self.writable.set()
+
+    def pauseProducing(self):
+        self.writable.clear()
+
+    def resumeProducing(self):
+        self.writable.set()
+
+    def stopProducing(self):
+        # The connection is gone; writes are dropped from now on
+        self.writable.set()
+
+
+def daphne_protocol(send):
+    """
+    The Twisted protocol of a connection served by Daphne, which passes
+    `functools.partial(server.handle_reply, protocol)` as the ASGI send
+    callable, or None on other servers.
+    """
+
+    args = getattr(send, 'args', None)
+    protocol = args[0] if args else None
+    return protocol if hasattr(protocol, 'registerProducer') else None
+
+
+class OutboundQueueMixin:
+    """
+    Bounded outbound queue for an AsyncWebsocketConsumer.
+
+    Frames passed to `send_frame` are queued and written by a per-connection
+    task, so group handlers never wait on a slow client. Once `outbound_max`
+    frames are waiting, `outbound_policy` decides what happens:
+
+        drop_oldest: the oldest queued frame is dropped.
+        coalesce_presence: queued presence diffs are merged into one, falling
+            back to dropping the oldest frame.
+        disconnect: the client gets the frame from `resume_hint()` and the
+            connection is closed with code 4008.
+
+    Daphne's send returns as soon as a frame is in the transport's write
+    buffer, however large it grows, so under Daphne a TransportProducer holds
+    frames in the queue while that buffer is full. Other servers fill the
+    queue only if their send waits for the client.
+
+    Frames are text, or bytes on connections that negotiated the binary
+    encoding (`binary`). Frames carrying a chat message are queued with its
+    id; `delivered_message_id` is the last such id actually written to the
+    socket.
+    """
+
+    outbound_policy = DROP_OLDEST
+    outbound_max = None
+    binary = False
+
+    def outbound_init(self):
+        self.outbound = deque()  # (frame, kind, message id or None)
+        self.outbound_task = None
+        if self.outbound_max is None:
+            self.outbound_max = settings.CHAT_OUTBOUND['MAX_QUEUE']
+        self.outbound_producer = None
+        protocol = daphne_protocol(getattr(self, 'base_send', None))
+        if protocol is not None:
+            self.outbound_producer = TransportProducer()
+            protocol.registerProducer(self.outbound_producer, True)
+        _consumers.add(self)
+
+    async def send_frame(self, frame, kind=None, message_id=None):
+        if not hasattr(self, 'outbound'):
+            self.outbound_init()
+        if len(self.outbound) >= self.outbound_max and not await self.outbound_overflow():
+            return
+        self.outbound.append((frame, kind, message_id))
+        if self.outbound_task is None or self.outbound_task.done():
+            self.outbound_task = asyncio.get_running_loop().create_task(self.outbound_drain())
+
+    async def send_event(self, event, kind=None):
+        # Group events carry a JSON frame, packed on first use, see encoding.encode_frames
+        await self.send_frame(packed_frame(event['frame']) if self.binary else event['frame'], kind, event.get('message_id'))
+
+    def encode(self, payload):
+        return encode_packed(payload) if self.binary else encode_frame(payload)
+
+    async def outbound_overflow(self):
+        """
+        Make room in a full queue. Returns False if the frame must not be queued.
+        """
+
+        if self.outbound_policy == DISCONNECT:
+            _counters['disconnected'] += 1
+            self.outbound.clear()
+            if self.outbound_task is not None:
+                self.outbound_task.cancel()
+            await self.send_encoded(self.encode(self.resume_hint()))
+            await self.close(code=SLOW_CONSUMER_CLOSE_CODE)
+            return False
+        if self.outbound_policy == COALESCE_PRESENCE:
+            presence = [frame for frame, kind, _ in self.outbound if kind == 'presence']
+            if len(presence) > 1:
+                _counters['coalesced'] += len(presence) - 1
+                others = [item for item in self.outbound if item[1] != 'presence']
+                self.outbound = deque(others)
+                self.outbound.append((merge_presence(presence), 'presence', None))
+                return True
+        _counters['dropped'] += 1
+        self.outbound.popleft()
+        return True
+
+    async def outbound_drain(self):
+        try:
+            while self.outbound:
+                if self.outbound_producer is not None:
+                    # Frames stay queued, counting towards outbound_max, until the client reads
+                    await self.outbound_producer.writable.wait()
+                frame, _, message_id = self.outbound.popleft()
+                await self.send_encoded(frame)
+                if message_id:
+                    self.delivered_message_id = message_id
+        except Exception as e:
+            logger.error(f"Error in outbound_drain method: {e}")
+
+    async def send_encoded(self, frame):
+        if isinstance(frame, bytes):
+            await self.send(bytes_data=frame)
+        else:
+            await self.send(text_data=frame)
+
+    def resume_hint(self):
+        return {'type': 'resume'}
+
+    async def websocket_disconnect(self, message):
+        if getattr(self, 'outbound_task', None) is not None:
+            self.outbound_task.cancel()
+        _consumers.discard(self)
+        await super().websocket_disconnect(message)
@@ -0,0 +1,121 @@
+from django.db.models import Q
+from rest_framework.exceptions import NotFound, ValidationError
+from rest_framework.pagination import BasePagination, CursorPagination
+from rest_framework.response import Response
+
+
+def messages_before(queryset, anchor):
+    """
+    Restrict a message queryset to the rows strictly older than the anchor.
+
+    Messages are ordered by (created_at, id), so the id breaks ties between
+    messages written within the same timestamp.
+    """
+
+    return queryset.filter(
+        Q(created_at__lt=anchor['created_at']) |
+        Q(created_at=anchor['created_at'], id__lt=anchor['id'])
+    )
+
+
+def messages_after(queryset, anchor):
+    """
+    Restrict a message queryset to the rows strictly newer than the anchor.
+    """
+
+    return queryset.filter(
+        Q(created_at__gt=anchor['created_at']) |
+        Q(created_at=anchor['created_at'], id__gt=anchor['id'])
+    )
+
+
+class MessageKeysetPagination(BasePagination):
+    """
+    Keyset pagination for a room's message history.
+
+    Pages are always returned newest-first. Without a cursor the newest page is
+    returned; `before=<message id>` walks back through older history and
+    `after=<message id>` scrolls forward from a known message. Every page is a
+    bounded range scan on the (chat_room, created_at, id) index, so the cost of a
+    page does not depend on how much history the room has.
+    """
+
+    default_limit = 50
+    max_limit = 200
+
+    def get_limit(self, request):
+        limit = request.query_params.get('limit')
+        if limit is None:
+            return self.default_limit
+        try:
+            limit = int(limit)
+        except ValueError:
+            raise ValidationError({'limit': 'A valid integer is required.'})
+        if limit < 1:
+            raise ValidationError({'limit': 'Ensure this value is greater than or equal to 1.'})
+        return min(limit, self.max_limit)
+
+    def get_anchor(self, queryset, param, message_id):
+        try:
+            message_id = int(message_id)
+        except ValueError:
+            raise ValidationError({param: 'A valid message id is required.'})
+        anchor = queryset.filter(id=message_id).values('id', 'created_at').first()
+        if anchor is None:
+            raise NotFound(f'Message {message_id} does not exist in this room.')
+        return anchor
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.limit = self.get_limit(request)
+        before = request.query_params.get('before')
+        after = request.query_params.get('after')
+        if before and after:
+            raise ValidationError('Only one of `before` and `after` may be given.')
+
+        if after:
+            anchor = self.get_anchor(queryset, 'after', after)
+            page = list(messages_after(queryset, anchor).order_by('created_at', 'id')[:self.limit + 1])
+            self.has_newer = len(page) > self.limit
+            self.has_older = True
+            page = page[:self.limit]
+            page.reverse()
+        else:
+            if before:
+                anchor = self.get_anchor(queryset, 'before', before)
+                queryset = messages_before(queryset, anchor)
+            page = list(queryset.order_by('-created_at', '-id')[:self.limit + 1])
+            self.has_older = len(page) > self.limit
+            self.has_newer = bool(before)
+            page = page[:self.limit]
+
+        self.page = page
+        return page
+
+    def get_paginated_response(self, data):
+        return Response({
+            'before': self.page[-1].id if self.page and self.has_older else None,
+            'after': self.page[0].id if self.page and self.has_newer else None,
+            'results': data,
+        })
+
+
+class ConversationCursorPagination(CursorPagination):
+    """
+    Most recently active conversations first.
+    """
+
+    page_size = 30
+    max_page_size = 100
+    page_size_query_param = 'limit'
+    ordering = ('-updated_at', '-id')
+
+
+class UserDirectoryPagination(CursorPagination):
+    """
+    Users in username order.
+    """
+
+    page_size = 50
+    max_page_size = 200
+    page_size_query_param = 'limit'
+    ordering = 'username'
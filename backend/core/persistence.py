@@ -0,0 +1,306 @@
+import asyncio
+import atexit
+import logging
+from collections import Counter, defaultdict, deque
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Case, Count, F, Q, Value, When
+from django.utils import timezone
+
+from .db import db_sync_to_async
+from .history import room_history
+from .models import Conversation, Message, ReadState
+from .serializers import MessageSerializer
+
+logger = logging.getLogger(__name__)
+
+
+class WriteBehindBuffer:
+    """
+    Queue of pending writes that are flushed in batches.
+
+    Items are written in the order they were queued, either once `batch_size`
+    items are waiting or `flush_interval` seconds after the first item of a batch
+    was queued, whichever comes first. `write` is a synchronous callable that
+    receives the list of queued items and runs in a worker thread. If a batch
+    fails, its items are written one by one, so one bad item only loses itself.
+    """
+
+    def __init__(self, write, batch_size=100, flush_interval=0.05):
+        self.write = write
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._items = []
+        self._timer = None
+        self._lock = None
+
+    def put(self, item):
+        """
+        Queue an item without waiting for it to be written.
+        """
+
+        self._items.append(item)
+        loop = asyncio.get_running_loop()
+        if len(self._items) >= self.batch_size:
+            loop.create_task(self.flush())
+        elif self._timer is None:
+            self._timer = loop.call_later(self.flush_interval, lambda: loop.create_task(self.flush()))
+
+    async def flush(self):
+        """
+        Write everything queued so far. Batches never overlap, so items are
+        written in the order they were queued.
+        """
+
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            batch, self._items = self._items, []
+            if batch:
+                await db_sync_to_async(self._write)(batch)
+
+    def flush_sync(self):
+        """
+        Write whatever is still queued from outside the event loop, e.g. at
+        interpreter shutdown.
+        """
+
+        batch, self._items = self._items, []
+        if batch:
+            self._write(batch)
+
+    def _write(self, batch):
+        try:
+            self.write(batch)
+        except Exception as e:
+            if len(batch) == 1:
+                logger.error(f"Error writing {batch[0]!r}, dropping it: {e}")
+                return
+            logger.error(f"Error writing batch of {len(batch)} items, writing them one by one: {e}")
+            for item in batch:
+                self._write([item])
+
+
+def reserve_message_ids(count):
+    """
+    Take `count` ids from the message table's id sequence, for messages that
+    are broadcast before they are written. Later INSERTs never reuse them.
+    """
+
+    table = Message._meta.db_table
+    with transaction.atomic(), connection.cursor() as cursor:
+        if connection.vendor == 'postgresql':
+            cursor.execute(
+                "SELECT nextval(pg_get_serial_sequence(%s, 'id')) FROM generate_series(1, %s)",
+                [table, count],
+            )
+            return [row[0] for row in cursor.fetchall()]
+        if connection.vendor == 'sqlite':
+            # AUTOINCREMENT ids always go past the table's sqlite_sequence entry
+            quoted = connection.ops.quote_name(table)
+            cursor.execute(
+                f"UPDATE sqlite_sequence SET seq = MAX(seq, (SELECT COALESCE(MAX(id), 0) FROM {quoted})) + %s "
+                "WHERE name = %s",
+                [count, table],
+            )
+            if not cursor.rowcount:
+                cursor.execute(
+                    f"INSERT INTO sqlite_sequence (name, seq) SELECT %s, COALESCE(MAX(id), 0) + %s FROM {quoted}",
+                    [table, count],
+                )
+            cursor.execute("SELECT seq FROM sqlite_sequence WHERE name = %s", [table])
+            last = cursor.fetchone()[0]
+            return list(range(last - count + 1, last + 1))
+    raise NotImplementedError(f"Reserving message ids is not supported on {connection.vendor}.")
+
+
+class MessageIdAllocator:
+    """
+    Hands out message ids reserved from the database `block_size` at a time,
+    so that queued messages are broadcast with the id they are written with.
+
+    Ids are increasing within a process. Between processes, a message can get a
+    lower id than an older message of another process while both hold
+    reserved blocks, which is why the block size is 1 when workers share a
+    channel broker.
+    """
+
+    def __init__(self, block_size=100):
+        self.block_size = block_size
+        self._ids = deque()
+        self._lock = None
+
+    async def next_id(self):
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        while not self._ids:
+            async with self._lock:
+                if not self._ids:
+                    self._ids.extend(await db_sync_to_async(reserve_message_ids)(self.block_size))
+        return self._ids.popleft()
+
+
+def ensure_read_states(room_id, user_ids):
+    """
+    Create the missing ReadState rows of a room's members, so that unread
+    counters can be maintained with plain UPDATEs.
+    """
+
+    ReadState.objects.bulk_create(
+        [ReadState(user_id=user_id, chat_room_id=room_id) for user_id in user_ids],
+        ignore_conflicts=True,
+    )
+
+
+def add_unread(room_id, sent):
+    """
+    Bump the unread counters of a room's members in a single UPDATE.
+
+    `sent` maps sender id -> number of new messages; every member's counter grows
+    by the number of new messages that other members sent.
+    """
+
+    total = sum(sent.values())
+    own = Case(*[When(user_id=user_id, then=Value(count)) for user_id, count in sent.items()], default=Value(0))
+    ReadState.objects.filter(chat_room_id=room_id).update(unread_count=F('unread_count') + total - own)
+
+
+def touch_conversation(room_id, message):
+    """
+    Record `message` as the newest message of the room's conversation.
+    """
+
+    Conversation.objects.filter(chat_room_id=room_id).update(
+        last_message_text=message.text[:255],
+        last_message_sender_id=message.user_id,
+        last_message_at=message.created_at,
+        updated_at=message.created_at,
+    )
+
+
+def write_messages(messages):
+    sent = defaultdict(Counter)
+    for message in messages:
+        sent[message.chat_room_id][message.user_id] += 1
+    with transaction.atomic():
+        Message.objects.bulk_create(messages, batch_size=settings.CHAT_WRITE_BEHIND['BATCH_SIZE'])
+        newest = {message.chat_room_id: message for message in messages}
+        for room_id, counts in sent.items():
+            add_unread(room_id, counts)
+            touch_conversation(room_id, newest[room_id])
+    if room_history.enabled:
+        # The hot history only takes messages once they are written
+        for message in messages:
+            room_history.append(message.chat_room_id, MessageSerializer(message, context={'is_new': True}).data)
+
+
+def count_unread(states):
+    """
+    Set the unread_count of ReadStates to the number of messages after their
+    watermark that other users sent, in a single SELECT.
+    """
+
+    if not states:
+        return
+    after = Q()
+    counts = {}
+    for index, state in enumerate(states):
+        newer = Q(chat_room_id=state.chat_room_id, id__gt=state.last_read_message_id)
+        after |= newer
+        counts[f'unread_{index}'] = Count('id', filter=newer & ~Q(user_id=state.user_id))
+    unread = Message.objects.filter(after).aggregate(**counts)
+    for index, state in enumerate(states):
+        state.unread_count = unread[f'unread_{index}']
+
+
+def write_read_marks(marks):
+    """
+    Persist (user id, room id, message id) read marks, keeping for each reader
+    the highest message id seen, and recount the readers' unread messages after
+    their new watermark, which covers messages that arrived while the marks were
+    queued. Costs two SELECTs plus one bulk UPDATE and one bulk INSERT however
+    many marks are queued.
+    """
+
+    latest = {}
+    for user_id, room_id, message_id in marks:
+        key = (user_id, room_id)
+        if message_id > latest.get(key, 0):
+            latest[key] = message_id
+    marks_by_reader = dict(latest)
+
+    pairs = Q()
+    for user_id, room_id in latest:
+        pairs |= Q(user_id=user_id, chat_room_id=room_id)
+    existing = ReadState.objects.filter(pairs)
+    now = timezone.now()
+    updated = []
+    for state in existing:
+        message_id = latest.pop((state.user_id, state.chat_room_id), None)
+        if message_id is not None and message_id > state.last_read_message_id:
+            state.last_read_message_id = message_id
+            state.updated_at = now
+            updated.append(state)
+    created = [
+        ReadState(user_id=user_id, chat_room_id=room_id, last_read_message_id=message_id)
+        for (user_id, room_id), message_id in latest.items()
+    ]
+    count_unread(updated + created)
+    ReadState.objects.bulk_update(updated, ['last_read_message_id', 'unread_count', 'updated_at'])
+    ReadState.objects.bulk_create(created, ignore_conflicts=True)
+    for (user_id, room_id), message_id in marks_by_reader.items():
+        room_history.mark_read(room_id, user_id, message_id)
+
+
+_message_buffer = None
+_message_ids = None
+_read_buffer = None
+
+
+def get_message_buffer():
+    """
+    Return the process-wide write-behind buffer for chat messages.
+    """
+
+    global _message_buffer
+    if _message_buffer is None:
+        config = settings.CHAT_WRITE_BEHIND
+        _message_buffer = WriteBehindBuffer(
+            write_messages,
+            batch_size=config['BATCH_SIZE'],
+            flush_interval=config['FLUSH_INTERVAL'],
+        )
+        atexit.register(_message_buffer.flush_sync)
+    return _message_buffer
+
+
+def get_message_ids():
+    """
+    Return the process-wide allocator of ids for write-behind messages.
+    """
+
+    global _message_ids
+    if _message_ids is None:
+        _message_ids = MessageIdAllocator(block_size=settings.CHAT_WRITE_BEHIND['ID_BLOCK_SIZE'])
+    return _message_ids
+
+
+def get_read_buffer():
+    """
+    Return the process-wide buffer that debounces read marks.
+    """
+
+    global _read_buffer
+    if _read_buffer is None:
+        config = settings.CHAT_READ_RECEIPTS
+        _read_buffer = WriteBehindBuffer(
+            write_read_marks,
+            batch_size=config['BATCH_SIZE'],
+            flush_interval=config['FLUSH_INTERVAL'],
+        )
+        atexit.register(_read_buffer.flush_sync)
+    return _read_buffer
@@ -0,0 +1,238 @@
+import asyncio
+import logging
+import time
+
+from channels.layers import get_channel_layer
+from django.conf import settings
+
+from .db import db_sync_to_async
+from .encoding import encode_frames
+from .models import User
+
+logger = logging.getLogger(__name__)
+
+
+class PresenceRegistry:
+    """
+    Record of which users have open global connections.
+
+    A user is online while at least one of their connections is open and has
+    sent a heartbeat within `timeout` seconds, so closing one of several tabs
+    does not mark them offline. Transitions are collected and broadcast every
+    `tick` seconds as a single diff; a user who goes offline and back online
+    within one tick (or the reverse) is left out of it. `User.is_online` is
+    written lazily: every `interval` seconds the registry expires stale
+    connections and persists the users whose state changed since the last run,
+    with at most one UPDATE per state.
+
+    Diffs and expiry notices go through `layer`, by default the channel layer.
+    A registry covers the connections of one process; when workers share a
+    channel broker, the broker runs the registry of all of them (see
+    BrokerPresence).
+    """
+
+    def __init__(self, timeout=90, interval=5, tick=1, layer=None):
+        self.timeout = timeout
+        self.interval = interval
+        self.tick = tick
+        self.layer = layer
+        self._connections = {}  # channel name -> [user id, last heartbeat]
+        self._counts = {}  # user id -> number of live connections
+        self._usernames = {}
+        self._dirty = {}  # user id -> is_online still to be persisted
+        self._changes = {}  # username -> is_online as of the last broadcast diff
+        self._task = None
+
+    def connect(self, channel_name, user_id, username):
+        """
+        Register a connection. Returns True if the user just came online.
+        """
+
+        self._ensure_running()
+        self._connections[channel_name] = [user_id, time.monotonic()]
+        self._usernames[user_id] = username
+        count = self._counts.get(user_id, 0) + 1
+        self._counts[user_id] = count
+        if count == 1:
+            self._dirty[user_id] = True
+            self._changes.setdefault(username, False)
+            return True
+        return False
+
+    def disconnect(self, channel_name):
+        """
+        Forget a connection. Returns the username if the user just went
+        offline, otherwise None. Unknown connections are ignored, so this is safe
+        to call for connections the sweeper already expired.
+        """
+
+        connection = self._connections.pop(channel_name, None)
+        if connection is None:
+            return None
+        user_id = connection[0]
+        count = self._counts[user_id] - 1
+        if count:
+            self._counts[user_id] = count
+            return None
+        del self._counts[user_id]
+        self._dirty[user_id] = False
+        username = self._usernames.pop(user_id)
+        self._changes.setdefault(username, True)
+        return username
+
+    def heartbeat(self, channel_name):
+        connection = self._connections.get(channel_name)
+        if connection is not None:
+            connection[1] = time.monotonic()
+
+    def is_online(self, user_id):
+        return user_id in self._counts
+
+    def online_usernames(self):
+        return list(self._usernames.values())
+
+    def channel_names(self):
+        return list(self._connections)
+
+    def snapshot_event(self):
+        return {
+            'type': 'presence_snapshot',
+            **encode_frames({
+                'type': 'presence_snapshot',
+                'online': self.online_usernames()
+            })
+        }
+
+    async def join(self, channel_name, user_id, username):
+        """
+        Register a connection and send it the users that are online.
+        """
+
+        self.connect(channel_name, user_id, username)
+        await (self.layer or get_channel_layer()).send(channel_name, self.snapshot_event())
+
+    async def leave(self, channel_name):
+        self.disconnect(channel_name)
+
+    async def beat(self, channel_name):
+        self.heartbeat(channel_name)
+
+    def take_diff(self):
+        """
+        Return the usernames that came online and went offline since the last
+        diff, leaving out users who ended up where they started.
+        """
+
+        changes, self._changes = self._changes, {}
+        online_now = set(self._usernames.values())
+        online, offline = [], []
+        for username, was_online in changes.items():
+            is_online = username in online_now
+            if is_online != was_online:
+                (online if is_online else offline).append(username)
+        return online, offline
+
+    def sweep(self):
+        """
+        Expire connections without a recent heartbeat. Returns the expired
+        channel names and the usernames of users that went offline.
+        """
+
+        deadline = time.monotonic() - self.timeout
+        expired = [name for name, (_, seen) in self._connections.items() if seen < deadline]
+        offline = []
+        for channel_name in expired:
+            username = self.disconnect(channel_name)
+            if username is not None:
+                offline.append(username)
+        return expired, offline
+
+    async def persist(self):
+        dirty, self._dirty = self._dirty, {}
+        if dirty:
+            await db_sync_to_async(self._write)(dirty)
+
+    def _write(self, dirty):
+        try:
+            for is_online in (True, False):
+                user_ids = [user_id for user_id, state in dirty.items() if state is is_online]
+                if user_ids:
+                    User.objects.filter(pk__in=user_ids).update(is_online=is_online)
+        except Exception as e:
+            logger.error(f"Error persisting presence of {len(dirty)} users: {e}")
+
+    def _ensure_running(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def _run(self):
+        channel_layer = self.layer or get_channel_layer()
+        next_sweep = time.monotonic() + self.interval
+        while True:
+            await asyncio.sleep(self.tick)
+            try:
+                if time.monotonic() >= next_sweep:
+                    next_sweep = time.monotonic() + self.interval
+                    expired, _ = self.sweep()
+                    for channel_name in expired:
+                        await channel_layer.send(channel_name, {'type': 'presence_expired'})
+                    await self.persist()
+                online, offline = self.take_diff()
+                if online or offline:
+                    await broadcast_presence_diff(channel_layer, online, offline)
+            except Exception as e:
+                logger.error(f"Error in presence sweeper: {e}")
+
+
+class BrokerPresence:
+    """
+    Presence of workers that share a channel broker.
+
+    Connections are registered with the broker (see core.layers.ChannelBroker),
+    which runs one PresenceRegistry for every worker. A user is therefore online
+    while any worker has a connection of theirs, and the connections of a worker
+    that goes away are forgotten with it.
+    """
+
+    def __init__(self, layer=None):
+        self.layer = layer
+
+    async def join(self, channel_name, user_id, username):
+        await (self.layer or get_channel_layer()).presence('join', channel_name, user_id, username)
+
+    async def leave(self, channel_name):
+        await (self.layer or get_channel_layer()).presence('leave', channel_name)
+
+    async def beat(self, channel_name):
+        await (self.layer or get_channel_layer()).presence('beat', channel_name)
+
+
+async def broadcast_presence_diff(channel_layer, online, offline):
+    await channel_layer.group_send(
+        'chat_global',
+        {
+            'type': 'presence_diff',
+            **encode_frames({
+                'type': 'presence',
+                'online': online,
+                'offline': offline
+            })
+        }
+    )
+
+
+def presence_registry(layer=None):
+    """
+    A PresenceRegistry configured from CHAT_PRESENCE.
+    """
+
+    config = settings.CHAT_PRESENCE
+    return PresenceRegistry(
+        timeout=config['HEARTBEAT_TIMEOUT'],
+        interval=config['SWEEP_INTERVAL'],
+        tick=config['BROADCAST_INTERVAL'],
+        layer=layer,
+    )
+
+
+presence = BrokerPresence() if settings.CHAT_PRESENCE['SHARED'] else presence_registry()
@@ -0,0 +1,95 @@
+from django.db import connection
+from django.db.models import Q
+from rest_framework.exceptions import ValidationError
+
+from .models import Message
+
+
+def parse_cursor(cursor):
+    """
+    Split a "<rank>:<message id>" search cursor.
+    """
+
+    try:
+        rank, message_id = cursor.split(':')
+        return float(rank), int(message_id)
+    except ValueError:
+        raise ValidationError({'cursor': 'Invalid cursor.'})
+
+
+def make_cursor(rank, message_id):
+    return f'{rank!r}:{message_id}'
+
+
+def search_messages(query, room_ids, limit, cursor=None):
+    """
+    Full-text search over the messages of `room_ids`.
+
+    Returns up to `limit` (message, rank) pairs, best match first, and the
+    cursor of the next page or None. Pages are keyset-paginated on
+    (rank, id), so deep pages cost the same as the first one.
+    """
+
+    if connection.vendor == 'postgresql':
+        search = _search_postgresql
+    elif connection.vendor == 'sqlite':
+        search = _search_sqlite
+    else:
+        raise NotImplementedError(f'Message search is not supported on {connection.vendor}.')
+
+    after = parse_cursor(cursor) if cursor else None
+    results = search(query, list(room_ids), limit + 1, after)
+    next_cursor = None
+    if len(results) > limit:
+        results = results[:limit]
+        message, rank = results[-1]
+        next_cursor = make_cursor(rank, message.id)
+    return results, next_cursor
+
+
+def _search_postgresql(query, room_ids, limit, after):
+    from django.contrib.postgres.search import SearchQuery, SearchRank, SearchVector
+
+    # Served by the GIN index on the same expression, see migration 0012
+    vector = SearchVector('text', config='simple')
+    search_query = SearchQuery(query, config='simple', search_type='websearch')
+    queryset = (
+        Message.objects.filter(chat_room_id__in=room_ids)
+        .annotate(search=vector, rank=SearchRank(vector, search_query))
+        .filter(search=search_query)
+    )
+    if after is not None:
+        rank, message_id = after
+        queryset = queryset.filter(Q(rank__lt=rank) | Q(rank=rank, id__lt=message_id))
+    queryset = queryset.select_related('user', 'media', 'chat_room').order_by('-rank', '-id')[:limit]
+    return [(message, message.rank) for message in queryset]
+
+
+def _search_sqlite(query, room_ids, limit, after):
+    if not room_ids:
+        return []
+    # Quote every term so user input cannot be read as FTS5 query syntax
+    match = ' '.join('"{}"'.format(term.replace('"', '""')) for term in query.split())
+    # bm25() is lower for better matches; negate it so that higher ranks are better
+    sql = [
+        'SELECT core_message_fts.rowid, -bm25(core_message_fts)',
+        'FROM core_message_fts JOIN core_message ON core_message.id = core_message_fts.rowid',
+        'WHERE core_message_fts MATCH %s',
+        'AND core_message.chat_room_id IN ({})'.format(', '.join(['%s'] * len(room_ids))),
+    ]
+    params = [match, *room_ids]
+    if after is not None:
+        rank, message_id = after
+        sql.append(
+            'AND (-bm25(core_message_fts) < %s OR (-bm25(core_message_fts) = %s AND core_message_fts.rowid < %s))'
+        )
+        params += [rank, rank, message_id]
+    sql.append('ORDER BY 2 DESC, 1 DESC LIMIT %s')
+    params.append(limit)
+
+    with connection.cursor() as cursor:
+        cursor.execute(' '.join(sql), params)
+        ranks = dict(cursor.fetchall())
+    messages = Message.objects.filter(id__in=ranks).select_related('user', 'media', 'chat_room').in_bulk()
+    ordered = sorted(ranks.items(), key=lambda item: (item[1], item[0]), reverse=True)
+    return [(messages[message_id], rank) for message_id, rank in ordered if message_id in messages]
@@ -1,8 +1,26 @@
 from rest_framework import serializers
 from cloudinary.utils import cloudinary_url
 from rest_framework_simplejwt.serializers import TokenObtainPairSerializer
-from rest_framework_simplejwt.tokens import RefreshToken
-from .models import User, ChatRoom, Message, Conversation
+from .cache import avatar_urls
+from django.conf import settings
+from .models import User, ChatRoom, Message, Conversation, MediaAsset, MediaUpload
+from .media import media_kind
+
+
+def avatar_url(public_id, **options):
+    """
+    Resolve the URL of a Cloudinary image, memoized by public id and
+    transformation options. A new picture gets a new public id, so entries
+    never go stale; they are only evicted when the cache is full.
+    """
+
+    options.setdefault('secure', True)
+    key = (public_id, tuple(sorted(options.items())))
+    url = avatar_urls.get(key)
+    if url is None:
+        url = cloudinary_url(public_id, **options)[0]
+        avatar_urls.set(key, url)
+    return url
 
 
 class UserSerializer(serializers.ModelSerializer):
@@ -25,16 +43,69 @@ class UserSerializer(serializers.ModelSerializer):
         representation = super().to_representation(instance)
         if instance.profile_picture:
             # Add the file URL to the representation
-            representation['profile_picture'] = cloudinary_url(instance.profile_picture.public_id, secure=True)[0]
+            representation['profile_picture'] = avatar_url(instance.profile_picture.public_id)
         return representation
 
+class MediaAssetSerializer(serializers.ModelSerializer):
+    # Storage URLs as they are, so messages serialize the same with or without a request
+    url = serializers.SerializerMethodField()
+    thumbnail_url = serializers.SerializerMethodField()
+
+    class Meta:
+        model = MediaAsset
+        fields = ['id', 'kind', 'content_type', 'size', 'url', 'thumbnail_url', 'width', 'height', 'status']
+
+    def get_url(self, obj):
+        return obj.file.url
+
+    def get_thumbnail_url(self, obj):
+        return obj.thumbnail.url if obj.thumbnail else None
+
+class MediaUploadSerializer(serializers.ModelSerializer):
+    """
+    Starts a chunked upload. Given the `sha256` of the file, content that was
+    uploaded before is not uploaded again.
+    """
+
+    sha256 = serializers.RegexField(r'^[0-9a-f]{64}$', write_only=True, required=False)
+    offset = serializers.IntegerField(source='received', read_only=True)
+    # Set once a completed upload has been processed
+    asset = MediaAssetSerializer(read_only=True)
+
+    class Meta:
+        model = MediaUpload
+        fields = ['id', 'filename', 'content_type', 'size', 'sha256', 'offset', 'asset', 'error']
+        read_only_fields = ['id', 'error']
+
+    def validate_content_type(self, value):
+        if media_kind(value) is None:
+            raise serializers.ValidationError("Only JPEG, PNG, GIF and WebP images and MP4, WebM and QuickTime videos can be uploaded.")
+        return value
+
+    def validate_size(self, value):
+        if not 0 < value <= settings.CHAT_MEDIA['MAX_SIZE']:
+            raise serializers.ValidationError(f"Files must be 1 to {settings.CHAT_MEDIA['MAX_SIZE']} bytes.")
+        return value
+
 class MessageSerializer(serializers.ModelSerializer):
     user = UserSerializer(read_only=True)
-    seen_by = serializers.PrimaryKeyRelatedField(many=True, read_only=True)
+    media = MediaAssetSerializer(read_only=True)
+    seen_by = serializers.SerializerMethodField()
 
     class Meta:
         model = Message
-        fields = ['id', 'user', 'text', 'message_type', 'seen_by', 'created_at']
+        fields = ['id', 'user', 'text', 'message_type', 'media', 'seen_by', 'created_at']
+
+    def get_seen_by(self, obj):
+        # A message that has just been written (or is still queued) cannot have been seen yet
+        if obj.pk is None or self.context.get('is_new'):
+            return []
+        # Read watermarks of the room, {user id: last read message id}
+        watermarks = self.context.get('watermarks', {})
+        return [
+            user_id for user_id, last_read in watermarks.items()
+            if last_read >= obj.pk and user_id != obj.user_id
+        ]
 
 class ChatRoomSerializer(serializers.ModelSerializer):
     messages = MessageSerializer(many=True, read_only=True)
@@ -43,6 +114,32 @@ class ChatRoomSerializer(serializers.ModelSerializer):
         model = ChatRoom
         fields = ['id', 'name', 'messages']
 
+class ConversationSerializer(serializers.ModelSerializer):
+    """
+    Serializer for the conversation list.
+
+    Only the denormalized summary of the last message is included, never the
+    room's history.
+    """
+
+    room_name = serializers.CharField(source='chat_room.name', read_only=True)
+    participants = UserSerializer(many=True, read_only=True)
+    last_message = serializers.SerializerMethodField()
+
+    class Meta:
+        model = Conversation
+        fields = ['id', 'room_name', 'participants', 'is_group', 'last_message', 'updated_at']
+
+    def get_last_message(self, obj):
+        if obj.last_message_at is None:
+            return None
+        sender = obj.last_message_sender
+        return {
+            'text': obj.last_message_text,
+            'user': {'id': sender.id, 'username': sender.username} if sender else None,
+            'created_at': serializers.DateTimeField().to_representation(obj.last_message_at),
+        }
+
 class MyTokenObtainPairSerializer(TokenObtainPairSerializer):
     """
     Custom token obtain pair serializer.
@@ -50,6 +147,17 @@ class MyTokenObtainPairSerializer(TokenObtainPairSerializer):
     This serializer is used to add additional user data to the token obtain pair response.
     """
 
+    @classmethod
+    def get_token(cls, user):
+        """
+        Add the username claim, so WebSocket connections can identify the user
+        from the access token alone (see core.middleware.JWTAuthMiddleware).
+        """
+
+        token = super().get_token(user)
+        token['username'] = user.username
+        return token
+
     def validate(self, attrs):
         """
         Validate the token obtain pair serializer data.
@@ -109,7 +217,7 @@ class RegistrationSerializer(serializers.ModelSerializer):
 
         validated_data['id'] = user.id
 
-        refresh_token = RefreshToken.for_user(user)
+        refresh_token = MyTokenObtainPairSerializer.get_token(user)
         access_token = str(refresh_token.access_token)
         validated_data['access_token'] = access_token
         validated_data['refresh_token'] = refresh_token
@@ -0,0 +1,85 @@
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_save
+from django.dispatch import receiver
+
+from .cache import invalidate, principals, room_ids, room_members
+from .history import room_history
+from .models import ChatRoom, Conversation, Message, User
+from .serializers import avatar_url
+
+
+@receiver(post_delete, sender=ChatRoom)
+def forget_room_id(sender, instance, **kwargs):
+    invalidate(room_ids, instance.name)
+    invalidate(room_members, instance.pk)
+    room_history.discard(instance.pk)
+
+
+@receiver(post_save, sender=Message)
+@receiver(post_delete, sender=Message)
+def forget_room_history(sender, instance, created=False, **kwargs):
+    # New messages are appended by the write path; edits and deletes refill from the database
+    if not created:
+        room_history.discard(instance.chat_room_id)
+
+
+@receiver(post_save, sender=Conversation)
+@receiver(post_delete, sender=Conversation)
+def forget_conversation_members(sender, instance, **kwargs):
+    invalidate(room_members, instance.chat_room_id)
+
+
+@receiver(m2m_changed, sender=Conversation.participants.through)
+def forget_participants(sender, instance, action, reverse, pk_set, **kwargs):
+    if not action.startswith('post_'):
+        return
+    if reverse:
+        # instance is a User; the affected conversations are in pk_set
+        conversations = Conversation.objects.all() if pk_set is None else Conversation.objects.filter(pk__in=pk_set)
+        for room_id in conversations.values_list('chat_room_id', flat=True):
+            invalidate(room_members, room_id)
+    else:
+        invalidate(room_members, instance.chat_room_id)
+
+
+@receiver(post_save, sender=User)
+def resolve_avatar_url(sender, instance, update_fields=None, **kwargs):
+    # Resolve a new profile picture's URL on write rather than on the first read
+    if update_fields is not None and 'profile_picture' not in update_fields:
+        return
+    if instance.profile_picture:
+        avatar_url(instance.profile_picture.public_id)
+
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def forget_principal(sender, instance, **kwargs):
+    # Picks up password changes and deactivation on the next request
+    invalidate(principals, instance.pk)
+
+
+# User fields embedded in cached messages
+MESSAGE_SENDER_FIELDS = ('username', 'profile_picture')
+
+
+def message_sender_values(username, profile_picture):
+    return username, getattr(profile_picture, 'public_id', profile_picture) or None
+
+
+@receiver(pre_save, sender=User)
+def remember_message_sender(sender, instance, update_fields=None, **kwargs):
+    if instance.pk is None or (update_fields is not None and not set(MESSAGE_SENDER_FIELDS) & set(update_fields)):
+        instance._message_sender = None
+        return
+    saved = User.objects.filter(pk=instance.pk).values_list(*MESSAGE_SENDER_FIELDS).first()
+    instance._message_sender = message_sender_values(*saved) if saved else None
+
+
+@receiver(post_save, sender=User)
+def forget_histories(sender, instance, created=False, **kwargs):
+    # Cached messages embed their sender's username and picture; only a change
+    # to those empties them, not e.g. the last_login update of every login
+    before = getattr(instance, '_message_sender', None)
+    if created or before is None:
+        return
+    if before != message_sender_values(*(getattr(instance, field) for field in MESSAGE_SENDER_FIELDS)):
+        room_history.clear()
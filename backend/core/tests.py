@@ -1,3 +1,1362 @@
-from django.test import TestCase
+import asyncio
+import functools
+import gzip
+import hashlib
+import io
+import json
+import os
+import tempfile
+import warnings
+from unittest import mock
 
-# Create your tests here.
+from asgiref.sync import sync_to_async
+from channels.layers import get_channel_layer
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from cloudinary import CloudinaryResource
+from django.conf import settings
+from django.core.files.storage import FileSystemStorage
+from django.core.management import call_command
+from django.db import connection, connections
+from django.test import RequestFactory, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+import msgpack
+from PIL import Image
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import AccessToken, RefreshToken
+
+from .authentication import CachedJWTAuthentication
+from .cache import LRUCache, avatar_urls, principals, room_ids, room_members, shared_caches
+from .consumers import ChatConsumer
+from .db import executor as db_executor
+from .encoding import SUBPROTOCOL_JSON, SUBPROTOCOL_MSGPACK, decode_frame, encode_frame, encode_packed
+from .history import RoomHistory, room_history
+from .media import executor as media_executor
+from .layers import BrokerChannelLayer, ChannelBroker, pack_frame
+from .metrics import Gauge, Histogram, _metrics
+from .middleware import TOKEN_SUBPROTOCOL_PREFIX, JWTAuthMiddleware, get_token_user
+from .models import ChatRoom, Conversation, MediaAsset, Message, ReadState, User
+from .outbound import SLOW_CONSUMER_CLOSE_CODE
+from .persistence import WriteBehindBuffer, get_read_buffer, reserve_message_ids, write_read_marks
+from .presence import BrokerPresence, PresenceRegistry
+from .routing import websocket_urlpatterns
+from .serializers import UserSerializer, avatar_url
+from .views import serve_media
+
+
+class ChatTestCase(TestCase):
+    """
+    Process-level caches are keyed by primary keys and room names, which the
+    rolled back test transactions hand out again.
+    """
+
+    def setUp(self):
+        for cache in (room_ids, room_members, room_history):
+            cache.clear()
+            self.addCleanup(cache.clear)
+
+
+class ConsumerTestCase(ChatTestCase):
+    """
+    Talks to the consumers through channels' test communicator, authenticated
+    with an access token like a browser.
+    """
+
+    application = JWTAuthMiddleware(URLRouter(websocket_urlpatterns))
+
+    def setUp(self):
+        super().setUp()
+        self.ana = User.objects.create(username='ana', email='ana@example.com')
+        self.bo = User.objects.create(username='bo', email='bo@example.com')
+        self.room_name = f'{self.ana.id}_{self.bo.id}'
+
+    async def connect(self, user, path=None, binary=False):
+        token = AccessToken.for_user(user)
+        token['username'] = user.username
+        communicator = WebsocketCommunicator(
+            self.application, path or f'/ws/chat/{self.room_name}/',
+            subprotocols=[SUBPROTOCOL_MSGPACK if binary else SUBPROTOCOL_JSON, TOKEN_SUBPROTOCOL_PREFIX + str(token)],
+        )
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        return communicator
+
+    async def receive(self, communicator):
+        frame = await communicator.receive_from(timeout=1)
+        return decode_frame(bytes_data=frame) if isinstance(frame, bytes) else decode_frame(frame)
+
+    async def log_queries(self, coroutine):
+        """
+        Await `coroutine`, returning its result and the SQL it ran on the
+        database thread.
+        """
+
+        statements = []
+
+        def log(execute, sql, params, many, context):
+            statements.append(sql)
+            return execute(sql, params, many, context)
+
+        await sync_to_async(lambda: connection.execute_wrappers.append(log))()
+        try:
+            result = await coroutine
+        finally:
+            await sync_to_async(lambda: connection.execute_wrappers.remove(log))()
+        return result, statements
+
+    async def drain(self, communicator):
+        """
+        Receive every frame that arrives until the connection goes quiet.
+        """
+
+        frames = []
+        while not await communicator.receive_nothing(timeout=0.1):
+            frames.append(await self.receive(communicator))
+        return frames
+
+    async def send_message(self, communicator, text):
+        await communicator.send_json_to({'text': text, 'messageType': 'text'})
+        return await self.receive(communicator)
+
+
+class ConnectionCacheTests(ConsumerTestCase):
+    def tables(self, statements, *tables):
+        return [sql for sql in statements if sql.startswith('SELECT') and any(f'"{table}"' in sql for table in tables)]
+
+    async def test_sending_does_not_look_up_room_or_sender_again(self):
+        communicator = await self.connect(self.ana)
+        await self.send_message(communicator, 'first')
+        _, statements = await self.log_queries(self.send_message(communicator, 'second'))
+        await communicator.disconnect()
+
+        self.assertEqual(self.tables(statements, 'core_chatroom', 'core_user', 'core_conversation_participants'), [])
+        self.assertTrue(any(sql.startswith('INSERT INTO "core_message"') for sql in statements))
+
+    async def test_room_id_is_resolved_once_per_process(self):
+        first = await self.connect(self.ana)
+        second, statements = await self.log_queries(self.connect(self.bo))
+        await first.disconnect()
+        await second.disconnect()
+
+        self.assertEqual(self.tables(statements, 'core_chatroom'), [])
+
+
+class BroadcastEncodingTests(ConsumerTestCase):
+    async def test_message_is_encoded_once_for_all_recipients(self):
+        communicators = [await self.connect(self.ana), await self.connect(self.bo), await self.connect(self.bo)]
+        with mock.patch('core.encoding.encode_frame', wraps=encode_frame) as encode:
+            await communicators[0].send_json_to({'text': 'hi', 'messageType': 'text'})
+            frames = [await communicator.receive_from(timeout=1) for communicator in communicators]
+        for communicator in communicators:
+            await communicator.disconnect()
+
+        self.assertEqual(len(set(frames)), 1)
+        self.assertEqual(decode_frame(frames[0])['text'], 'hi')
+        # One frame for the room group and one for the members' inboxes
+        self.assertEqual(encode.call_count, 2)
+
+    async def test_msgpack_is_only_encoded_for_binary_recipients(self):
+        communicators = [await self.connect(self.ana), await self.connect(self.bo)]
+        with mock.patch('core.encoding.encode_packed', wraps=encode_packed) as pack:
+            await self.send_message(communicators[0], 'hi')
+            await self.receive(communicators[1])
+        self.assertEqual(pack.call_count, 0)
+
+        communicators += [await self.connect(self.bo, binary=True), await self.connect(self.bo, binary=True)]
+        with mock.patch('core.encoding.encode_packed', wraps=encode_packed) as pack:
+            await communicators[0].send_json_to({'text': 'hello', 'messageType': 'text'})
+            frames = [await communicator.receive_from(timeout=1) for communicator in communicators]
+        for communicator in communicators:
+            await communicator.disconnect()
+
+        # Converted once for both binary connections
+        self.assertEqual(pack.call_count, 1)
+        self.assertEqual(frames[2], frames[3])
+        self.assertIsInstance(frames[2], bytes)
+        self.assertEqual(decode_frame(bytes_data=frames[2]), decode_frame(frames[0]))
+        self.assertEqual(msgpack.unpackb(frames[2])['x'], 'hello')
+
+
+class InboxFanoutTests(ConsumerTestCase):
+    def setUp(self):
+        super().setUp()
+        self.carol = User.objects.create(username='carol', email='carol@example.com')
+
+    async def test_messages_reach_the_inboxes_of_participants_only(self):
+        inboxes = {
+            user.username: await self.connect(user, '/ws/chat/global/')
+            for user in (self.ana, self.bo, self.carol)
+        }
+        room = await self.connect(self.ana)
+        for inbox in inboxes.values():
+            await self.drain(inbox)
+
+        message = await self.send_message(room, 'hi')
+        received = {username: await self.drain(inbox) for username, inbox in inboxes.items()}
+        await room.disconnect()
+        for inbox in inboxes.values():
+            await inbox.disconnect()
+
+        expected = {'type': 'global_message', 'room_name': self.room_name, 'message': message}
+        self.assertIn(expected, received['ana'])
+        self.assertIn(expected, received['bo'])
+        self.assertNotIn('global_message', [frame['type'] for frame in received['carol']])
+
+
+class ReadMarkTests(ConsumerTestCase):
+    def setUp(self):
+        super().setUp()
+        self.elsewhere = Message.objects.create(
+            chat_room=ChatRoom.objects.create(name='elsewhere'), user=self.ana, text='hi'
+        )
+
+    async def test_marks_of_messages_outside_the_room_are_ignored(self):
+        communicator = await self.connect(self.bo)
+        message = await self.send_message(communicator, 'hi')
+        for message_id in (self.elsewhere.id, 2 ** 70, message['id']):
+            await communicator.send_json_to({'type': 'read', 'messageId': message_id})
+        with self.assertLogs('core.consumers', 'ERROR'):
+            frames = await self.drain(communicator)
+        await get_read_buffer().flush()
+        await communicator.disconnect()
+
+        self.assertEqual(frames, [{'type': 'read', 'user': self.bo.id, 'messageId': message['id']}])
+        state = await ReadState.objects.aget(user=self.bo, chat_room__name=self.room_name)
+        self.assertEqual(state.last_read_message_id, message['id'])
+
+    def test_marks_are_written_for_their_own_reader_and_room(self):
+        room = self.elsewhere.chat_room
+        other = ChatRoom.objects.create(name='other')
+        for user, chat_room in ((self.ana, room), (self.ana, other), (self.bo, room), (self.bo, other)):
+            ReadState.objects.create(user=user, chat_room=chat_room)
+
+        write_read_marks([(self.ana.id, room.id, 5), (self.bo.id, other.id, 7), (self.ana.id, room.id, 3)])
+
+        marks = {
+            (state.user_id, state.chat_room_id): state.last_read_message_id for state in ReadState.objects.all()
+        }
+        self.assertEqual(marks, {
+            (self.ana.id, room.id): 5, (self.ana.id, other.id): 0,
+            (self.bo.id, room.id): 0, (self.bo.id, other.id): 7,
+        })
+
+
+class UnreadCountTests(ChatTestCase):
+    def test_marks_recount_messages_after_the_watermark(self):
+        ana = User.objects.create(username='ana', email='ana@example.com')
+        bo = User.objects.create(username='bo', email='bo@example.com')
+        room = ChatRoom.objects.create(name='unread')
+        ReadState.objects.create(user=bo, chat_room=room, unread_count=3)
+        ids = [Message.objects.create(chat_room=room, user=ana, text=str(index)).id for index in range(3)]
+        # bo's own messages are never unread for bo
+        Message.objects.create(chat_room=room, user=bo, text='mine')
+
+        write_read_marks([(bo.id, room.id, ids[0]), (ana.id, room.id, ids[2])])
+
+        counts = dict(ReadState.objects.values_list('user_id', 'unread_count'))
+        self.assertEqual(counts, {bo.id: 2, ana.id: 1})
+
+
+class DirectConversationTests(ConsumerTestCase):
+    def setUp(self):
+        super().setUp()
+        self.carol = User.objects.create(username='carol', email='carol@example.com')
+
+    async def participants(self, room_name):
+        return {
+            user_id async for user_id in Conversation.participants.through.objects
+            .filter(conversation__chat_room__name=room_name).values_list('user_id', flat=True)
+        }
+
+    async def test_only_a_participant_creates_the_conversation(self):
+        communicator = await self.connect(self.carol)
+        await communicator.disconnect()
+        self.assertEqual(await self.participants(self.room_name), set())
+
+        communicator = await self.connect(self.bo)
+        await communicator.disconnect()
+        self.assertEqual(await self.participants(self.room_name), {self.ana.id, self.bo.id})
+        self.assertFalse(await Conversation.objects.filter(is_group=True).aexists())
+
+    async def test_group_conversations_are_not_created_on_connect(self):
+        room_name = f'{self.ana.id}_{self.bo.id}_{self.carol.id}'
+        communicator = await self.connect(self.ana, f'/ws/chat/{room_name}/')
+        await communicator.disconnect()
+        self.assertFalse(await Conversation.objects.aexists())
+
+
+class SlowConsumerTests(ConsumerTestCase):
+    async def overflow(self, message_ids):
+        """
+        Feed `message_ids` to a ChatConsumer whose client stalls after the
+        first frame, and return the resume hint it is dropped with.
+        """
+
+        consumer = ChatConsumer()
+        consumer.outbound_max = 2
+        consumer.replayed_ids = set()
+        delivered, hints = [], []
+
+        async def send_encoded(frame):
+            payload = json.loads(frame)
+            if payload['type'] == 'resume':
+                hints.append(payload)
+                return
+            if delivered:
+                # The client stops reading
+                await asyncio.Event().wait()
+            delivered.append(payload)
+
+        consumer.send_encoded = send_encoded
+        consumer.close = mock.AsyncMock()
+        for message_id in message_ids:
+            await consumer.chat_message({'type': 'chat_message', 'message_id': message_id, 'frame': '{"type": "message"}'})
+            # Let the outbound task write what it can
+            await asyncio.sleep(0)
+        consumer.close.assert_awaited_once_with(code=SLOW_CONSUMER_CLOSE_CODE)
+        return hints
+
+    async def test_full_daphne_write_buffer_fills_the_queue(self):
+        class Protocol:
+            def registerProducer(self, producer, streaming):
+                self.producer = producer
+
+        async def handle_reply(protocol, message):
+            written.append(json.loads(message['text']))
+
+        written, protocol = [], Protocol()
+        consumer = ChatConsumer()
+        consumer.outbound_max = 2
+        consumer.replayed_ids = set()
+        consumer.base_send = functools.partial(handle_reply, protocol)
+        consumer.close = mock.AsyncMock()
+
+        async def deliver(*message_ids):
+            for message_id in message_ids:
+                await consumer.chat_message({'type': 'chat_message', 'message_id': message_id, 'frame': json.dumps({'id': message_id})})
+                await asyncio.sleep(0)
+
+        await deliver(1)
+        # The transport's buffer is full until Twisted resumes the producer
+        protocol.producer.pauseProducing()
+        await deliver(2, 3)
+        self.assertEqual(written, [{'id': 1}])
+        protocol.producer.resumeProducing()
+        await asyncio.sleep(0)
+        self.assertEqual(written, [{'id': 1}, {'id': 2}, {'id': 3}])
+
+        protocol.producer.pauseProducing()
+        await deliver(4, 5, 6)
+        consumer.close.assert_awaited_once_with(code=SLOW_CONSUMER_CLOSE_CODE)
+        self.assertEqual(written[3:], [{'type': 'resume', 'since': 3}])
+
+    async def test_resume_after_overflow_replays_undelivered_messages(self):
+        sender = await self.connect(self.ana)
+        ids = [(await self.send_message(sender, f'message {n}'))['id'] for n in range(5)]
+        await sender.disconnect()
+
+        # Only the first message reaches the client before its queue overflows
+        hints = await self.overflow(ids)
+        self.assertEqual(hints, [{'type': 'resume', 'since': ids[0]}])
+
+        communicator = await self.connect(self.bo, f'/ws/chat/{self.room_name}/?since={hints[0]["since"]}')
+        history = await self.drain(communicator)
+        await communicator.disconnect()
+        self.assertEqual([message['id'] for frame in history for message in frame['messages']], ids[1:])
+
+
+@override_settings(CHAT_REPLAY={'CHUNK_SIZE': 2, 'MAX_MESSAGES': 1000})
+class ReplayTests(ConsumerTestCase):
+    def ids(self, frames):
+        ids = []
+        for frame in frames:
+            ids += [message['id'] for message in frame['messages']] if frame.get('type') == 'history' else [frame['id']]
+        return ids
+
+    async def test_reconnect_has_no_gaps_or_duplicates(self):
+        sender = await self.connect(self.ana)
+        reader = await self.connect(self.bo)
+        seen = [(await self.send_message(sender, 'before'))['id']]
+        self.assertEqual(self.ids(await self.drain(reader)), seen)
+        await reader.disconnect()
+
+        missed = [(await self.send_message(sender, f'missed {n}'))['id'] for n in range(5)]
+        reader = await self.connect(self.bo, f'/ws/chat/{self.room_name}/?since={seen[-1]}')
+        frames = await self.drain(reader)
+        self.assertEqual([frame['done'] for frame in frames], [False, False, True])
+
+        # A live copy of a replayed message is not sent again
+        await get_channel_layer().group_send(f'chat_{self.room_name}', {
+            'type': 'chat_message', 'message_id': missed[-1], 'frame': encode_frame({'id': missed[-1], 'text': 'missed 4'}),
+        })
+        await self.drain(sender)
+        live = (await self.send_message(sender, 'after'))['id']
+        frames += await self.drain(reader)
+        await sender.disconnect()
+        await reader.disconnect()
+
+        self.assertEqual(self.ids(frames), missed + [live])
+
+    async def test_live_messages_below_the_replayed_ids_are_delivered(self):
+        sender = await self.connect(self.ana)
+        ids = [(await self.send_message(sender, f'message {n}'))['id'] for n in range(3)]
+        reader = await self.connect(self.bo, f'/ws/chat/{self.room_name}/?since={ids[0]}')
+        await self.drain(reader)
+
+        # Written behind, after messages with higher ids were replayed
+        await get_channel_layer().group_send(f'chat_{self.room_name}', {
+            'type': 'chat_message', 'message_id': ids[0], 'frame': encode_frame({'id': ids[0], 'text': 'late'}),
+        })
+        frames = await self.drain(reader)
+        await sender.disconnect()
+        await reader.disconnect()
+        self.assertEqual(self.ids(frames), [ids[0]])
+
+    async def test_truncated_only_when_messages_are_left(self):
+        sender = await self.connect(self.ana)
+        ids = [(await self.send_message(sender, f'message {n}'))['id'] for n in range(5)]
+        await sender.disconnect()
+
+        for max_messages, truncated in ((4, False), (3, True)):
+            with self.settings(CHAT_REPLAY={'CHUNK_SIZE': 2, 'MAX_MESSAGES': max_messages}):
+                reader = await self.connect(self.bo, f'/ws/chat/{self.room_name}/?since={ids[0]}')
+                frames = await self.drain(reader)
+                await reader.disconnect()
+            self.assertEqual(self.ids(frames), ids[1:1 + max_messages])
+            self.assertEqual(frames[-1]['truncated'], truncated)
+
+    async def test_last_replays_the_newest_messages(self):
+        sender = await self.connect(self.ana)
+        ids = [(await self.send_message(sender, f'message {n}'))['id'] for n in range(3)]
+        await sender.disconnect()
+
+        reader = await self.connect(self.bo, f'/ws/chat/{self.room_name}/?last=2')
+        frames = await self.drain(reader)
+        await reader.disconnect()
+        self.assertEqual(self.ids(frames), ids[1:])
+        self.assertTrue(frames[-1]['done'])
+
+
+class MediaMessageTests(ConsumerTestCase):
+    def asset(self, user, sha256, status=MediaAsset.READY):
+        return MediaAsset.objects.create(
+            sha256=sha256, kind='image', content_type='image/png', size=1, file=f'media/{sha256}.png',
+            uploaded_by=user, status=status,
+        )
+
+    async def test_only_visible_ready_media_can_be_sent(self):
+        eve = await sync_to_async(User.objects.create)(username='eve', email='eve@example.com')
+        own = await sync_to_async(self.asset)(self.ana, 'a' * 64)
+        other = await sync_to_async(self.asset)(eve, 'e' * 64)
+        processing = await sync_to_async(self.asset)(self.ana, 'b' * 64, MediaAsset.PROCESSING)
+        failed = await sync_to_async(self.asset)(self.ana, 'c' * 64, MediaAsset.FAILED)
+        communicator = await self.connect(self.ana)
+
+        for asset in (other, processing, failed):
+            await communicator.send_json_to({'text': '', 'messageType': 'image', 'mediaId': asset.id})
+            self.assertTrue(await communicator.receive_nothing(timeout=0.1))
+        await communicator.send_json_to({'text': '', 'messageType': 'image', 'mediaId': own.id})
+        message = await self.receive(communicator)
+        await communicator.disconnect()
+        self.assertEqual(message['media']['id'], own.id)
+
+
+class WriteBehindTests(ConsumerTestCase):
+    @override_settings(CHAT_WRITE_BEHIND={**settings.CHAT_WRITE_BEHIND, 'ENABLED': True})
+    async def test_queued_messages_are_broadcast_with_their_ids(self):
+        communicator = await self.connect(self.ana)
+        await communicator.send_json_to({'text': 'hi', 'messageType': 'text'})
+        await communicator.send_json_to({'text': 'there', 'messageType': 'text'})
+        first, second = await self.receive(communicator), await self.receive(communicator)
+        await communicator.disconnect()
+
+        self.assertLess(first['id'], second['id'])
+        written = [message async for message in Message.objects.order_by('id').values_list('id', 'text')]
+        self.assertEqual(written, [(first['id'], 'hi'), (second['id'], 'there')])
+
+    def test_reserved_ids_are_not_reused(self):
+        reserved = reserve_message_ids(3)
+        room = ChatRoom.objects.create(name='ids')
+        message = Message.objects.create(chat_room=room, user=self.ana, text='hi')
+        self.assertEqual(reserved, sorted(set(reserved)))
+        self.assertGreater(message.id, reserved[-1])
+
+
+class WriteBehindBufferTests(SimpleTestCase):
+    async def test_failed_batch_is_written_one_by_one(self):
+        written = []
+
+        def write(batch):
+            if 'bad' in batch:
+                raise ValueError('bad item')
+            written.extend(batch)
+
+        buffer = WriteBehindBuffer(write, batch_size=10)
+        for item in ('a', 'bad', 'b'):
+            buffer.put(item)
+        with self.assertLogs('core.persistence', 'ERROR'):
+            await buffer.flush()
+        self.assertEqual(written, ['a', 'b'])
+
+
+class DatabaseThreadTests(SimpleTestCase):
+    databases = {'default'}
+
+    def test_only_the_pool_threads_keep_their_connections(self):
+        def pooled():
+            connection = connections['default']
+            connection.ensure_connection()
+            try:
+                return connection.settings_dict['CONN_MAX_AGE'], connection.close_at is not None
+            finally:
+                connection.close()
+
+        self.assertEqual(db_executor.submit(pooled).result(), (settings.CHAT_DB_CONN_MAX_AGE, True))
+        self.assertEqual(settings.DATABASES['default']['CONN_MAX_AGE'], 0)
+        self.assertEqual(connections['default'].settings_dict['CONN_MAX_AGE'], 0)
+
+
+class MessageListTests(ChatTestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = User.objects.create(username='ana', email='ana@example.com')
+        room = ChatRoom.objects.create(name='history')
+        self.ids = [Message.objects.create(chat_room=room, user=self.user, text=str(index)).id for index in range(5)]
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def page(self, query=''):
+        response = self.client.get(f'/api/messages/history/{query}')
+        self.assertEqual(response.status_code, 200)
+        return [message['id'] for message in response.data['results']], response.data['before'], response.data['after']
+
+    def test_pages_walk_back_newest_first(self):
+        ids = self.ids[::-1]
+        self.assertEqual(self.page('?limit=2'), (ids[:2], ids[1], None))
+        self.assertEqual(self.page(f'?limit=2&before={ids[1]}'), (ids[2:4], ids[3], ids[2]))
+        self.assertEqual(self.page(f'?limit=2&before={ids[3]}'), (ids[4:], None, ids[4]))
+
+    def test_after_scrolls_forward(self):
+        ids = self.ids[::-1]
+        self.assertEqual(self.page(f'?limit=2&after={ids[4]}'), (ids[2:4], ids[3], ids[2]))
+        self.assertEqual(self.page(f'?limit=2&after={ids[1]}'), (ids[:1], ids[0], None))
+
+    def test_ties_on_created_at_are_broken_by_id(self):
+        Message.objects.update(created_at=Message.objects.first().created_at)
+        ids = self.ids[::-1]
+        self.assertEqual(self.page(f'?limit=2&before={ids[1]}')[0], ids[2:4])
+
+    def test_invalid_cursors(self):
+        self.assertEqual(self.client.get('/api/messages/history/?limit=0').status_code, 400)
+        self.assertEqual(self.client.get('/api/messages/history/?before=1&after=2').status_code, 400)
+        self.assertEqual(self.client.get(f'/api/messages/history/?before={self.ids[-1] + 100}').status_code, 404)
+
+
+class UserListTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create(username='ana', email='ana@example.com')
+        for username in ('bea', 'Bob', 'carl', 'dan', 'jacob'):
+            User.objects.create(username=username, email=f'{username}@example.com')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def get(self, url, etag=None):
+        return self.client.get(url, headers={'If-None-Match': etag} if etag else None)
+
+    def test_pages_walk_the_directory_without_the_requesting_user(self):
+        usernames, url = [], '/api/user/list/?limit=2'
+        while url:
+            response = self.get(url)
+            self.assertEqual(response.status_code, 200)
+            self.assertLessEqual(len(response.data['results']), 2)
+            usernames += [user['username'] for user in response.data['results']]
+            url = response.data['next']
+        self.assertEqual(usernames, sorted(['bea', 'Bob', 'carl', 'dan', 'jacob']))
+
+    def test_search_matches_the_start_of_usernames_in_any_case(self):
+        response = self.get('/api/user/list/?search=B')
+        self.assertEqual({user['username'] for user in response.data['results']}, {'bea', 'Bob'})
+        response = self.get('/api/user/list/?search=ob')
+        self.assertEqual(response.data['results'], [])
+
+    def test_unchanged_page_is_not_sent_again(self):
+        response = self.get('/api/user/list/')
+        etag = response['ETag']
+        self.assertTrue(etag)
+
+        response = self.get('/api/user/list/', etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+        self.assertFalse(response.content)
+
+        User.objects.filter(username='dan').update(is_online=True)
+        response = self.get('/api/user/list/', etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+
+class CachedJWTAuthenticationTests(TestCase):
+    def setUp(self):
+        principals.clear()
+        self.user = User.objects.create(username='ana', email='ana@example.com')
+        self.refresh = RefreshToken.for_user(self.user)
+
+    def authenticate(self):
+        request = RequestFactory().get('/', headers={'Authorization': f'Bearer {self.refresh.access_token}'})
+        user, _ = CachedJWTAuthentication().authenticate(request)
+        return user
+
+    def test_repeat_requests_do_not_load_the_user(self):
+        self.assertEqual(self.authenticate(), self.user)
+        with self.assertNumQueries(0):
+            user = self.authenticate()
+        self.assertEqual(user, self.user)
+        # Each request gets its own copy
+        self.assertIsNot(user, self.authenticate())
+
+    def test_saving_the_user_drops_the_cached_user(self):
+        self.authenticate()
+        self.user.username = 'anna'
+        self.user.save()
+        with self.assertNumQueries(1):
+            self.assertEqual(self.authenticate().username, 'anna')
+
+    def test_logging_out_drops_the_cached_user(self):
+        self.authenticate()
+        client = APIClient()
+        client.cookies[settings.SIMPLE_JWT['AUTH_COOKIE_REFRESH']] = str(self.refresh)
+        response = client.post('/api/user/logout/')
+        self.assertEqual(response.status_code, 200)
+        self.assertIsNone(principals.get(self.user.id))
+
+
+class MessageSearchTests(ChatTestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = User.objects.create(username='ana', email='ana@example.com')
+        other = User.objects.create(username='bo', email='bo@example.com')
+        self.room = ChatRoom.objects.create(name='mine')
+        Conversation.objects.create(chat_room=self.room).participants.add(self.user, other)
+        hidden = ChatRoom.objects.create(name='theirs')
+        Conversation.objects.create(chat_room=hidden).participants.add(other)
+        Message.objects.create(chat_room=hidden, user=other, text='lunch plans')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def message(self, text):
+        return Message.objects.create(chat_room=self.room, user=self.user, text=text).id
+
+    def search(self, query):
+        response = self.client.get(f'/api/search/messages/{query}')
+        self.assertEqual(response.status_code, 200)
+        return [item['id'] for item in response.data['results']], response.data['next']
+
+    def test_only_the_callers_rooms_are_searched(self):
+        lunch = self.message('lunch at noon?')
+        self.message('see you tomorrow')
+        self.assertEqual(self.search('?q=lunch'), ([lunch], None))
+        self.assertEqual(self.client.get('/api/search/messages/?q=lunch').data['results'][0]['room_name'], 'mine')
+
+    def test_better_matches_rank_first(self):
+        once = self.message('lunch and a long list of other things to talk about today')
+        twice = self.message('lunch lunch')
+        self.assertEqual(self.search('?q=lunch')[0], [twice, once])
+
+    def test_pages_have_no_gaps_or_duplicates(self):
+        # Equal texts rank the same, so pages are ordered by id
+        ids = [self.message('lunch') for _ in range(5)][::-1]
+        found, cursor = self.search('?q=lunch&limit=2')
+        pages = [found]
+        while cursor:
+            found, cursor = self.search(f'?q=lunch&limit=2&cursor={cursor}')
+            pages.append(found)
+        self.assertEqual(pages, [ids[:2], ids[2:4], ids[4:]])
+
+    def test_edits_and_deletes_update_the_index(self):
+        message_id = self.message('lunch')
+        Message.objects.filter(id=message_id).update(text='dinner')
+        self.assertEqual(self.search('?q=lunch')[0], [])
+        self.assertEqual(self.search('?q=dinner')[0], [message_id])
+        Message.objects.filter(id=message_id).delete()
+        self.assertEqual(self.search('?q=dinner')[0], [])
+
+    def test_query_syntax_is_matched_literally(self):
+        message_id = self.message('is "NEAR" a keyword OR not')
+        self.assertEqual(self.search('?q=%22near%22%20OR')[0], [message_id])
+        self.assertEqual(self.search('?q=NEAR(a')[0], [message_id])
+        self.assertEqual(self.search('?q=keyword%20AND%20lunch')[0], [])
+
+    def test_invalid_parameters(self):
+        self.assertEqual(self.client.get('/api/search/messages/').status_code, 400)
+        self.assertEqual(self.client.get('/api/search/messages/?q=lunch&limit=x').status_code, 400)
+        self.assertEqual(self.client.get('/api/search/messages/?q=lunch&cursor=nope').status_code, 400)
+
+
+class MessageHistoryCacheTests(ConsumerTestCase):
+    def setUp(self):
+        super().setUp()
+        self.client = APIClient()
+        self.client.force_authenticate(self.ana)
+
+    def page(self):
+        response = self.client.get(f'/api/messages/{self.room_name}/')
+        self.assertEqual(response.status_code, 200)
+        return response.data['results']
+
+    async def test_direct_room_opened_over_rest_gets_its_conversation(self):
+        # A room without a Conversation yet, as left by someone else trying to join it
+        await sync_to_async(ChatRoom.objects.create)(name=self.room_name)
+        await sync_to_async(self.page)()
+        communicator = await self.connect(self.ana)
+        await communicator.disconnect()
+
+        conversation = await sync_to_async(Conversation.objects.get)(chat_room__name=self.room_name)
+        participants = await sync_to_async(lambda: {user.id for user in conversation.participants.all()})()
+        self.assertEqual(participants, {self.ana.id, self.bo.id})
+
+    def test_newest_page_is_served_from_the_room_history(self):
+        room = ChatRoom.objects.create(name=self.room_name)
+        Conversation.objects.create(chat_room=room).participants.add(self.ana, self.bo)
+        message = Message.objects.create(chat_room=room, user=self.bo, text='hi')
+
+        self.assertEqual([item['text'] for item in self.page()], ['hi'])
+        with self.assertNumQueries(0):
+            self.assertEqual([item['text'] for item in self.page()], ['hi'])
+
+        # Edits refill it from the database
+        message.text = 'hello'
+        message.save()
+        self.assertEqual([item['text'] for item in self.page()], ['hello'])
+
+    def test_histories_are_only_emptied_when_a_sender_changes(self):
+        room = ChatRoom.objects.create(name=self.room_name)
+        Conversation.objects.create(chat_room=room).participants.add(self.ana, self.bo)
+        Message.objects.create(chat_room=room, user=self.bo, text='hi')
+        self.page()
+
+        self.bo.last_login = timezone.now()
+        self.bo.save()
+        self.assertIsNotNone(room_history.get(room.pk, 1))
+
+        self.bo.username = 'bob'
+        self.bo.save()
+        self.assertIsNone(room_history.get(room.pk, 1))
+        self.assertEqual(self.page()[0]['user']['username'], 'bob')
+
+
+class BrokerChannelLayerTests(SimpleTestCase):
+    """
+    Two BrokerChannelLayer instances stand in for two worker processes sharing
+    an in-process broker.
+    """
+
+    async def start_workers(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        path = os.path.join(directory.name, 'broker.sock')
+        self.broker = ChannelBroker(path)
+        server = await self.broker.start()
+        first, second = BrokerChannelLayer(path), BrokerChannelLayer(path)
+
+        async def stop():
+            await first.close()
+            await second.close()
+            # Let the broker see both connections close before shutting down
+            await asyncio.sleep(0.01)
+            server.close()
+            await server.wait_closed()
+
+        return first, second, stop
+
+    async def receive(self, layer, channel):
+        return await asyncio.wait_for(layer.receive(channel), timeout=1)
+
+    async def test_group_send_reaches_every_worker(self):
+        first, second, stop = await self.start_workers()
+        try:
+            channels = [
+                (first, await first.new_channel()),
+                (second, await second.new_channel()),
+                (second, await second.new_channel()),
+            ]
+            for layer, channel in channels:
+                await layer.group_add('chat_room', channel)
+
+            await first.group_send('chat_room', {'type': 'chat_message', 'frame': '{}'})
+
+            for layer, channel in channels:
+                message = await self.receive(layer, channel)
+                self.assertEqual(message, {'type': 'chat_message', 'frame': '{}'})
+        finally:
+            await stop()
+
+    async def test_send_to_channel_of_another_worker(self):
+        first, second, stop = await self.start_workers()
+        try:
+            channel = await second.new_channel()
+            await first.send(channel, {'type': 'presence_expired'})
+            self.assertEqual(await self.receive(second, channel), {'type': 'presence_expired'})
+        finally:
+            await stop()
+
+    async def test_group_discard(self):
+        first, second, stop = await self.start_workers()
+        try:
+            kept, dropped = await second.new_channel(), await second.new_channel()
+            await second.group_add('chat_room', kept)
+            await second.group_add('chat_room', dropped)
+            await second.group_discard('chat_room', dropped)
+
+            await first.group_send('chat_room', {'type': 'chat_message'})
+
+            self.assertEqual(await self.receive(second, kept), {'type': 'chat_message'})
+            with self.assertRaises(asyncio.TimeoutError):
+                await asyncio.wait_for(second.receive(dropped), timeout=0.1)
+        finally:
+            await stop()
+
+    async def test_groups_of_closed_worker_are_forgotten(self):
+        first, second, stop = await self.start_workers()
+        try:
+            channel = await second.new_channel()
+            await second.group_add('chat_room', channel)
+            await second.close()
+            await asyncio.sleep(0.01)
+
+            # Reconnecting replays the worker's memberships
+            await first.group_send('chat_room', {'type': 'chat_message', 'n': 1})
+            await second.group_add('chat_global', channel)
+            await first.group_send('chat_room', {'type': 'chat_message', 'n': 2})
+
+            self.assertEqual(await self.receive(second, channel), {'type': 'chat_message', 'n': 2})
+        finally:
+            await stop()
+
+    async def test_only_receiving_channels_have_queues(self):
+        first, second, stop = await self.start_workers()
+        try:
+            channel = await second.new_channel()
+            # Kept until the consumer starts receiving
+            await first.send(channel, {'type': 'chat_message', 'n': 1})
+            self.assertEqual(await self.receive(second, channel), {'type': 'chat_message', 'n': 1})
+
+            # The consumer disconnects, which cancels its receive
+            receiving = asyncio.ensure_future(second.receive(channel))
+            await asyncio.sleep(0)
+            receiving.cancel()
+            await asyncio.gather(receiving, return_exceptions=True)
+            self.assertNotIn(channel, second.channels)
+
+            unknown = channel.replace('!', '!unknown')
+            for target in (channel, unknown):
+                await first.send(target, {'type': 'chat_message', 'n': 2})
+            # Delivered after the messages above, so those have been handled by now
+            fresh = await second.new_channel()
+            await first.send(fresh, {'type': 'chat_message', 'n': 3})
+            self.assertEqual(await self.receive(second, fresh), {'type': 'chat_message', 'n': 3})
+            self.assertNotIn(channel, second.channels)
+            self.assertNotIn(unknown, second.channels)
+        finally:
+            await stop()
+
+    async def test_group_add_fails_without_an_ack(self):
+        first, second, stop = await self.start_workers()
+        try:
+            channel = await first.new_channel()
+            first.group_add_timeout = 0.1
+            with mock.patch('core.layers.pack_frame', side_effect=lambda *frame: pack_frame(*frame[:3])):
+                with self.assertRaises(asyncio.TimeoutError), self.assertLogs('core.layers', 'ERROR'):
+                    await first.group_add('chat_room', channel)
+            self.assertNotIn('chat_room', first.groups)
+        finally:
+            await stop()
+
+    async def test_invalidation_reaches_every_worker(self):
+        first, second, stop = await self.start_workers()
+        cache = LRUCache(name='test_members')
+        self.addCleanup(shared_caches.pop, 'test_members')
+        try:
+            # Both workers are connected to the broker
+            await first.new_channel()
+            await second.new_channel()
+            cache.set(1, frozenset({1, 2}))
+            cache.set(2, frozenset({1, 3}))
+
+            await sync_to_async(first.publish_invalidation, thread_sensitive=False)('test_members', 1)
+            for _ in range(100):
+                if cache.get(1) is None:
+                    break
+                await asyncio.sleep(0.01)
+            self.assertIsNone(cache.get(1))
+            self.assertEqual(cache.get(2), frozenset({1, 3}))
+        finally:
+            await stop()
+
+    async def test_presence_is_shared_by_workers(self):
+        first, second, stop = await self.start_workers()
+        registry = self.broker.presence = PresenceRegistry(tick=0.05, interval=60, layer=self.broker)
+        try:
+            watcher, tab, other_tab = await first.new_channel(), await first.new_channel(), await second.new_channel()
+            await first.group_add('chat_global', watcher)
+
+            await BrokerPresence(first).join(tab, 1, 'ana')
+            snapshot = await self.receive(first, tab)
+            self.assertEqual(json.loads(snapshot['frame']), {'type': 'presence_snapshot', 'online': ['ana']})
+            await BrokerPresence(second).join(other_tab, 1, 'ana')
+            self.assertEqual(json.loads((await self.receive(first, watcher))['frame'])['online'], ['ana'])
+
+            # Closing one of the tabs leaves the user online
+            await BrokerPresence(first).leave(tab)
+            with self.assertRaises(asyncio.TimeoutError):
+                await asyncio.wait_for(first.receive(watcher), timeout=0.2)
+
+            # The worker with the other tab goes away
+            await second.close()
+            diff = json.loads((await self.receive(first, watcher))['frame'])
+            self.assertEqual((diff['online'], diff['offline']), ([], ['ana']))
+        finally:
+            registry._task.cancel()
+            await stop()
+
+
+class PresenceRegistryTests(SimpleTestCase):
+    def registry(self):
+        # The sweeper task started by connect() is cancelled with the test's event loop
+        return PresenceRegistry(timeout=90, interval=60, tick=60)
+
+    async def test_user_goes_offline_with_their_last_connection(self):
+        registry = self.registry()
+        registry.connect('tab1', 1, 'ana')
+        registry.connect('tab2', 1, 'ana')
+        self.assertEqual(registry.take_diff(), (['ana'], []))
+
+        self.assertIsNone(registry.disconnect('tab1'))
+        self.assertEqual(registry.take_diff(), ([], []))
+        self.assertEqual(registry.disconnect('tab2'), 'ana')
+        self.assertEqual(registry.take_diff(), ([], ['ana']))
+
+    async def test_flapping_within_a_tick_is_left_out(self):
+        registry = self.registry()
+        registry.connect('tab1', 1, 'ana')
+        registry.disconnect('tab1')
+        registry.connect('tab2', 2, 'bo')
+        self.assertEqual(registry.take_diff(), (['bo'], []))
+
+    async def test_sweep_expires_connections_without_heartbeat(self):
+        registry = self.registry()
+        with mock.patch('core.presence.time.monotonic', return_value=1000):
+            registry.connect('tab1', 1, 'ana')
+            registry.connect('tab2', 2, 'bo')
+        with mock.patch('core.presence.time.monotonic', return_value=1050):
+            registry.heartbeat('tab2')
+        with mock.patch('core.presence.time.monotonic', return_value=1100):
+            self.assertEqual(registry.sweep(), (['tab1'], ['ana']))
+        self.assertEqual(registry.online_usernames(), ['bo'])
+
+
+class ChatBenchTests(TransactionTestCase):
+    def test_benchmark_runs_and_cleans_up(self):
+        existing = User.objects.create(username='chatbench0', email='chatbench0@example.com')
+        room = ChatRoom.objects.create(name='chatbench_r0')
+        out = io.StringIO()
+        call_command('chatbench', clients=4, rooms=2, messages=3, stdout=out)
+
+        output = out.getvalue()
+        self.assertIn('messages_sent: 12', output)
+        # Every message reaches both members of its room, and both of their inboxes
+        self.assertIn(' frames_delivered: 24', output)
+        self.assertIn('global_connections: 4', output)
+        self.assertIn('inbox_frames_delivered: 24', output)
+        self.assertNotIn('inbox_p50_ms: None', output)
+        # Only the benchmark's own users and rooms are deleted
+        self.assertEqual(list(User.objects.filter(username__startswith='chatbench')), [existing])
+        self.assertEqual(list(ChatRoom.objects.filter(name__startswith='chatbench')), [room])
+
+
+class MetricsTests(SimpleTestCase):
+    def setUp(self):
+        self.registered = len(_metrics)
+
+    def tearDown(self):
+        # Keep the test metrics out of the process-wide registry
+        del _metrics[self.registered:]
+
+    def test_histogram_buckets_are_cumulative(self):
+        histogram = Histogram('test_seconds', 'Test.', buckets=(0.1, 1))
+        histogram.observe(0.05, handler='receive')
+        histogram.observe(0.5, handler='receive')
+        histogram.observe(2, handler='receive')
+
+        self.assertEqual(list(histogram.samples()), [
+            'test_seconds_bucket{handler="receive",le="0.1"} 1',
+            'test_seconds_bucket{handler="receive",le="1"} 2',
+            'test_seconds_bucket{handler="receive",le="+Inf"} 3',
+            'test_seconds_sum{handler="receive"} 2.55',
+            'test_seconds_count{handler="receive"} 3',
+        ])
+
+    def test_labelled_gauge_series_are_removed_at_zero(self):
+        gauge = Gauge('test_connections', 'Test.')
+        gauge.inc(room='a')
+        gauge.inc(room='b')
+        gauge.dec(room='a')
+
+        self.assertEqual(list(gauge.samples()), ['test_connections{room="b"} 1'])
+
+
+class JWTAuthMiddlewareTests(SimpleTestCase):
+    def token(self):
+        token = AccessToken.for_user(User(id=7, username='ana'))
+        token['username'] = 'ana'
+        return str(token)
+
+    def test_user_from_subprotocol(self):
+        user = get_token_user({'subprotocols': ['chat.json.v1', f'access_token.{self.token()}'], 'headers': []})
+        self.assertTrue(user.is_authenticated)
+        self.assertEqual((user.id, user.username), (7, 'ana'))
+
+    def test_user_from_cookie(self):
+        cookie = f'theme=dark; access_token={self.token()}'.encode()
+        user = get_token_user({'subprotocols': [], 'headers': [(b'cookie', cookie)]})
+        self.assertEqual(user.id, 7)
+
+    def test_invalid_token_is_anonymous(self):
+        user = get_token_user({'subprotocols': ['access_token.not-a-jwt'], 'headers': []})
+        self.assertFalse(user.is_authenticated)
+
+
+class WebSocketOriginTests(ConsumerTestCase):
+    async def connect_from(self, origin):
+        from chat.asgi import application
+
+        token = AccessToken.for_user(self.ana)
+        token['username'] = self.ana.username
+        communicator = WebsocketCommunicator(application, f'/ws/chat/{self.room_name}/', headers=[
+            (b'origin', origin.encode()),
+            (b'cookie', f'access_token={token}'.encode()),
+        ])
+        connected, _ = await communicator.connect()
+        await communicator.disconnect()
+        return connected
+
+    async def test_cookie_sockets_are_only_accepted_from_the_frontend(self):
+        self.assertTrue(await self.connect_from(settings.CORS_ALLOWED_ORIGINS[0]))
+        self.assertFalse(await self.connect_from('https://evil.example'))
+
+
+class LRUCacheTests(SimpleTestCase):
+    def test_entries_expire_after_ttl(self):
+        cache = LRUCache(maxsize=2, ttl=60)
+        with mock.patch('core.cache.time.monotonic', return_value=1000):
+            cache.set('user', 1)
+        with mock.patch('core.cache.time.monotonic', return_value=1059):
+            self.assertEqual(cache.get('user'), 1)
+        with mock.patch('core.cache.time.monotonic', return_value=1061):
+            self.assertIsNone(cache.get('user'))
+
+
+class AvatarUrlTests(TestCase):
+    def setUp(self):
+        avatar_urls.clear()
+        self.addCleanup(avatar_urls.clear)
+        patcher = mock.patch('core.serializers.cloudinary_url', side_effect=lambda public_id, **options: (f'https://res.example.com/{public_id}', options))
+        self.cloudinary_url = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_urls_are_resolved_once_per_public_id_and_options(self):
+        self.assertEqual(avatar_url('avatars/ana'), 'https://res.example.com/avatars/ana')
+        self.assertEqual(avatar_url('avatars/ana'), 'https://res.example.com/avatars/ana')
+        avatar_url('avatars/ana', width=64)
+        avatar_url('avatars/bo')
+        self.assertEqual(self.cloudinary_url.call_count, 3)
+        self.cloudinary_url.assert_any_call('avatars/ana', secure=True, width=64)
+
+    def test_saving_a_picture_resolves_it_for_the_serializer(self):
+        user = User.objects.create(username='ana', email='ana@example.com', profile_picture=CloudinaryResource('avatars/ana', format='png', version=1, type='upload', resource_type='image'))
+        self.assertEqual(self.cloudinary_url.call_count, 1)
+
+        user.refresh_from_db()
+        data = UserSerializer([user, user], many=True).data
+        self.assertEqual([item['profile_picture'] for item in data], ['https://res.example.com/avatars/ana'] * 2)
+        self.assertEqual(self.cloudinary_url.call_count, 1)
+
+        user.save(update_fields=['username'])
+        self.assertEqual(self.cloudinary_url.call_count, 1)
+
+
+class RoomHistoryTests(SimpleTestCase):
+    def message(self, message_id, user_id=1):
+        return {'id': message_id, 'user': {'id': user_id}, 'text': 'x' * 10, 'seen_by': []}
+
+    def filled(self, messages, complete=False, watermarks=None, **kwargs):
+        history = RoomHistory(**{'size': 3, 'max_bytes': 10000, **kwargs})
+        token = history.begin_fill(1)
+        history.fill(1, token, messages, complete=complete, watermarks=watermarks or {})
+        return history
+
+    def test_serves_newest_page_with_appended_messages(self):
+        history = self.filled([self.message(2), self.message(1)], complete=True, watermarks={2: 2})
+        history.append(1, self.message(3))
+
+        results, has_older = history.get(1, 2)
+        self.assertEqual([message['id'] for message in results], [3, 2])
+        self.assertEqual([message['seen_by'] for message in results], [[], [2]])
+        self.assertTrue(has_older)
+        self.assertFalse(history.get(1, 3)[1])
+
+    def test_incomplete_entry_misses_larger_pages(self):
+        history = self.filled([self.message(2), self.message(1)])
+        self.assertIsNone(history.get(1, 3))
+
+    def test_write_during_fill_discards_it(self):
+        history = RoomHistory(size=3, max_bytes=10000)
+        token = history.begin_fill(1)
+        history.append(1, self.message(3))
+        history.fill(1, token, [self.message(2), self.message(1)], complete=True, watermarks={})
+        self.assertIsNone(history.get(1, 1))
+
+    def test_out_of_order_write_drops_entry(self):
+        history = self.filled([self.message(2), self.message(1)], complete=True)
+        history.append(1, self.message(2))
+        self.assertIsNone(history.get(1, 1))
+
+    def test_least_recently_used_rooms_are_evicted(self):
+        history = RoomHistory(size=3, max_bytes=150)
+        for room_id in (1, 2, 3):
+            token = history.begin_fill(room_id)
+            history.fill(room_id, token, [self.message(1)], complete=True, watermarks={})
+        self.assertIsNone(history.get(1, 1))
+        self.assertIsNotNone(history.get(3, 1))
+
+
+class MediaUploadTests(TransactionTestCase):
+    """
+    Jobs for the media pool are run in the test's thread by `run_jobs`, once
+    their on_commit callbacks have submitted them.
+    """
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        # The fields resolve their storage when the model is loaded, so settings cannot swap it
+        storage = FileSystemStorage(location=directory.name, base_url='/media/')
+        for name in ('file', 'thumbnail'):
+            patcher = mock.patch.object(MediaAsset._meta.get_field(name), 'storage', storage)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        media = {**settings.CHAT_MEDIA, 'UPLOAD_DIR': os.path.join(directory.name, 'uploads'), 'MAX_CHUNK_SIZE': 64}
+        overrides = override_settings(CHAT_MEDIA=media)
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+
+        self.jobs = []
+        patcher = mock.patch.object(media_executor, 'submit', side_effect=lambda *job: self.jobs.append(job))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        buffer = io.BytesIO()
+        Image.new('RGB', (64, 48), 'orange').save(buffer, format='PNG')
+        self.content = buffer.getvalue()
+
+        self.client = APIClient()
+        self.client.force_authenticate(User.objects.create(username='ana', email='ana@example.com'))
+
+    def as_user(self, username):
+        self.client.force_authenticate(User.objects.create(username=username, email=f'{username}@example.com'))
+
+    def run_jobs(self):
+        # Including the thumbnail jobs that completing an upload submits
+        while self.jobs:
+            func, *args = self.jobs.pop(0)
+            func(*args)
+
+    def send(self, content, filename='cat.png', content_type='image/png'):
+        """
+        Start an upload and send its chunks. Returns the response that started
+        it, which is the existing asset if the content is known.
+        """
+
+        started = self.client.post('/api/media/uploads/', {
+            'filename': filename, 'content_type': content_type, 'size': len(content),
+            'sha256': hashlib.sha256(content).hexdigest(),
+        })
+        if started.status_code == 200:
+            return started
+        chunk_size = settings.CHAT_MEDIA['MAX_CHUNK_SIZE']
+        for first in range(0, len(content), chunk_size):
+            chunk = content[first:first + chunk_size]
+            response = self.client.put(
+                f"/api/media/uploads/{started.data['id']}/", chunk, content_type='application/octet-stream',
+                HTTP_CONTENT_RANGE=f'bytes {first}-{first + len(chunk) - 1}/{len(content)}',
+            )
+            self.assertEqual(response.data['offset'], first + len(chunk))
+        return started
+
+    def upload(self, content=None):
+        """
+        Upload `content` and wait for it to be completed. Returns the completed
+        asset's data.
+        """
+
+        response = self.send(content or self.content)
+        if response.status_code == 200:
+            return response.data['asset']
+        upload_id = response.data['id']
+        self.assertEqual(self.client.post(f'/api/media/uploads/{upload_id}/complete/').status_code, 202)
+        self.run_jobs()
+        response = self.client.post(f'/api/media/uploads/{upload_id}/complete/')
+        self.assertEqual(response.status_code, 200)
+        return response.data
+
+    def test_completion_happens_in_the_background(self):
+        upload_id = self.send(self.content).data['id']
+        response = self.client.post(f'/api/media/uploads/{upload_id}/complete/')
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(response.data['offset'], len(self.content))
+        self.assertIsNone(response.data['asset'])
+        # A repeated request schedules a run that finds the upload completed
+        self.assertEqual(self.client.post(f'/api/media/uploads/{upload_id}/complete/').status_code, 202)
+        self.run_jobs()
+
+        asset_data = self.client.get(f'/api/media/uploads/{upload_id}/').data['asset']
+        asset = MediaAsset.objects.get(pk=asset_data['id'])
+        self.assertEqual((asset.kind, asset.size, asset.status), ('image', len(self.content), 'ready'))
+        self.assertEqual((asset.width, asset.height), (64, 48))
+        with asset.file.open('rb') as f:
+            self.assertEqual(f.read(), self.content)
+        self.assertTrue(asset.thumbnail.storage.exists(asset.thumbnail.name))
+        self.assertEqual(MediaAsset.objects.count(), 1)
+
+    def test_extension_comes_from_the_content_type(self):
+        upload_id = self.send(self.content, filename='cat.html').data['id']
+        self.client.post(f'/api/media/uploads/{upload_id}/complete/')
+        self.run_jobs()
+
+        asset = MediaAsset.objects.get()
+        self.assertTrue(asset.file.name.endswith('.png'))
+
+    def test_content_that_is_not_the_declared_image_is_rejected(self):
+        page = b'<html><script>alert(document.cookie)</script></html>'
+        jpeg = io.BytesIO()
+        Image.new('RGB', (8, 8)).save(jpeg, format='JPEG')
+        for content in (page, jpeg.getvalue()):
+            upload_id = self.send(content, filename='cat.html').data['id']
+            self.assertEqual(self.client.post(f'/api/media/uploads/{upload_id}/complete/').status_code, 202)
+            self.run_jobs()
+
+            response = self.client.post(f'/api/media/uploads/{upload_id}/complete/')
+            self.assertEqual(response.status_code, 400)
+            self.assertEqual(self.client.get(f'/api/media/uploads/{upload_id}/').data['error'], response.data['detail'])
+        self.assertFalse(MediaAsset.objects.exists())
+        self.assertEqual(os.listdir(settings.CHAT_MEDIA['UPLOAD_DIR']), [])
+
+    def test_only_known_content_types_are_accepted(self):
+        for content_type in ('image/svg+xml', 'text/html', 'video/x-unknown'):
+            response = self.client.post('/api/media/uploads/', {
+                'filename': 'cat', 'content_type': content_type, 'size': 10,
+            })
+            self.assertEqual(response.status_code, 400)
+
+    def test_media_is_served_as_a_download(self):
+        asset_id = self.upload()['id']
+        asset = MediaAsset.objects.get(pk=asset_id)
+        request = RequestFactory().get(asset.file.url)
+        response = serve_media(request, asset.file.name, document_root=asset.file.storage.location)
+        self.assertEqual(response['Content-Type'], 'image/png')
+        self.assertEqual(response['Content-Disposition'], 'attachment')
+        self.assertEqual(response['X-Content-Type-Options'], 'nosniff')
+
+    def test_incomplete_upload_cannot_be_completed(self):
+        upload_id = self.client.post('/api/media/uploads/', {
+            'filename': 'cat.png', 'content_type': 'image/png', 'size': 10,
+        }).data['id']
+        self.client.put(
+            f'/api/media/uploads/{upload_id}/', b'0123', content_type='application/octet-stream',
+            HTTP_CONTENT_RANGE='bytes 0-3/10',
+        )
+        self.assertEqual(self.client.post(f'/api/media/uploads/{upload_id}/complete/').status_code, 400)
+        self.assertEqual(self.jobs, [])
+
+    def test_known_content_is_not_uploaded_again(self):
+        first = self.upload()
+        response = self.send(self.content)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['asset']['id'], first['id'])
+        self.assertEqual(MediaAsset.objects.count(), 1)
+
+    def test_other_users_content_is_only_matched_after_upload(self):
+        first = self.upload()
+        self.as_user('eve')
+
+        # Knowing the hash is not enough to get the file
+        response = self.client.post('/api/media/uploads/', {
+            'filename': 'cat.png', 'content_type': 'image/png', 'size': len(self.content),
+            'sha256': hashlib.sha256(self.content).hexdigest(),
+        })
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(self.client.get(f"/api/media/{first['id']}/").status_code, 404)
+
+        # Sending the whole content is
+        second = self.upload()
+        self.assertEqual(second['id'], first['id'])
+        self.assertEqual(self.client.get(f"/api/media/{first['id']}/").status_code, 200)
+
+    def test_assets_are_visible_in_the_rooms_they_were_sent_to(self):
+        asset_id = self.upload()['id']
+        sender = User.objects.get(username='ana')
+        room = ChatRoom.objects.create(name='media')
+        Message.objects.create(chat_room=room, user=sender, text='', message_type='image', media_id=asset_id)
+        self.as_user('bo')
+        self.assertEqual(self.client.get(f'/api/media/{asset_id}/').status_code, 404)
+
+        Conversation.objects.create(chat_room=room, is_group=True).participants.add(sender, User.objects.get(username='bo'))
+        self.assertEqual(self.client.get(f'/api/media/{asset_id}/').status_code, 200)
+
+    def test_out_of_order_chunk_is_rejected(self):
+        upload_id = self.client.post('/api/media/uploads/', {
+            'filename': 'cat.png', 'content_type': 'image/png', 'size': 8,
+        }).data['id']
+        response = self.client.put(
+            f'/api/media/uploads/{upload_id}/', b'4567', content_type='application/octet-stream',
+            HTTP_CONTENT_RANGE='bytes 4-7/8',
+        )
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.data['offset'], 0)
+
+
+class MessageExportTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create(username='ana', email='ana@example.com')
+        self.room = ChatRoom.objects.create(name='export')
+        Conversation.objects.create(chat_room=self.room, is_group=True).participants.add(self.user)
+        self.messages = [
+            Message.objects.create(chat_room=self.room, user=self.user, text=f'message {index}')
+            for index in range(3)
+        ]
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def export(self, query=''):
+        response = self.client.get(f'/api/messages/export/export/{query}')
+        self.assertEqual(response.status_code, 200)
+        with warnings.catch_warnings():
+            # The test client consumes the async stream synchronously
+            warnings.simplefilter('ignore')
+            return response, b''.join(response)
+
+    def test_exports_ndjson_oldest_first(self):
+        _, content = self.export()
+        lines = [json.loads(line) for line in content.splitlines()]
+        self.assertEqual([line['text'] for line in lines], ['message 0', 'message 1', 'message 2'])
+        self.assertEqual(lines[0]['user'], {'id': self.user.id, 'username': 'ana'})
+
+    def test_since_and_gzip(self):
+        response, content = self.export(f'?since={self.messages[0].id}&gzip=1')
+        self.assertEqual(response['Content-Type'], 'application/gzip')
+        lines = [json.loads(line) for line in gzip.decompress(content).splitlines()]
+        self.assertEqual([line['id'] for line in lines], [self.messages[1].id, self.messages[2].id])
+
+    def test_non_participants_cannot_export(self):
+        self.client.force_authenticate(User.objects.create(username='bo', email='bo@example.com'))
+        self.assertEqual(self.client.get('/api/messages/export/export/').status_code, 403)
@@ -8,5 +8,14 @@ urlpatterns = [
     path('user/logout/', views.LogoutView.as_view(), name='logout'),
     path('user/refresh/', views.RefreshTokenView.as_view(), name='token_refresh'),
     path('chatrooms/', views.ChatRoomView.as_view(), name='chat_room'),
+    path('conversations/', views.ConversationListView.as_view(), name='conversation_list'),
     path('messages/<str:room_name>/', views.MessageListView.as_view(), name='message_list'),
+    path('messages/<str:room_name>/export/', views.MessageExportView.as_view(), name='message_export'),
+    path('search/messages/', views.MessageSearchView.as_view(), name='message_search'),
+    path('media/uploads/', views.MediaUploadView.as_view(), name='media_upload'),
+    path('media/uploads/<uuid:upload_id>/', views.MediaUploadChunkView.as_view(), name='media_upload_chunk'),
+    path('media/uploads/<uuid:upload_id>/complete/', views.MediaUploadCompleteView.as_view(), name='media_upload_complete'),
+    path('media/<int:pk>/', views.MediaAssetView.as_view(), name='media_asset'),
+    path('unread/', views.UnreadCountView.as_view(), name='unread_counts'),
+    path('metrics/', views.MetricsView.as_view(), name='metrics'),
 ]
@@ -1,22 +1,48 @@
+import hashlib
+import json
+import re
+import zlib
+
 from django.conf import settings
+from django.db import transaction
 from django.db.models import Count
+from django.http import HttpResponse, StreamingHttpResponse
+from django.utils.dateparse import parse_datetime
+from django.utils.http import parse_etags, quote_etag
+from django.views.static import serve
 from rest_framework import generics, permissions, status, exceptions
 from rest_framework.exceptions import PermissionDenied
 from rest_framework.exceptions import ValidationError
-from rest_framework.permissions import IsAuthenticated
+from rest_framework.permissions import IsAdminUser, IsAuthenticated
 from rest_framework.response import Response
 from rest_framework.throttling import AnonRateThrottle
 from rest_framework.views import APIView
 from rest_framework_simplejwt import tokens
+from rest_framework_simplejwt.settings import api_settings
 from rest_framework_simplejwt.views import TokenObtainPairView
 from django.shortcuts import get_object_or_404
 
-from .models import User, ChatRoom, Message, Conversation
+from .models import User, ChatRoom, Message, Conversation, ReadState, MediaUpload
+from . import metrics
+from .cache import invalidate, principals, room_ids
+from .encoding import encode_frame
+from .history import room_history
+from .media import append_chunk, schedule_completion, visible_assets
+from .search import search_messages
+from .pagination import (
+    ConversationCursorPagination,
+    MessageKeysetPagination,
+    UserDirectoryPagination,
+    messages_after,
+)
 from .serializers import (
     MyTokenObtainPairSerializer,
     UserSerializer, 
     ChatRoomSerializer, 
+    ConversationSerializer,
     MessageSerializer,
+    MediaAssetSerializer,
+    MediaUploadSerializer,
     RegistrationSerializer
     )
 
@@ -125,6 +151,7 @@ class LogoutView(APIView):
             
             token = tokens.RefreshToken(refresh_token)
             token.blacklist()
+            invalidate(principals, token[api_settings.USER_ID_CLAIM])
 
             response = Response({'detail': 'Logged out successfully'}, status=status.HTTP_200_OK)
             response.delete_cookie(settings.SIMPLE_JWT['AUTH_COOKIE'])
@@ -192,29 +219,388 @@ class RefreshTokenView(APIView):
             return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
 
 class UserListView(generics.ListAPIView):
+    """
+    Paginated user directory.
+
+    `?search=<prefix>` matches the start of usernames, case-insensitively, using
+    the username prefix index. Pages carry an ETag, and a request whose
+    If-None-Match matches it gets an empty 304 response.
+    """
+
     serializer_class = UserSerializer
     permission_classes = [IsAuthenticated]
+    pagination_class = UserDirectoryPagination
 
     def get_queryset(self):
         user = self.request.user
+        queryset = User.objects.only('id', 'username', 'profile_picture', 'is_online')
         if user is not None:
-            return User.objects.exclude(id=user.id)
-        return User.objects.all()
+            queryset = queryset.exclude(id=user.id)
+        search = self.request.query_params.get('search')
+        if search:
+            queryset = queryset.filter(username__istartswith=search)
+        return queryset
+
+    def list(self, request, *args, **kwargs):
+        response = super().list(request, *args, **kwargs)
+        content = json.dumps(response.data, sort_keys=True, default=str).encode()
+        etag = quote_etag(hashlib.md5(content).hexdigest())
+        if etag in parse_etags(request.META.get('HTTP_IF_NONE_MATCH', '')):
+            return Response(status=status.HTTP_304_NOT_MODIFIED, headers={'ETag': etag})
+        response['ETag'] = etag
+        return response
 
 class ChatRoomView(generics.ListCreateAPIView):
     queryset = ChatRoom.objects.all()
     serializer_class = ChatRoomSerializer
 
+class ConversationListView(generics.ListAPIView):
+    """
+    Conversations of the requesting user, most recently active first, each with
+    its participants and a preview of the last message. A page costs two
+    queries however much history the conversations hold.
+    """
+
+    serializer_class = ConversationSerializer
+    permission_classes = [IsAuthenticated]
+    pagination_class = ConversationCursorPagination
+
+    def get_queryset(self):
+        return (
+            Conversation.objects.filter(participants=self.request.user)
+            .select_related('chat_room', 'last_message_sender')
+            .prefetch_related('participants')
+        )
+
 class MessageListView(generics.ListAPIView):
+    """
+    Newest-first, keyset-paginated message history of a room.
+
+    Query parameters:
+        before: Message id; return the page of messages older than it.
+        after: Message id; return the page of messages newer than it.
+        limit: Page size, capped at `MessageKeysetPagination.max_limit`.
+
+    The newest page is served from the room's hot history when this process
+    has it (see core.history), and fills it otherwise.
+    """
+
     serializer_class = MessageSerializer
     permission_classes = [IsAuthenticated]
+    pagination_class = MessageKeysetPagination
+
+    chat_room = None
+    watermarks = None
+
+    def list(self, request, *args, **kwargs):
+        params = request.query_params
+        if not room_history.enabled or params.get('before') or params.get('after'):
+            return super().list(request, *args, **kwargs)
+
+        room_id = self.get_room_id()
+        if room_id is None:
+            return super().list(request, *args, **kwargs)
+        cached = room_history.get(room_id, self.paginator.get_limit(request))
+        if cached is not None:
+            results, has_older = cached
+            return Response({
+                'before': results[-1]['id'] if results and has_older else None,
+                'after': None,
+                'results': results,
+            })
+
+        token = room_history.begin_fill(room_id)
+        response = super().list(request, *args, **kwargs)
+        room_history.fill(
+            room_id, token, response.data['results'],
+            complete=response.data['before'] is None,
+            watermarks=self.watermarks or {},
+        )
+        return response
+
+    def get_room_id(self):
+        room_name = self.kwargs['room_name']
+        room_id = room_ids.get(room_name)
+        if room_id is None:
+            # Rooms without a Conversation are not cached, like in ChatConsumer.get_room_id,
+            # so that the first participant to connect to a direct room still creates it
+            room_id = Conversation.objects.filter(chat_room__name=room_name).values_list('chat_room_id', flat=True).first()
+            if room_id is not None:
+                room_ids.set(room_name, room_id)
+        return room_id
 
     def get_queryset(self):
         room_name = self.kwargs['room_name']
         try:
-            chat_room = ChatRoom.objects.get(name=room_name)
+            self.chat_room = ChatRoom.objects.get(name=room_name)
         except ChatRoom.DoesNotExist:
             # Return an empty queryset if the chat room doesn't exist
             return Message.objects.none()
 
-        return Message.objects.filter(chat_room=chat_room).order_by('created_at')
+        return Message.objects.filter(chat_room=self.chat_room).select_related('user', 'media')
+
+    def get_serializer_context(self):
+        context = super().get_serializer_context()
+        if self.chat_room is not None:
+            # seen_by is derived from the readers' watermarks
+            self.watermarks = context['watermarks'] = dict(
+                ReadState.objects.filter(chat_room=self.chat_room)
+                .values_list('user_id', 'last_read_message_id')
+            )
+        return context
+
+class MessageExportView(APIView):
+    """
+    Stream a room's whole message history as newline-delimited JSON, oldest
+    first, one message per line.
+
+    Rows are read through a server-side cursor in chunks and written out as
+    they arrive, so memory use does not grow with the size of the room. Only
+    the room's participants (and staff) may export it.
+
+    Query parameters:
+        since: Message id or ISO 8601 datetime; only export messages after it.
+        gzip: If 1, the stream is gzip-compressed.
+    """
+
+    permission_classes = [IsAuthenticated]
+    chunk_size = 2000
+    # Lines are sent in pieces of about this many bytes
+    flush_size = 64 * 1024
+    fields = ('id', 'user_id', 'user__username', 'text', 'message_type', 'media_id', 'created_at')
+
+    def get(self, request, room_name):
+        chat_room = get_object_or_404(ChatRoom, name=room_name)
+        if not request.user.is_staff and not Conversation.objects.filter(
+            chat_room=chat_room, participants=request.user
+        ).exists():
+            raise PermissionDenied("You are not a participant of this room.")
+
+        messages = Message.objects.filter(chat_room=chat_room)
+        since = request.query_params.get('since')
+        if since:
+            messages = self.filter_since(messages, since)
+        messages = messages.order_by('created_at', 'id').values(*self.fields)
+
+        compress = request.query_params.get('gzip') == '1'
+        response = StreamingHttpResponse(
+            self.stream(messages, compress),
+            content_type='application/gzip' if compress else 'application/x-ndjson',
+        )
+        filename = f'{room_name}.ndjson.gz' if compress else f'{room_name}.ndjson'
+        response['Content-Disposition'] = f'attachment; filename="{filename}"'
+        return response
+
+    def filter_since(self, messages, since):
+        if since.isdigit():
+            anchor = messages.filter(id=int(since)).values('id', 'created_at').first()
+            if anchor is None:
+                raise ValidationError({'since': f'Message {since} does not exist in this room.'})
+            return messages_after(messages, anchor)
+        since_at = parse_datetime(since)
+        if since_at is None:
+            raise ValidationError({'since': 'A message id or an ISO 8601 datetime is required.'})
+        return messages.filter(created_at__gt=since_at)
+
+    async def stream(self, messages, compress):
+        # wbits=31 writes a gzip header and trailer around the deflate stream
+        compressor = zlib.compressobj(wbits=31) if compress else None
+        lines = []
+        size = 0
+        async for row in messages.aiterator(chunk_size=self.chunk_size):
+            line = encode_frame({
+                'id': row['id'],
+                'user': {'id': row['user_id'], 'username': row['user__username']},
+                'text': row['text'],
+                'message_type': row['message_type'],
+                'media': row['media_id'],
+                'created_at': row['created_at'].isoformat(),
+            }) + '\n'
+            lines.append(line)
+            size += len(line)
+            if size >= self.flush_size:
+                data = ''.join(lines).encode()
+                lines, size = [], 0
+                yield compressor.compress(data) if compressor else data
+        data = ''.join(lines).encode()
+        if compressor:
+            yield compressor.compress(data) + compressor.flush()
+        elif data:
+            yield data
+
+class MessageSearchView(APIView):
+    """
+    Full-text search over the messages of the rooms the requesting user takes
+    part in, best match first.
+
+    Query parameters:
+        q: Search terms.
+        cursor: `next` cursor of the previous page.
+        limit: Page size, at most 50.
+    """
+
+    permission_classes = [IsAuthenticated]
+    default_limit = 20
+    max_limit = 50
+
+    def get(self, request):
+        query = request.query_params.get('q', '').strip()
+        if not query:
+            raise ValidationError({'q': 'This query parameter is required.'})
+        try:
+            limit = min(int(request.query_params.get('limit', self.default_limit)), self.max_limit)
+        except ValueError:
+            raise ValidationError({'limit': 'A valid integer is required.'})
+
+        room_ids = Conversation.objects.filter(participants=request.user).values_list('chat_room_id', flat=True)
+        results, next_cursor = search_messages(query, room_ids, max(limit, 1), request.query_params.get('cursor'))
+
+        data = []
+        for message, rank in results:
+            item = MessageSerializer(message).data
+            item['room_name'] = message.chat_room.name
+            item['rank'] = rank
+            data.append(item)
+        return Response({'next': next_cursor, 'results': data})
+
+class MediaUploadView(generics.CreateAPIView):
+    """
+    Start a chunked media upload.
+
+    Responds 201 with the upload's id and offset, after which the file is sent
+    with PUT requests to media/uploads/<id>/. If a `sha256` is given and the
+    user can already see an asset with that content, responds 200 with it
+    instead; other users' files are only matched once the content is uploaded.
+    """
+
+    serializer_class = MediaUploadSerializer
+    permission_classes = [IsAuthenticated]
+
+    def create(self, request, *args, **kwargs):
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        sha256 = serializer.validated_data.pop('sha256', None)
+        if sha256:
+            asset = visible_assets(request.user.id).filter(sha256=sha256).first()
+            if asset is not None:
+                return Response({'asset': MediaAssetSerializer(asset).data}, status=status.HTTP_200_OK)
+        serializer.save(user=request.user)
+        return Response(serializer.data, status=status.HTTP_201_CREATED)
+
+class MediaUploadChunkView(APIView):
+    """
+    Receive one chunk of an upload.
+
+    The chunk is the raw request body, placed with a
+    `Content-Range: bytes <first>-<last>/<size>` header. Chunks must be sent in
+    order; a chunk that does not start at the upload's offset gets a 409 with
+    the offset to resume from. GET returns the current offset.
+    """
+
+    permission_classes = [IsAuthenticated]
+    content_range = re.compile(r'^bytes (\d+)-(\d+)/(\d+)$')
+
+    def get(self, request, upload_id):
+        upload = get_object_or_404(MediaUpload, pk=upload_id, user=request.user)
+        return Response(MediaUploadSerializer(upload).data)
+
+    def put(self, request, upload_id):
+        match = self.content_range.match(request.headers.get('Content-Range', ''))
+        if match is None:
+            raise ValidationError({'Content-Range': 'Expected "bytes <first>-<last>/<size>".'})
+        first, last, size = (int(group) for group in match.groups())
+        length = last - first + 1
+
+        with transaction.atomic():
+            upload = get_object_or_404(MediaUpload.objects.select_for_update(), pk=upload_id, user=request.user)
+            if size != upload.size or last >= size or length < 1:
+                raise ValidationError({'Content-Range': 'Range does not fit the upload.'})
+            if length > settings.CHAT_MEDIA['MAX_CHUNK_SIZE']:
+                raise ValidationError({'Content-Range': f"Chunks are at most {settings.CHAT_MEDIA['MAX_CHUNK_SIZE']} bytes."})
+            if first != upload.received:
+                return Response({'offset': upload.received}, status=status.HTTP_409_CONFLICT)
+            # Read from the request stream piece by piece rather than through request.body
+            written = append_chunk(upload, request.stream, length) if request.stream is not None else 0
+            if written != length:
+                raise ValidationError({'detail': 'The request body is shorter than its Content-Range.'})
+            upload.received += written
+            upload.save(update_fields=['received'])
+        return Response({'offset': upload.received})
+
+class MediaUploadCompleteView(APIView):
+    """
+    Finish a fully received upload.
+
+    The file is hashed and stored in the background: responds 202 with the
+    upload, which is then polled at media/uploads/<id>/ until its `asset` is
+    set. Once it is, responds 200 with the asset, or 400 with the upload's
+    `error` if the content was rejected. Thumbnails are made after that; the
+    asset's status is "processing" until then.
+    """
+
+    permission_classes = [IsAuthenticated]
+
+    def post(self, request, upload_id):
+        upload = get_object_or_404(MediaUpload.objects.select_related('asset'), pk=upload_id, user=request.user)
+        if upload.asset_id is not None:
+            return Response(MediaAssetSerializer(upload.asset).data)
+        if upload.error:
+            raise ValidationError({'detail': upload.error})
+        if upload.received != upload.size:
+            raise ValidationError({'detail': f'Received {upload.received} of {upload.size} bytes.'})
+        schedule_completion(upload.pk)
+        return Response(MediaUploadSerializer(upload).data, status=status.HTTP_202_ACCEPTED)
+
+class MediaAssetView(generics.RetrieveAPIView):
+    """
+    A media asset, e.g. to poll its status while thumbnails are made. Only
+    assets the user uploaded or can see in one of their rooms are found.
+    """
+
+    serializer_class = MediaAssetSerializer
+    permission_classes = [IsAuthenticated]
+
+    def get_queryset(self):
+        return visible_assets(self.request.user.id)
+
+def serve_media(request, path, document_root=None):
+    """
+    Serve a file of the local 'chat_media' storage in development. Uploads are
+    user content, so browsers are told to download rather than render them and
+    not to second-guess their content type.
+    """
+
+    response = serve(request, path, document_root=document_root)
+    response['Content-Disposition'] = 'attachment'
+    response['X-Content-Type-Options'] = 'nosniff'
+    return response
+
+class UnreadCountView(APIView):
+    """
+    Unread message counts of every room the requesting user has unread messages
+    in, as {room name: count}, read from the maintained counters in one query.
+    """
+
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request):
+        counts = (
+            ReadState.objects.filter(user=request.user, unread_count__gt=0)
+            .values_list('chat_room__name', 'unread_count')
+        )
+        return Response(dict(counts))
+
+class IsMetricsScraper(permissions.BasePermission):
+    def has_permission(self, request, view):
+        return request.META.get('REMOTE_ADDR') in settings.CHAT_METRICS['ALLOWED_IPS']
+
+class MetricsView(APIView):
+    """
+    Handler timings, connection and queue gauges and slow-consumer counters of
+    the process serving the request, in the Prometheus text format.
+    """
+
+    permission_classes = [IsAdminUser | IsMetricsScraper]
+
+    def get(self, request):
+        return HttpResponse(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
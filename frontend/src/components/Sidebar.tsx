@@ -11,7 +11,7 @@ import {
   TooltipProvider,
   TooltipTrigger
 } from "./ui/tooltip";
-import { useEffect, useRef } from "react";
+import { useEffect, useRef, useState } from "react";
 import { useToast } from "./ui/use-toast";
 import { getCookie } from "../lib/utils";
 
@@ -31,8 +31,10 @@ const Sidebar = ({ isCollapsed }: SidebarProps) => {
     logout
   } = useUserContext();
   const { toast } = useToast();
+  // Query string of the next page of the user directory, if there is one
+  const [nextUsersPage, setNextUsersPage] = useState<string | null>(null);
 
-  const fetchUsers = async () => {
+  const fetchUsers = async (page = '', append = false) => {
     const token = getCookie('access_token');
 
     if (!token) {
@@ -47,7 +49,7 @@ const Sidebar = ({ isCollapsed }: SidebarProps) => {
     }
   
     try {
-      const response = await fetch(`/api/user/list/`, {
+      const response = await fetch(`/api/user/list/${page}`, {
         headers: {
           'Content-Type': 'application/json',
           'Authorization': `Bearer ${token}`,
@@ -58,7 +60,8 @@ const Sidebar = ({ isCollapsed }: SidebarProps) => {
         throw new Error('Network response was not ok');
       }  
       const data = await response.json();
-      setUsers(data);
+      setUsers(append ? [...users, ...data.results] : data.results);
+      setNextUsersPage(data.next ? new URL(data.next).search : null);
     } catch (error) {
       console.error('Failed to fetch users:', error);
     }
@@ -67,14 +70,19 @@ const Sidebar = ({ isCollapsed }: SidebarProps) => {
   useEffect(() => {
     if (user) {
       fetchUsers();
-      // const newClient = new WebSocket(`ws://127.0.0.1:8000/ws/chat/global/?user_id=${user?.id}`);
-      const newClient = new WebSocket(`wss://chat-api-e2xv.onrender.com/ws/chat/global/?user_id=${user?.id}`);
+      // The access token goes in a subprotocol, since browsers cannot set headers on WebSockets
+      const protocols = ['chat.json.v1', `access_token.${getCookie('access_token')}`];
+      // const newClient = new WebSocket(`ws://127.0.0.1:8000/ws/chat/global/`, protocols);
+      const newClient = new WebSocket(`wss://chat-api-e2xv.onrender.com/ws/chat/global/`, protocols);
       clientRef.current = newClient;
       newClient.onmessage = (message) => {
         const data = JSON.parse(message.data as string);
-        if (data.type === 'user_status') {
-          console.log('User logged in. Updating status..')
-          updateUserStatus(data.user, data.status === 'online');
+        if (data.type === 'presence_snapshot') {
+          data.online.forEach((username: string) => updateUserStatus(username, true));
+        }
+        if (data.type === 'presence') {
+          data.online.forEach((username: string) => updateUserStatus(username, true));
+          data.offline.forEach((username: string) => updateUserStatus(username, false));
         }
         if (data.type === 'global_message') {
           const { message, room_name } = data;
@@ -91,7 +99,14 @@ const Sidebar = ({ isCollapsed }: SidebarProps) => {
           }
         }
       };
+      // Keep the presence registry from expiring this connection
+      const heartbeat = setInterval(() => {
+        if (newClient.readyState === WebSocket.OPEN) {
+          newClient.send(JSON.stringify({ type: 'heartbeat' }));
+        }
+      }, 30000);
       return () => {
+        clearInterval(heartbeat);
         newClient.close();
       };
     }
@@ -166,6 +181,15 @@ const Sidebar = ({ isCollapsed }: SidebarProps) => {
             </Button>
           )
         )}
+        {nextUsersPage && !isCollapsed && (
+          <Button
+            variant='ghost'
+            className='w-full my-1'
+            onClick={() => fetchUsers(nextUsersPage, true)}
+          >
+            Load more
+          </Button>
+        )}
       </ScrollArea>
 
       {/* logout section */}
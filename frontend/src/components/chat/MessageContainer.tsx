@@ -12,7 +12,7 @@ const MessageContainer = () => {
   const [messages, setMessages] = useState<IMessage[]>([]);
   const [messagesLoading, setMessagesLoading] = useState(false);
 
-  const fetchMessages = async (roomName: string) => {
+  const fetchMessages = useCallback(async (roomName: string) => {
     try {
       setMessagesLoading(true);
       const response = await fetch(`/api/messages/${roomName}/`, {
@@ -24,36 +24,81 @@ const MessageContainer = () => {
       );
       if (response.status === 200) {
         const data = await response.json();
-        setMessages(data);
+        // The API pages newest-first; the list renders oldest-first.
+        setMessages([...data.results].reverse());
       }
     } catch (error) {
       console.error('Failed to fetch messages:', error);
     } finally {
       setMessagesLoading(false);
     }
-  };
+  }, []);
 
   const connectWebSocket = useCallback((roomName: string) => {
-    if (clientRef.current) {
-      clientRef.current.close();
-    }
-    // const newClient = new WebSocket(`ws://127.0.0.1:8000/ws/chat/${roomName}/?user_id=${loggedUser?.id}`);
-    const newClient = new WebSocket(`wss://chat-api-e2xv.onrender.com/ws/chat/${roomName}/?user_id=${loggedUser?.id}`);
-    clientRef.current = newClient;
-    newClient.onopen = () => {
-      console.log('WebSocket Client Connected');
-    };
+    const connect = (since: number | null) => {
+      if (clientRef.current) {
+        clientRef.current.close();
+      }
+      // The access token goes in a subprotocol, since browsers cannot set headers on WebSockets
+      const protocols = ['chat.json.v1', `access_token.${getCookie('access_token')}`];
+      // Resuming after being dropped replays the messages after `since`
+      const query = since ? `?since=${since}` : '';
+      // const newClient = new WebSocket(`ws://127.0.0.1:8000/ws/chat/${roomName}/${query}`, protocols);
+      const newClient = new WebSocket(`wss://chat-api-e2xv.onrender.com/ws/chat/${roomName}/${query}`, protocols);
+      clientRef.current = newClient;
+      let resumeFrom = since;
+      newClient.onopen = () => {
+        console.log('WebSocket Client Connected');
+      };
 
-    newClient.onmessage = (message) => {
-      const data = JSON.parse(message.data as string);
-      setMessages((prevMessages) => [...prevMessages, data]);
-    };
+      newClient.onmessage = (message) => {
+        const data = JSON.parse(message.data as string);
+        if (data.type === 'read') {
+          setMessages((prevMessages) => prevMessages.map((msg) =>
+            msg.id <= data.messageId && msg.user.id !== data.user && !msg.seen_by?.includes(data.user)
+              ? { ...msg, seen_by: [...(msg.seen_by || []), data.user] }
+              : msg
+          ));
+          return;
+        }
+        if (data.type === 'resume') {
+          // Sent just before the server drops a client that fell behind
+          resumeFrom = data.since;
+          return;
+        }
+        if (data.type === 'history') {
+          if (data.truncated) {
+            // Too much was missed to replay; reload the newest page instead
+            fetchMessages(roomName);
+            return;
+          }
+          setMessages((prevMessages) => {
+            const ids = new Set(prevMessages.map((msg) => msg.id));
+            return [...prevMessages, ...data.messages.filter((msg: IMessage) => !ids.has(msg.id))];
+          });
+          return;
+        }
+        setMessages((prevMessages) => [...prevMessages, data]);
+        if (data.id && data.user.id !== loggedUser?.id) {
+          newClient.send(JSON.stringify({ type: 'read', messageId: data.id }));
+        }
+      };
 
-    newClient.onclose = () => {
-      console.log('WebSocket Client Disconnected');
+      newClient.onclose = (event) => {
+        console.log('WebSocket Client Disconnected');
+        // 4008: dropped for reading too slowly; reconnect where the client left off
+        if (event.code === 4008 && clientRef.current === newClient) {
+          if (!resumeFrom) {
+            // Dropped before anything was delivered; there is nothing to resume from
+            fetchMessages(roomName);
+          }
+          connect(resumeFrom);
+        }
+      };
     };
 
-    }, [loggedUser, setMessages]);
+    connect(null);
+  }, [loggedUser, setMessages, fetchMessages]);
 
   useEffect(() => {
     const handleEscape = (e: KeyboardEvent) => {